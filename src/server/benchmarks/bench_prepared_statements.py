@@ -0,0 +1,98 @@
+# Benchmark of the statements of a booking (make_reservation):
+# values pasted into the SQL text versus values bound to the placeholders of
+# the QUERIES registry, with and without the per-connection statement cache
+#
+# Fabrizio Giovannini Filho, Yuxin Guan, Lynnette Jiang, Jared McKeon, Fandi Meng
+#
+# Execution (from src/server): python -m benchmarks.bench_prepared_statements
+
+import os, sqlite3, sys, tempfile, time
+import database.database_helpers as database_helpers
+from database.database_queries import QUERIES
+from database.database_storage import apply_pragmas
+from benchmarks.bench_transaction_report import create_database
+
+RESERVATIONS = 20000
+BOOKINGS = 5000
+
+
+def booking_statements(i):
+    '''
+    Returns (query name, parameters) of the statements run by the i-th booking
+    '''
+    client_id = f'client{i % 50}'
+    reservation_date = f'2022-{i % 12 + 1:02d}-{i % 28 + 1:02d}'
+    return [
+        ('get_user', [client_id]),
+        ('reservations_version', []),
+        ('day_occupancy', ['facility1', reservation_date, 'on', 'hold']),
+        ('reserve_ids', [1, 'reservations']),
+        ('add_reservation', [RESERVATIONS + 1 + i, 'facility1', 0, reservation_date, 'workshop',
+            client_id, 9 + i % 8, 10 + i % 8, 'on']),
+        ('add_to_balance', [-100, client_id]),
+        ('add_transaction', [f'{RESERVATIONS + 1 + i}-t1', 'payment', 100, '2022-01-01 10:00:00',
+            client_id, RESERVATIONS + 1 + i]),
+    ]
+
+
+def inline(query, parameters):
+    '''
+    Pastes the parameters into the SQL text, as the f-string queries did
+    '''
+    for value in parameters:
+        literal = "'" + value.replace("'", "''") + "'" if isinstance(value, str) else str(value)
+        query = query.replace('?', literal, 1)
+    return query
+
+
+def run_bookings(conn, bound):
+    '''
+    Runs the statements of every booking in a transaction that is rolled
+    back, so each booking sees the same database
+    '''
+    for i in range(BOOKINGS):
+        conn.execute("BEGIN IMMEDIATE")
+        for name, parameters in booking_statements(i):
+            if bound:
+                conn.execute(QUERIES[name], parameters).fetchall()
+            else:
+                conn.execute(inline(QUERIES[name], parameters)).fetchall()
+        conn.rollback()
+
+
+def time_bookings(database_file, bound, cached_statements):
+    '''
+    Returns the time of BOOKINGS bookings on a new connection, in seconds
+    '''
+    conn = sqlite3.connect(database_file, cached_statements=cached_statements)
+    conn.row_factory = sqlite3.Row
+    apply_pragmas(conn)
+    try:
+        start = time.perf_counter()
+        run_bookings(conn, bound)
+        return time.perf_counter() - start
+    finally:
+        conn.close()
+
+
+def main():
+    with tempfile.TemporaryDirectory() as directory:
+        database_file = os.path.join(directory, 'bench_statements.db')
+        create_database(database_file, RESERVATIONS)
+        conn = sqlite3.connect(database_file)
+        conn.executemany(QUERIES['add_user'], ([f'client{i}', 'client', 10000, 'yes', b'', b'']
+            for i in range(50)))
+        conn.commit()
+        conn.close()
+
+        print(f"{'statements':<28} {'total (s)':>10} {'us/booking':>11}")
+        for label, bound, cached_statements in [
+                ('values in SQL text', False, database_helpers.DB_STATEMENT_CACHE),
+                ('bound, no statement cache', True, 0),
+                ('bound, statement cache', True, database_helpers.DB_STATEMENT_CACHE)]:
+            total = min(time_bookings(database_file, bound, cached_statements) for _ in range(3))
+            print(f"{label:<28} {total:>10.3f} {total / BOOKINGS * 1e6:>11.1f}")
+
+
+if __name__ == '__main__':
+    sys.exit(main())
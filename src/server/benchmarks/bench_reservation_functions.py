@@ -0,0 +1,241 @@
+# Benchmarks of the hot paths of reservation_functions.py and user_functions.py:
+# every function is timed with timeit against generated databases of growing
+# size, and the results are saved as JSON so runs of different commits can
+# be compared (--compare)
+#
+# Fabrizio Giovannini Filho, Yuxin Guan, Lynnette Jiang, Jared McKeon, Fandi Meng
+#
+# Execution (from src/server):
+#     python -m benchmarks.bench_reservation_functions [--sizes 1000 100000 1000000]
+#         [--only make_reservation ...] [--output FILE] [--compare OLD_FILE]
+
+import argparse, json, os, platform, random, sqlite3, subprocess, sys, tempfile, time, timeit
+from datetime import date, timedelta
+from types import SimpleNamespace
+from fastapi import HTTPException
+import database.database_helpers as database_helpers
+from database.database_queries import QUERIES
+from database.database_occupancy import OCCUPANCY_INDEX, RESOURCES
+from database.database_sequences import RESERVATION_IDS
+import helpers.reservation_functions as reservation_functions
+import helpers.user_functions as user_functions
+
+SIZES = [1000, 100000, 1000000]
+FACILITIES = ['facility1', 'facility2']
+CLIENTS = 100
+# Reservations of the generated databases are spread over this many days
+FIRST_DAY = date(2022, 1, 1)
+DAYS = 1000
+PASSWORD = 'benchpw'
+RESULTS_DIRECTORY = os.path.join(os.path.dirname(__file__), 'results')
+
+
+def create_database(database_file, size, seed=0):
+    '''
+    Creates a database with `size` reservations (mostly booked, some
+    cancelled or held) over DAYS days, a payment for every booking and
+    CLIENTS clients with a large balance
+    '''
+    rng = random.Random(seed)
+
+    def reservations():
+        for reservation_id in range(1, size + 1):
+            start_time = 9 + rng.randrange(16) / 2
+            status = rng.choices(['on', 'off', 'hold'], [90, 5, 5])[0]
+            yield [reservation_id, rng.choice(FACILITIES), 0,
+                (FIRST_DAY + timedelta(days=rng.randrange(DAYS))).isoformat(), rng.choice(RESOURCES),
+                f'client{rng.randrange(CLIENTS)}', start_time, min(start_time + rng.choice([0.5, 1, 2]), 18),
+                status]
+
+    conn = sqlite3.connect(database_file)
+    conn.executescript(open(database_helpers.CREATE_DB_FILE, 'r').read())
+    conn.executemany(QUERIES['add_reservation'], reservations())
+    conn.execute("INSERT INTO transactions SELECT reservation_id || '-t1', 'payment', 100, "
+        "reservation_date || ' 08:00:00', client_id, reservation_id FROM reservations WHERE status = 'on'")
+    salt, hashed = database_helpers.generate_hash(PASSWORD)
+    conn.executemany(QUERIES['add_user'], ([f'client{i}', 'client', 10 ** 9, 'yes', salt, hashed]
+        for i in range(CLIENTS)))
+    conn.commit()
+    database_helpers.update_db_schema(conn)
+    conn.close()
+
+
+class Calls:
+    '''
+    Gives the arguments of one call after the other, so a benchmark can
+    use new arguments (e.g. a new booking) on every call
+    '''
+
+    def __init__(self, arguments):
+        self.arguments = iter(arguments)
+
+    def __call__(self, function):
+        return lambda: function(*next(self.arguments))
+
+
+def ignore_rejections(function):
+    '''
+    Calls function, counting a rejected request (HTTPException) as done
+    '''
+    def call(*arguments):
+        try:
+            return function(*arguments)
+        except HTTPException:
+            return None
+    return call
+
+
+def booking_request(i):
+    '''
+    A reservation request for a free window (on a day after the generated data)
+    '''
+    day = FIRST_DAY + timedelta(days=DAYS + 1 + i // 8)
+    return SimpleNamespace(facility=FACILITIES[i % 2], user_id=f'client{i % CLIENTS}',
+        reservation_item=RESOURCES[i % len(RESOURCES)], reservation_client_id=f'client{i % CLIENTS}',
+        reservation_date=day.isoformat(), reservation_time=9 + i % 8, duration=1)
+
+
+def benchmarks(rng):
+    '''
+    Returns {name: (number of calls, function to set up the calls)}. The
+    set-up function gets the number of calls and returns a callable timed by
+    timeit (called once per call).
+    '''
+    def random_day():
+        return FIRST_DAY + timedelta(days=rng.randrange(DAYS))
+
+    def calculate_booking_costs(calls):
+        return Calls([random_day(), rng.choice(RESOURCES), rng.choice([0.5, 1, 2])]
+            for _ in range(calls))(reservation_functions.calculate_booking_costs)
+
+    def check_machine_availability(calls):
+        return Calls([random_day().isoformat(), 9 + rng.randrange(16) / 2, rng.choice(RESOURCES), 1,
+            rng.choice(FACILITIES)] for _ in range(calls))(ignore_rejections(
+            reservation_functions.check_machine_availability))
+
+    def make_reservation(calls):
+        start = rng.randrange(10 ** 6)
+        return Calls([booking_request(start + i)] for i in range(calls))(reservation_functions.make_reservation)
+
+    def cancel_reservation(calls):
+        # Bookings to cancel, made before timing starts
+        start = rng.randrange(10 ** 6)
+        reservation_ids = [reservation_functions.make_reservation(booking_request(start + i))['reservation_id']
+            for i in range(calls)]
+        return Calls([reservation_id] for reservation_id in reservation_ids)(reservation_functions.cancel_reservation)
+
+    def view_reservations(calls):
+        def arguments():
+            day = random_day()
+            return [day.isoformat(), (day + timedelta(days=7)).isoformat(), rng.choice(FACILITIES), None]
+        return Calls(arguments() for _ in range(calls))(reservation_functions.view_reservations)
+
+    def view_all_transactions(calls):
+        return Calls([] for _ in range(calls))(reservation_functions.view_all_transactions)
+
+    def validate_user(calls):
+        return Calls([f'client{rng.randrange(CLIENTS)}', PASSWORD, True]
+            for _ in range(calls))(user_functions.validate_user)
+
+    return {
+        'calculate_booking_costs': (10000, calculate_booking_costs),
+        'check_machine_availability': (2000, check_machine_availability),
+        'make_reservation': (200, make_reservation),
+        'cancel_reservation': (200, cancel_reservation),
+        'view_reservations': (20, view_reservations),
+        'view_all_transactions': (1, view_all_transactions),
+        'validate_user': (5, validate_user),
+    }
+
+
+def run_benchmark(calls, set_up, repeat):
+    '''
+    Returns the best time per call of `repeat` runs of `calls` calls, in seconds
+    '''
+    times = []
+    for _ in range(repeat):
+        timer = timeit.Timer(set_up(calls))
+        times.append(timer.timeit(number=calls) / calls)
+    return min(times)
+
+
+def use_database(database_file):
+    '''
+    Makes the db_* functions use a database file. Returns the pool used before.
+    '''
+    OCCUPANCY_INDEX.clear()
+    RESERVATION_IDS.reset()
+    return database_helpers.set_db_pool(database_helpers.create_db_pool(database_file))
+
+
+def get_commit():
+    '''
+    Returns the current git commit, or None outside of a git checkout
+    '''
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+            check=True, cwd=os.path.dirname(__file__)).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, old_results):
+    '''
+    Prints the time per call of every benchmark relative to an older run
+    '''
+    print(f"\n{'size':>8} {'benchmark':<28} {'old (us)':>12} {'new (us)':>12} {'new/old':>8}")
+    for size, sized_results in results['results'].items():
+        for name, result in sized_results.items():
+            old = old_results['results'].get(size, {}).get(name)
+            if old:
+                print(f"{size:>8} {name:<28} {old['seconds_per_call'] * 1e6:>12.1f} "
+                    f"{result['seconds_per_call'] * 1e6:>12.1f} {result['seconds_per_call'] / old['seconds_per_call']:>8.2f}")
+
+
+def main(arguments=None):
+    parser = argparse.ArgumentParser(prog='python -m benchmarks.bench_reservation_functions',
+        description='Time the hot paths of the reservation functions on generated databases.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=SIZES, help='reservations in the databases')
+    parser.add_argument('--only', nargs='+', help='benchmarks to run (default: all)')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help=f'JSON file for the results (default: {RESULTS_DIRECTORY}/<commit>.json)')
+    parser.add_argument('--compare', help='JSON results of an older run to compare with')
+    arguments = parser.parse_args(arguments)
+
+    commit = get_commit()
+    results = {'commit': commit, 'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'python': platform.python_version(),
+        'sqlite': sqlite3.sqlite_version, 'repeat': arguments.repeat, 'results': {}}
+
+    print(f"{'size':>8} {'benchmark':<28} {'calls':>6} {'us/call':>12}")
+    with tempfile.TemporaryDirectory() as directory:
+        for size in arguments.sizes:
+            database_file = os.path.join(directory, f'bench_{size}.db')
+            create_database(database_file, size, arguments.seed)
+            previous_pool = use_database(database_file)
+            results['results'][str(size)] = {}
+            try:
+                for name, (calls, set_up) in benchmarks(random.Random(arguments.seed)).items():
+                    if arguments.only and name not in arguments.only:
+                        continue
+                    seconds = run_benchmark(calls, set_up, arguments.repeat)
+                    results['results'][str(size)][name] = {'calls': calls, 'seconds_per_call': seconds}
+                    print(f"{size:>8} {name:<28} {calls:>6} {seconds * 1e6:>12.1f}")
+            finally:
+                database_helpers.set_db_pool(previous_pool).close_all()
+                OCCUPANCY_INDEX.clear()
+                RESERVATION_IDS.reset()
+
+    output = arguments.output or os.path.join(RESULTS_DIRECTORY, f"{commit or 'results'}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as results_file:
+        json.dump(results, results_file, indent=2)
+    print(f"Results saved to {output}")
+
+    if arguments.compare:
+        with open(arguments.compare) as old_file:
+            compare(results, json.load(old_file))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,77 @@
+# Benchmark of the transaction reports (view_all_transactions):
+# one lookup per transaction versus one joined query, for growing numbers
+# of transactions on a generated database
+#
+# Fabrizio Giovannini Filho, Yuxin Guan, Lynnette Jiang, Jared McKeon, Fandi Meng
+#
+# Execution (from src/server): python -m benchmarks.bench_transaction_report
+
+import os, sqlite3, sys, tempfile, time
+import database.database_helpers as database_helpers
+import database.database_reservations as database_reservations
+import helpers.reservation_functions as reservation_functions
+
+SIZES = [1000, 5000, 20000]
+RESOURCES = ['workshop', 'microvac', 'irradiator', 'extruder', 'crusher', 'harvester']
+
+
+def create_database(database_file, size):
+    '''
+    Creates a database with `size` reservations, each paid by one transaction
+    '''
+    conn = sqlite3.connect(database_file)
+    conn.executescript(open(database_helpers.CREATE_DB_FILE, 'r').read())
+    conn.executemany("INSERT INTO reservations VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+        ([i, 'facility1', 0, f'2022-{i % 12 + 1:02d}-{i % 28 + 1:02d}', RESOURCES[i % len(RESOURCES)],
+          f'client{i % 50}', 9 + i % 8, 10 + i % 8, 'on'] for i in range(1, size + 1)))
+    conn.executemany("INSERT INTO transactions VALUES (?, ?, ?, ?, ?, ?)",
+        ([f'{i}-t1', 'payment', 100, '2022-01-01 10:00:00', f'scheduler{i % 5}', i] for i in range(1, size + 1)))
+    conn.commit()
+    database_helpers.update_db_schema(conn)
+    conn.close()
+
+
+def report_with_lookups():
+    '''
+    The report as built before: one reservation lookup per transaction
+    '''
+    report = "All transactions: \n"
+    for transaction in database_reservations.db_print_all_transactions():
+        reservation = database_reservations.db_get_reservations_for_id(transaction['reservation_id'])
+        if transaction['transaction_type'] == 'payment':
+            report += reservation_functions.create_report(reservation)
+        report += f'- {transaction["transaction_type"].capitalize()}: {transaction["transaction_amount"]}\n'
+    return {'data': report}
+
+
+def best_time(function, repeat=3):
+    '''
+    Returns the fastest of `repeat` runs of function, in seconds
+    '''
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def main():
+    print(f"{'transactions':>12} {'lookups (s)':>12} {'joined (s)':>11} {'joined us/row':>14}")
+    with tempfile.TemporaryDirectory() as directory:
+        for size in SIZES:
+            database_file = os.path.join(directory, f'bench_{size}.db')
+            create_database(database_file, size)
+            previous_pool = database_helpers.set_db_pool(database_helpers.create_db_pool(database_file))
+            try:
+                # Both ways must build the same report
+                assert report_with_lookups() == reservation_functions.view_all_transactions()
+                lookups = best_time(report_with_lookups)
+                joined = best_time(reservation_functions.view_all_transactions)
+            finally:
+                database_helpers.set_db_pool(previous_pool).close_all()
+            print(f"{size:>12} {lookups:>12.3f} {joined:>11.3f} {joined / size * 1e6:>14.1f}")
+
+
+if __name__ == '__main__':
+    sys.exit(main())
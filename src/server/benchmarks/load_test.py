@@ -0,0 +1,271 @@
+# Load test of a running server (server.py):
+# virtual users replay a mix of sign-ins, bookings, holds, report reads and
+# balance checks for a fixed time, then the throughput and latency
+# percentiles of every kind of request are reported and the database is
+# checked for double bookings (more machines booked in a slot than exist)
+#
+# Fabrizio Giovannini Filho, Yuxin Guan, Lynnette Jiang, Jared McKeon, Fandi Meng
+#
+# Execution (from src/server, with the server running):
+#     python -m benchmarks.load_test [--users 20] [--duration 30] [--url http://127.0.0.1:8000]
+# The database is saved to a snapshot before the run and restored after it
+# (unless --keep-data), so the load test leaves no reservations behind.
+
+import argparse, json, os, random, sys, threading, time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, timedelta
+import requests
+import database.database_helpers as database_helpers
+import database.database_backups as database_backups
+from database.database_occupancy import (DayOccupancy, RESERVATION_CONSTRAINTS, RESOURCES, SLOTS_PER_DAY,
+    ACTIVE_STATUSES)
+
+# Share of each kind of request in the workload
+WORKLOAD = {
+    'sign_in': 0.10,
+    'book': 0.30,
+    'read_reservations': 0.30,
+    'hold': 0.10,
+    'balance': 0.20,
+}
+FACILITIES = ['facility1', 'facility2']
+# Bookings are spread over this many days from tomorrow
+BOOKING_DAYS = 5
+PASSWORD = 'loadtestpw'
+PERCENTILES = [50, 90, 95, 99]
+
+
+class Recorder:
+    '''
+    Latencies and outcomes of the requests of every kind, from all threads
+    '''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latencies = defaultdict(list)
+        self.outcomes = defaultdict(lambda: defaultdict(int))
+
+    def record(self, kind, latency, outcome):
+        with self._lock:
+            self.latencies[kind].append(latency)
+            self.outcomes[kind][outcome] += 1
+
+
+def percentile(values, p):
+    '''
+    Returns the p-th percentile of sorted values (nearest rank)
+    '''
+    if not values:
+        return None
+    return values[min(len(values) - 1, max(0, int(round(p / 100 * len(values))) - 1))]
+
+
+def booking_window(rng):
+    '''
+    Returns a random facility, date, machine, start time and duration
+    '''
+    start = 9 + rng.randrange(16) / 2
+    duration = min(rng.choice([0.5, 0.5, 1, 1.5, 2]), 18 - start)
+    day = date.today() + timedelta(days=rng.randint(1, BOOKING_DAYS))
+    return rng.choice(FACILITIES), day.isoformat(), rng.choice(RESOURCES), start, duration
+
+
+class VirtualUser:
+    '''
+    A client that signs in and then sends requests of the workload mix
+    until `deadline`
+    '''
+
+    def __init__(self, url, user_id, recorder, seed):
+        self.url = url
+        self.user_id = user_id
+        self.recorder = recorder
+        self.rng = random.Random(seed)
+        self.session = requests.Session()
+
+    def request(self, kind, method, path, **kwargs):
+        start = time.perf_counter()
+        try:
+            response = self.session.request(method, self.url + path, timeout=60, **kwargs)
+            status = response.status_code
+        except requests.RequestException:
+            response, status = None, 'error'
+        latency = time.perf_counter() - start
+
+        if status == 'error' or status >= 500:
+            outcome = 'error'
+        elif status >= 400:
+            # e.g. machine already booked or balance too low
+            outcome = 'rejected'
+        else:
+            outcome = 'ok'
+        self.recorder.record(kind, latency, outcome)
+        return response
+
+    def sign_in(self):
+        # Password check (PBKDF2) and a session token for the next requests
+        response = self.request('sign_in', 'POST', '/login',
+            json={'user_id': self.user_id, 'password': PASSWORD})
+        if response is not None and response.status_code == 200:
+            self.session.headers['Authorization'] = 'Bearer ' + response.json()['token']
+
+    def book(self):
+        facility, day, resource, start, duration = booking_window(self.rng)
+        self.request('book', 'POST', '/reservations', json={'facility': facility, 'user_id': self.user_id,
+            'reservation_item': resource, 'reservation_client_id': self.user_id, 'reservation_date': day,
+            'reservation_time': start, 'duration': duration})
+
+    def hold(self):
+        facility, day, resource, start, duration = booking_window(self.rng)
+        self.request('hold', 'POST', '/holds', json={'facility': facility, 'user_id': self.user_id,
+            'hold_item': resource, 'hold_client_id': self.user_id, 'hold_date': day,
+            'hold_time': start, 'duration': duration})
+
+    def read_reservations(self):
+        start = date.today() + timedelta(days=self.rng.randint(0, BOOKING_DAYS))
+        self.request('read_reservations', 'GET', '/reservations', params={'start_date': start.isoformat(),
+            'end_date': (start + timedelta(days=7)).isoformat(), 'facility': self.rng.choice(FACILITIES)})
+
+    def balance(self):
+        self.request('balance', 'GET', '/balance', params={'user_id': self.user_id})
+
+    def run(self, deadline, think_time):
+        self.sign_in()
+        kinds, weights = list(WORKLOAD), list(WORKLOAD.values())
+        while time.perf_counter() < deadline:
+            getattr(self, self.rng.choices(kinds, weights)[0])()
+            if think_time:
+                time.sleep(self.rng.expovariate(1 / think_time))
+
+
+def set_up_users(url, users, admin_id, admin_password):
+    '''
+    Adds the load test clients (loadtest0, loadtest1, ...) with enough
+    balance for every booking they may make. Returns their IDs.
+    '''
+    session = requests.Session()
+    response = session.post(url + '/login', json={'user_id': admin_id, 'password': admin_password})
+    response.raise_for_status()
+    session.headers['Authorization'] = 'Bearer ' + response.json()['token']
+
+    user_ids = [f'loadtest{i}' for i in range(users)]
+    for user_id in user_ids:
+        session.post(url + '/users', json={'user_id': user_id, 'password': PASSWORD, 'role': 'client'})
+        session.get(url + '/balance', params={'user_id': user_id, 'amount': 10 ** 9}).raise_for_status()
+    return user_ids
+
+
+def find_double_bookings():
+    '''
+    Function to check that no half-hour slot has more machines booked or
+    held than exist. Returns (facility, date, resource, slot, units in use)
+    for every slot over capacity.
+    '''
+    days = defaultdict(DayOccupancy)
+    for row in database_helpers.db_iterate('active_reservations', ACTIVE_STATUSES):
+        days[(row['facility'], row['reservation_date'])].add(row['resource'], row['start_time'], row['end_time'])
+
+    double_bookings = []
+    for (facility, reservation_date), day in days.items():
+        for r, resource in enumerate(RESOURCES):
+            for slot in range(SLOTS_PER_DAY):
+                units = day.slots[r * SLOTS_PER_DAY + slot]
+                if units > RESERVATION_CONSTRAINTS[resource]:
+                    double_bookings.append((facility, reservation_date, resource, slot, units))
+    return double_bookings
+
+
+def summarize(recorder, elapsed):
+    '''
+    Returns the throughput, outcomes and latency percentiles (in ms) of
+    every kind of request and of all of them together
+    '''
+    summary = {'duration': elapsed, 'requests': {}}
+    everything = []
+    for kind in WORKLOAD:
+        latencies = sorted(recorder.latencies[kind])
+        everything += latencies
+        summary['requests'][kind] = {
+            'count': len(latencies),
+            'per_second': len(latencies) / elapsed,
+            'outcomes': dict(recorder.outcomes[kind]),
+            'latency_ms': {f'p{p}': (percentile(latencies, p) or 0) * 1000 for p in PERCENTILES},
+        }
+        summary['requests'][kind]['latency_ms']['max'] = (latencies[-1] if latencies else 0) * 1000
+    everything.sort()
+    summary['total'] = {
+        'count': len(everything),
+        'per_second': len(everything) / elapsed,
+        'bookings_per_second': recorder.outcomes['book']['ok'] / elapsed,
+        'latency_ms': {f'p{p}': (percentile(everything, p) or 0) * 1000 for p in PERCENTILES},
+    }
+    return summary
+
+
+def print_summary(summary):
+    print(f"{'request':<18} {'count':>7} {'req/s':>8} {'ok':>6} {'rejected':>9} {'errors':>7} "
+        + ' '.join(f"{'p' + str(p) + ' ms':>9}" for p in PERCENTILES))
+    for kind, stats in summary['requests'].items():
+        outcomes = stats['outcomes']
+        print(f"{kind:<18} {stats['count']:>7} {stats['per_second']:>8.1f} {outcomes.get('ok', 0):>6} "
+            f"{outcomes.get('rejected', 0):>9} {outcomes.get('error', 0):>7} "
+            + ' '.join(f"{stats['latency_ms'][f'p{p}']:>9.1f}" for p in PERCENTILES))
+    total = summary['total']
+    print(f"{'all':<18} {total['count']:>7} {total['per_second']:>8.1f} {'':>6} {'':>9} {'':>7} "
+        + ' '.join(f"{total['latency_ms'][f'p{p}']:>9.1f}" for p in PERCENTILES))
+    print(f"Successful bookings per second: {total['bookings_per_second']:.1f}")
+
+
+def main(arguments=None):
+    parser = argparse.ArgumentParser(prog='python -m benchmarks.load_test',
+        description='Load test a running reservations server.')
+    parser.add_argument('--url', default='http://127.0.0.1:8000')
+    parser.add_argument('--users', type=int, default=20, help='virtual users sending requests at once')
+    parser.add_argument('--duration', type=float, default=30, help='seconds of load')
+    parser.add_argument('--think-time', type=float, default=0,
+        help='mean seconds a virtual user waits between requests')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--admin', default='admin1')
+    parser.add_argument('--admin-password', default='admin1password')
+    parser.add_argument('--json', help='also write the results to this JSON file')
+    parser.add_argument('--keep-data', action='store_true',
+        help='keep the reservations made instead of restoring the database afterwards')
+    arguments = parser.parse_args(arguments)
+
+    # The server and this script use the same database file
+    snapshot = None if arguments.keep_data else database_backups.take_snapshot(database_helpers.DATABASE_FILE)
+    try:
+        user_ids = set_up_users(arguments.url, arguments.users, arguments.admin, arguments.admin_password)
+        recorder = Recorder()
+        virtual_users = [VirtualUser(arguments.url, user_id, recorder, arguments.seed * 1000 + i)
+            for i, user_id in enumerate(user_ids)]
+
+        start = time.perf_counter()
+        deadline = start + arguments.duration
+        with ThreadPoolExecutor(len(virtual_users)) as executor:
+            for future in [executor.submit(user.run, deadline, arguments.think_time) for user in virtual_users]:
+                future.result()
+        summary = summarize(recorder, time.perf_counter() - start)
+        summary['double_bookings'] = find_double_bookings()
+    finally:
+        if snapshot:
+            database_backups.restore_snapshot(snapshot, database_helpers.DATABASE_FILE)
+            os.remove(snapshot)
+
+    print_summary(summary)
+    if arguments.json:
+        with open(arguments.json, 'w') as results_file:
+            json.dump(summary, results_file, indent=2)
+
+    if summary['double_bookings']:
+        print(f"DOUBLE BOOKINGS: {len(summary['double_bookings'])} slots over capacity")
+        for double_booking in summary['double_bookings'][:20]:
+            print('   ', *double_booking)
+        return 1
+    print("No double bookings.")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
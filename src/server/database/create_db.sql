@@ -2,6 +2,9 @@
 DROP TABLE IF EXISTS reservations;
 DROP TABLE IF EXISTS users;
 DROP TABLE IF EXISTS transactions;
+DROP TABLE IF EXISTS reservations_version;
+DROP TABLE IF EXISTS id_sequences;
+DROP TABLE IF EXISTS schema_version;
 
 
 -- Create reservations table with data for reservations
@@ -0,0 +1,238 @@
+# Online backups of the SQLite database:
+# snapshots are copied with the SQLite backup API a few pages at a time, so
+# bookings keep going while a backup runs, and can be taken on a schedule
+# (keeping the newest few) and restored into the live database
+#
+# Fabrizio Giovannini Filho, Yuxin Guan, Lynnette Jiang, Jared McKeon, Fandi Meng
+#
+# Execution (from src/server):
+#     python -m database.database_backups backup [--directory DIRECTORY]
+#     python -m database.database_backups list [--directory DIRECTORY]
+#     python -m database.database_backups restore SNAPSHOT
+
+import argparse, os, sqlite3, sys, threading, time
+from datetime import datetime
+
+# Pages copied per step of a backup (-1 copies everything in one step) and
+# seconds to wait between steps, so writers get the database in between
+BACKUP_PAGES = int(os.environ.get('RESERVATIONS_BACKUP_PAGES', 256))
+BACKUP_SLEEP = float(os.environ.get('RESERVATIONS_BACKUP_SLEEP', 0.005))
+
+# Scheduled snapshots: folder, seconds between snapshots (0 to turn them
+# off) and number of snapshots kept
+BACKUP_DIRECTORY = os.environ.get('RESERVATIONS_BACKUP_DIRECTORY',
+    os.path.join(os.path.dirname(__file__), '../../../data/backups'))
+BACKUP_INTERVAL = float(os.environ.get('RESERVATIONS_BACKUP_INTERVAL', 0))
+BACKUP_RETENTION = int(os.environ.get('RESERVATIONS_BACKUP_RETENTION', 24))
+
+SNAPSHOT_PREFIX = 'reservations-'
+SNAPSHOT_SUFFIX = '.db'
+
+
+def backup_database(source_file, destination_file, pages=BACKUP_PAGES, sleep=BACKUP_SLEEP,
+    journal_mode=None, timeout=30):
+    '''
+    Copies a database with the SQLite backup API, `pages` pages at a time.
+    The source is only locked while a step runs; if another connection
+    writes to it in between, SQLite starts the copy over, so the result is
+    always a consistent snapshot. Changes still in the write-ahead log are
+    included and connections to the destination see the new content.
+    `journal_mode` (e.g. DELETE for a standalone copy) is set on the
+    destination afterwards. Returns the number of pages copied.
+    '''
+    copied = [0]
+
+    def progress(status, remaining, total):
+        copied[0] = total
+
+    source = sqlite3.connect(source_file, timeout=timeout)
+    destination = sqlite3.connect(destination_file, timeout=timeout)
+    try:
+        source.backup(destination, pages=pages, progress=progress, sleep=sleep)
+        if journal_mode:
+            destination.execute(f"PRAGMA journal_mode = {journal_mode}").fetchall()
+    finally:
+        source.close()
+        destination.close()
+    return copied[0]
+
+
+def check_database(database_file):
+    '''
+    Returns True if a database file passes SQLite's quick integrity check
+    '''
+    try:
+        conn = sqlite3.connect(f'file:{database_file}?mode=ro', uri=True)
+        try:
+            return conn.execute("PRAGMA quick_check").fetchone()[0] == 'ok'
+        finally:
+            conn.close()
+    except sqlite3.Error:
+        return False
+
+
+def list_snapshots(directory=BACKUP_DIRECTORY):
+    '''
+    Returns the paths of the snapshots in a folder, oldest first
+    '''
+    if not os.path.isdir(directory):
+        return []
+    return [os.path.join(directory, file_name) for file_name in sorted(os.listdir(directory))
+        if file_name.startswith(SNAPSHOT_PREFIX) and file_name.endswith(SNAPSHOT_SUFFIX)]
+
+
+def prune_snapshots(directory=BACKUP_DIRECTORY, retention=BACKUP_RETENTION):
+    '''
+    Deletes all but the newest `retention` snapshots. Returns the paths deleted.
+    '''
+    snapshots = list_snapshots(directory)
+    removed = snapshots[:max(len(snapshots) - retention, 0)]
+    for path in removed:
+        os.remove(path)
+    return removed
+
+
+def take_snapshot(database_file, directory=BACKUP_DIRECTORY, pages=BACKUP_PAGES, sleep=BACKUP_SLEEP):
+    '''
+    Writes a snapshot of a live database to `directory`, named after the
+    time it was taken. The copy is made under a temporary name and renamed
+    once complete, so a snapshot file is never partly written. Returns its path.
+    '''
+    os.makedirs(directory, exist_ok=True)
+    name = SNAPSHOT_PREFIX + datetime.now().strftime('%Y%m%d-%H%M%S-%f') + SNAPSHOT_SUFFIX
+    path = os.path.join(directory, name)
+    temporary_path = path + '.tmp'
+    try:
+        backup_database(database_file, temporary_path, pages, sleep, journal_mode='DELETE')
+        os.replace(temporary_path, path)
+    finally:
+        if os.path.exists(temporary_path):
+            os.remove(temporary_path)
+    return path
+
+
+def restore_snapshot(snapshot_file, database_file):
+    '''
+    Copies a snapshot into the live database with the backup API, in one
+    step so no request sees a half-restored database. Open connections keep
+    working and see the restored content. The snapshot is checked first.
+    '''
+    if not check_database(snapshot_file):
+        raise ValueError(f"{snapshot_file} is not a valid database snapshot.")
+    return backup_database(snapshot_file, database_file, pages=-1)
+
+
+class BackupScheduler:
+    '''
+    Background thread that takes a snapshot of `database_file` every
+    `interval` seconds and keeps the newest `retention` snapshots
+    '''
+
+    def __init__(self, database_file, directory=BACKUP_DIRECTORY, interval=BACKUP_INTERVAL,
+        retention=BACKUP_RETENTION):
+        self.database_file = database_file
+        self.directory = directory
+        self.interval = interval
+        self.retention = retention
+        self._stop = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+        self._stats = {'snapshots': 0, 'errors': 0, 'last_snapshot': None,
+            'last_duration': None, 'last_error': None}
+
+    def snapshot(self):
+        '''
+        Takes one snapshot and prunes the old ones. Returns its path, or None
+        if it failed.
+        '''
+        start = time.perf_counter()
+        try:
+            path = take_snapshot(self.database_file, self.directory)
+            prune_snapshots(self.directory, self.retention)
+        except (sqlite3.Error, OSError) as error:
+            with self._lock:
+                self._stats['errors'] += 1
+                self._stats['last_error'] = str(error)
+            return None
+
+        with self._lock:
+            self._stats['snapshots'] += 1
+            self._stats['last_snapshot'] = path
+            self._stats['last_duration'] = time.perf_counter() - start
+        return path
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.snapshot()
+
+    def start(self):
+        '''
+        Starts the background thread (does nothing if the interval is 0 or
+        it is already running)
+        '''
+        if self.interval <= 0 or (self._thread and self._thread.is_alive()):
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='db-backup', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        '''
+        Stops the background thread
+        '''
+        if self._thread:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+
+    def stats(self):
+        '''
+        Returns the number of snapshots and errors and the last snapshot
+        '''
+        with self._lock:
+            stats = dict(self._stats)
+        stats['running'] = bool(self._thread and self._thread.is_alive())
+        stats['interval'] = self.interval
+        stats['retention'] = self.retention
+        stats['directory'] = os.path.abspath(self.directory)
+        return stats
+
+
+def main(arguments=None):
+    # The live database and its migrations
+    import database.database_helpers as database_helpers
+
+    parser = argparse.ArgumentParser(prog='python -m database.database_backups',
+        description='Online backups of the reservations database.')
+    commands = parser.add_subparsers(dest='command', required=True)
+    backup = commands.add_parser('backup', help='take a snapshot of the live database')
+    backup.add_argument('--directory', default=BACKUP_DIRECTORY)
+    backup.add_argument('--retention', type=int, default=BACKUP_RETENTION)
+    listing = commands.add_parser('list', help='list the snapshots, oldest first')
+    listing.add_argument('--directory', default=BACKUP_DIRECTORY)
+    restore = commands.add_parser('restore', help='restore a snapshot into the live database')
+    restore.add_argument('snapshot')
+    restore.add_argument('--directory', default=BACKUP_DIRECTORY,
+        help='where the snapshot of the current database is kept before restoring')
+    restore.add_argument('--no-snapshot', action='store_true',
+        help='do not take a snapshot of the current database first')
+    arguments = parser.parse_args(arguments)
+
+    if arguments.command == 'backup':
+        path = take_snapshot(database_helpers.DATABASE_FILE, arguments.directory)
+        prune_snapshots(arguments.directory, arguments.retention)
+        print(path)
+    elif arguments.command == 'list':
+        for path in list_snapshots(arguments.directory):
+            print(f"{path} {os.path.getsize(path)}")
+    else:
+        if not arguments.no_snapshot:
+            print(f"Current database saved to {take_snapshot(database_helpers.DATABASE_FILE, arguments.directory)}")
+        restore_snapshot(arguments.snapshot, database_helpers.DATABASE_FILE)
+        # The snapshot may be older than the schema
+        database_helpers.db_migrate()
+        print(f"Restored {arguments.snapshot}")
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,239 @@
+# Bulk import and export of the reservations, transactions and users tables:
+# CSV or NDJSON (one JSON object per line) files of any size are streamed
+# into the live database in batches, each batch in its own transaction, and
+# rows with an existing key are updated (upsert). Exports stream the rows of
+# a table out the same way.
+#
+# Fabrizio Giovannini Filho, Yuxin Guan, Lynnette Jiang, Jared McKeon, Fandi Meng
+#
+# Execution (from src/server):
+#     python -m database.database_bulk import TABLE FILE [--batch-size N] [--workers N]
+#     python -m database.database_bulk export TABLE FILE
+# FILE is a .csv, .ndjson or .jsonl file (or --format), '-' for stdin/stdout.
+# An import stops at the first bad row; the batches before it stay imported.
+
+import argparse, csv, json, sys, time
+from concurrent.futures import ProcessPoolExecutor
+from database.database_helpers import *
+
+# Columns of each table, in order, with the queries of QUERIES used to
+# upsert and export its rows. Users are imported with either their salt and
+# hash (hexadecimal, as exported) or a plain password to hash.
+TABLES = {
+    'reservations': {
+        'columns': ['reservation_id', 'facility', 'recurring_number', 'reservation_date', 'resource',
+            'client_id', 'start_time', 'end_time', 'status'],
+        'upsert': 'upsert_reservation',
+        'export': 'all_reservations'
+    },
+    'transactions': {
+        'columns': ['transaction_id', 'transaction_type', 'transaction_amount', 'transaction_timestamp',
+            'user_id', 'reservation_id'],
+        'upsert': 'upsert_transaction',
+        'export': 'all_transactions'
+    },
+    'users': {
+        'columns': ['user_id', 'role', 'balance', 'active', 'salt', 'hash'],
+        'upsert': 'upsert_user',
+        'export': 'all_users'
+    }
+}
+BINARY_COLUMNS = ('salt', 'hash')
+FILE_FORMATS = {'.csv': 'csv', '.ndjson': 'ndjson', '.jsonl': 'ndjson'}
+
+# Rows per transaction
+BULK_BATCH_SIZE = int(os.environ.get('RESERVATIONS_BULK_BATCH_SIZE', 1000))
+
+
+def get_file_format(path, file_format=None):
+    '''
+    Returns the format of a file: `file_format` if given, otherwise the one
+    of its extension
+    '''
+    if file_format:
+        return file_format
+    extension = os.path.splitext(path)[1].lower()
+    if extension not in FILE_FORMATS:
+        raise ValueError(f"Cannot tell the format of '{path}', use --format csv or ndjson.")
+    return FILE_FORMATS[extension]
+
+
+def read_rows(data_file, file_format):
+    '''
+    Yields the rows of an open CSV or NDJSON file as dicts, one at a time
+    '''
+    if file_format == 'csv':
+        yield from csv.DictReader(data_file)
+    else:
+        for line in data_file:
+            if line.strip():
+                yield json.loads(line)
+
+
+def row_values(table, row, number):
+    '''
+    Returns the values of a row in the column order of its table. Users
+    without a hash keep their plain password in place of the salt, to be
+    hashed by hash_passwords.
+    '''
+    columns = TABLES[table]['columns']
+    if table == 'users':
+        row = dict(row)
+        row.setdefault('balance', 0)
+        row.setdefault('active', 'yes')
+        if not row.get('hash'):
+            if 'password' not in row:
+                raise ValueError(f"Row {number}: users need a password or a salt and hash.")
+            row['salt'], row['hash'] = row['password'], None
+        else:
+            row['salt'], row['hash'] = bytes.fromhex(row['salt']), bytes.fromhex(row['hash'])
+
+    missing = [column for column in columns if column not in row]
+    if missing:
+        raise ValueError(f"Row {number}: missing {', '.join(missing)}.")
+    return [row[column] for column in columns]
+
+
+def hash_passwords(values, executor=None):
+    '''
+    Replaces the plain passwords of user rows (see row_values) by a salt and
+    hash, in the processes of `executor` if given
+    '''
+    to_hash = [i for i, row in enumerate(values) if row[5] is None]
+    # hash_user_row takes a users.csv row: user_id, role, balance, active, password
+    csv_rows = [values[i][:5] for i in to_hash]
+    hashed = executor.map(hash_user_row, csv_rows) if executor else map(hash_user_row, csv_rows)
+    for i, row in zip(to_hash, hashed):
+        values[i] = row
+    return values
+
+
+class Progress:
+    '''
+    Prints the number of rows done (and the rate) to stderr, at most every
+    `interval` seconds
+    '''
+
+    def __init__(self, action, table, interval=1, output=sys.stderr):
+        self.action = action
+        self.table = table
+        self.interval = interval
+        self.output = output
+        self.start = time.perf_counter()
+        self.printed = 0
+        self.rows = 0
+
+    def update(self, rows):
+        self.rows = rows
+        now = time.perf_counter()
+        if self.output and now - self.printed >= self.interval:
+            self.printed = now
+            self._print('\r')
+
+    def finish(self):
+        if self.output:
+            self._print('\r')
+            self.output.write('\n')
+
+    def _print(self, start):
+        elapsed = max(time.perf_counter() - self.start, 1e-9)
+        self.output.write(f"{start}{self.action} {self.rows} {self.table} ({self.rows / elapsed:.0f} rows/s)")
+        self.output.flush()
+
+
+def import_rows(table, rows, batch_size=BULK_BATCH_SIZE, workers=1, progress=None):
+    '''
+    Function to upsert rows (dicts of column values) into a table,
+    `batch_size` rows per transaction. Passwords of new users are hashed by
+    `workers` processes. Returns the number of rows imported.
+    '''
+    upsert = TABLES[table]['upsert']
+    executor = ProcessPoolExecutor(workers) if table == 'users' and workers > 1 else None
+    count = 0
+    try:
+        for batch in batches(rows, batch_size):
+            values = [row_values(table, row, count + i + 1) for i, row in enumerate(batch)]
+            if table == 'users':
+                values = hash_passwords(values, executor)
+
+            # Connect to database
+            with get_db_transaction() as cursor:
+                db_execute_many(cursor, upsert, values)
+
+            count += len(values)
+            if progress:
+                progress.update(count)
+    finally:
+        if executor:
+            executor.shutdown()
+    return count
+
+
+def export_rows(table, data_file, file_format, progress=None):
+    '''
+    Function to write every row of a table to an open file, as CSV or
+    NDJSON, while reading it. Returns the number of rows exported.
+    '''
+    columns = TABLES[table]['columns']
+    writer = csv.writer(data_file) if file_format == 'csv' else None
+    if writer:
+        writer.writerow(columns)
+
+    count = 0
+    for row in db_iterate(TABLES[table]['export']):
+        values = [row[column].hex() if column in BINARY_COLUMNS else row[column] for column in columns]
+        if writer:
+            writer.writerow(values)
+        else:
+            data_file.write(json.dumps(dict(zip(columns, values))) + '\n')
+        count += 1
+        if progress and count % BULK_BATCH_SIZE == 0:
+            progress.update(count)
+    if progress:
+        progress.update(count)
+    return count
+
+
+def main(arguments=None):
+    parser = argparse.ArgumentParser(prog='python -m database.database_bulk',
+        description='Stream CSV or NDJSON files into or out of the reservations database.')
+    parser.add_argument('command', choices=['import', 'export'])
+    parser.add_argument('table', choices=list(TABLES))
+    parser.add_argument('file', help="CSV or NDJSON file, '-' for stdin/stdout")
+    parser.add_argument('--format', choices=['csv', 'ndjson'])
+    parser.add_argument('--batch-size', type=int, default=BULK_BATCH_SIZE, help='rows per transaction')
+    parser.add_argument('--workers', type=int, default=HASH_WORKERS,
+        help='processes hashing user passwords (default: number of CPUs)')
+    parser.add_argument('--quiet', action='store_true', help='do not report progress')
+    arguments = parser.parse_args(arguments)
+
+    progress = Progress('imported' if arguments.command == 'import' else 'exported', arguments.table,
+        output=None if arguments.quiet else sys.stderr)
+    try:
+        file_format = get_file_format(arguments.file, arguments.format) if arguments.file != '-' \
+            else arguments.format or 'csv'
+
+        if arguments.command == 'import':
+            data_file = sys.stdin if arguments.file == '-' else open(arguments.file, newline='')
+            try:
+                import_rows(arguments.table, read_rows(data_file, file_format), arguments.batch_size,
+                    arguments.workers, progress)
+            finally:
+                if data_file is not sys.stdin:
+                    data_file.close()
+        else:
+            data_file = sys.stdout if arguments.file == '-' else open(arguments.file, 'w', newline='')
+            try:
+                export_rows(arguments.table, data_file, file_format, progress)
+            finally:
+                if data_file is not sys.stdout:
+                    data_file.close()
+    except (ValueError, OSError, sqlite3.Error) as error:
+        # Batches before the failing one stay imported
+        progress.finish()
+        parser.exit(1, f"Error: {error}\n")
+    progress.finish()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -2,7 +2,16 @@
 #
 # Fabrizio Giovannini Filho, Yuxin Guan, Lynnette Jiang, Jared McKeon, Fandi Meng
 
-import sqlite3, os, csv, shutil, hashlib
+import argparse, sqlite3, os, csv, hashlib, itertools, time
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from database.database_pool import ConnectionPool
+from database.database_queries import QUERIES
+from database.database_migrations import migrate_db
+from database.database_storage import apply_pragmas, get_pragmas, CheckpointScheduler
+from database.database_backups import backup_database, BackupScheduler
+from database.database_metrics import record_query, record_connection_opened, record_password_hashing
+from database.database_profiler import SQL_PROFILER
 
 DIRNAME = os.path.dirname(__file__)
 CREATE_DB_FILE = os.path.join(DIRNAME, 'create_db.sql')
@@ -14,85 +23,321 @@ DATABASE_FILE = os.path.join(DATA_DIRECTORY, 'reservations.db')
 BACKUP_DATABASE_FILE = os.path.join(DATA_DIRECTORY, 'reservations_backup.db')
 TEST_DATABASE_FILE = os.path.join(DATA_DIRECTORY, 'test_reservations.db')
 
+# Rows inserted at a time when loading data, and processes hashing the
+# passwords of loaded users (PBKDF2 takes most of the loading time)
+IMPORT_BATCH_SIZE = 500
+HASH_WORKERS = int(os.environ.get('RESERVATIONS_HASH_WORKERS', os.cpu_count() or 1))
+
+
+def update_db_schema(conn):
+    '''
+    Function to bring an existing database up to date with the current schema
+    by applying the migrations it is missing (see database_migrations.py).
+    Run on every new pooled connection; does nothing if the tables have not
+    been created yet.
+    '''
+    return migrate_db(conn)
+
+
+def configure_connection(conn):
+    '''
+    Function to prepare a new pooled connection: storage pragmas (WAL, ...,
+    see database_storage.py), the SQL profiler (database_profiler.py) and
+    pending migrations
+    '''
+    record_connection_opened()
+    SQL_PROFILER.install(conn)
+    apply_pragmas(conn)
+    update_db_schema(conn)
+
+
+# Pool of long-lived connections shared by all db_* functions
+DB_POOL_SIZE = int(os.environ.get('RESERVATIONS_DB_POOL_SIZE', 5))
+DB_POOL_TIMEOUT = float(os.environ.get('RESERVATIONS_DB_POOL_TIMEOUT', 30))
+# Compiled statements kept per connection (enough for every query of QUERIES)
+DB_STATEMENT_CACHE = int(os.environ.get('RESERVATIONS_DB_STATEMENT_CACHE', 256))
+
+
+def create_db_pool(database_file=DATABASE_FILE, connect=None):
+    '''
+    Function to create a connection pool set up like the server's: to
+    `database_file`, or to whatever the `connect` factory returns (see
+    ConnectionPool)
+    '''
+    return ConnectionPool(database_file, size=DB_POOL_SIZE, timeout=DB_POOL_TIMEOUT,
+        on_connect=configure_connection, cached_statements=DB_STATEMENT_CACHE, connect=connect)
+
+
+DB_POOL = create_db_pool()
+
+
+def set_db_pool(pool):
+    '''
+    Function to make the db_* functions use another connection pool (e.g.
+    one of create_db_pool to an in-memory database in tests and benchmarks).
+    Returns the pool used before, to be set back afterwards.
+    '''
+    global DB_POOL
+    previous_pool = DB_POOL
+    DB_POOL = pool
+    return previous_pool
+
 
 def get_db_connection():
     '''
-    Function to connect to database
+    Function to borrow a connection from the pool. Use it as a context manager:
+    the transaction is committed (or rolled back on error) and the connection
+    returned to the pool at the end of the `with` block.
     '''
-    conn = sqlite3.connect(DATABASE_FILE)
-    conn.row_factory = sqlite3.Row
-    return conn
+    return DB_POOL.connection()
 
-def generate_hash(password):
-    salt = os.urandom(32)
+
+def get_db_dedicated_connection():
+    '''
+    Function to open a connection outside the pool, closed at the end of the
+    `with` block. Use it for reads that last as long as a client takes to
+    download them, so they do not hold a pooled connection meanwhile.
+    '''
+    return DB_POOL.dedicated_connection()
+
+
+def db_migrate():
+    '''
+    Function to apply the migrations the database is missing (run at server
+    start). Returns the versions applied.
+    '''
+    with get_db_connection() as conn:
+        return update_db_schema(conn)
+
+
+def get_db_pool_stats():
+    '''
+    Function to get the connection pool counters (opened, reused, ...)
+    '''
+    return DB_POOL.stats()
+
+
+# Background checkpoints of the write-ahead log and scheduled snapshots
+# (see database_backups.py), started with the server
+DB_CHECKPOINTS = CheckpointScheduler(get_db_connection)
+DB_BACKUPS = BackupScheduler(DATABASE_FILE)
+
+
+def get_db_storage_stats():
+    '''
+    Function to get the storage pragmas in use and the checkpoint and
+    snapshot counters
+    '''
+    with get_db_connection() as conn:
+        pragmas = get_pragmas(conn)
+    return {'pragmas': pragmas, 'checkpoints': DB_CHECKPOINTS.stats(), 'backups': DB_BACKUPS.stats()}
+
+
+class TransactionCursor(sqlite3.Cursor):
+    '''
+    Cursor of a write transaction opened with get_db_transaction. Callbacks
+    added to `after_commit` run once the transaction has been committed.
+    '''
+
+    def __init__(self, *args):
+        super().__init__(*args)
+        self.after_commit = []
+
+
+@contextmanager
+def get_db_cursor(cursor=None):
+    '''
+    Function to get a cursor to read from the database: the given cursor (to
+    read inside its transaction) or a new one on a pooled connection
+    '''
+    if cursor is not None:
+        yield cursor
+    else:
+        with get_db_connection() as conn:
+            yield conn.cursor()
+
+
+def db_execute(cursor, name, parameters=()):
+    '''
+    Function to run the query `name` of QUERIES (see database_queries.py)
+    with its values bound to the placeholders. Returns the cursor.
+    '''
+    SQL_PROFILER.begin()
+    start = time.perf_counter()
+    try:
+        return cursor.execute(QUERIES[name], parameters)
+    finally:
+        elapsed = time.perf_counter() - start
+        record_query(elapsed)
+        SQL_PROFILER.end(cursor, name, QUERIES[name], parameters, elapsed)
+
+
+def db_execute_many(cursor, name, rows):
+    '''
+    Function to run the query `name` of QUERIES once for every row of
+    values in `rows` (one statement, compiled once). Returns the cursor.
+    '''
+    SQL_PROFILER.begin()
+    start = time.perf_counter()
+    try:
+        return cursor.executemany(QUERIES[name], rows)
+    finally:
+        elapsed = time.perf_counter() - start
+        record_query(elapsed)
+        SQL_PROFILER.end(cursor, name, QUERIES[name], (), elapsed)
+
+
+def db_iterate(name, parameters=(), batch_size=500):
+    '''
+    Function to run the query `name` of QUERIES and yield its rows
+    `batch_size` at a time, so a large result is never held in memory at
+    once. The rows are read on a connection of their own (see
+    get_db_dedicated_connection), kept until the generator is exhausted or
+    closed, so streamed reports never hold a pooled connection.
+    '''
+    with get_db_dedicated_connection() as conn:
+        cursor = conn.cursor()
+        db_execute(cursor, name, parameters)
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            yield from rows
+
+
+@contextmanager
+def get_db_transaction(cursor=None):
+    '''
+    Function to run several statements in one write transaction, committed
+    at the end of the `with` block. The write lock is taken up front
+    (BEGIN IMMEDIATE) so the statements see no concurrent writes. If `cursor`
+    is given, its transaction is joined instead.
+    '''
+    if cursor is not None:
+        yield cursor
+        return
+
+    with get_db_connection() as conn:
+        cursor = conn.cursor(TransactionCursor)
+        cursor.execute("BEGIN IMMEDIATE")
+        yield cursor
+
+    for callback in cursor.after_commit:
+        callback()
+
+
+def hash_password(password, salt):
+    '''
+    Function to hash a password with a salt (PBKDF2, timed for the metrics)
+    '''
+    start = time.perf_counter()
     hashed = hashlib.pbkdf2_hmac(
         hash_name='sha256',
         password=password.encode('utf-8'),
         salt=salt,
         iterations=100000
     )
-    return salt, hashed
+    record_password_hashing(time.perf_counter() - start)
+    return hashed
+
+
+def generate_hash(password):
+    salt = os.urandom(32)
+    return salt, hash_password(password, salt)
+
 
-def add_data_to_table(cursor, data_path, table):
+def hash_user_row(row):
+    '''
+    Function to turn a row of users.csv (user_id, role, balance, active,
+    password) into a row of the users table, with a salted password hash
+    '''
+    salt, hashed = generate_hash(row[4])
+    return [row[0], row[1], row[2], row[3], salt, hashed]
+
+
+def batches(rows, size):
+    '''
+    Function to split rows into lists of at most `size` rows, read lazily
+    '''
+    rows = iter(rows)
+    while True:
+        batch = list(itertools.islice(rows, size))
+        if not batch:
+            return
+        yield batch
+
+
+def add_data_to_table(cursor, data_path, table, workers=HASH_WORKERS):
     '''
     Function to insert data into a database (determined by the cursor), given a data path
-    and table (3 tables - reservations, transactions and users)
-    '''
-    # Get number of values to be used in each table
-    DICT_NUMBER_OF_VALUES = {'reservations': 9, 'transactions': 6, 'users': 6}
-    number_of_values = DICT_NUMBER_OF_VALUES[table]
-
-    # Insert data into table
-    open_data_file = open(data_path)
-    if table == "users":
-        # Read CSV data
-        raw_data = csv.reader(open_data_file)
-        next(raw_data, None)
-        data_rows = []
-
-        # Create hashed password using salt
-        for row in raw_data:
-            password = row[4]
-            salt, hashed = generate_hash(password)
-            data_rows.append([row[0], row[1], row[2], row[3], salt, hashed])
-    else:
+    and table (3 tables - reservations, transactions and users).
+    The file is read and inserted IMPORT_BATCH_SIZE rows at a time; user
+    passwords are hashed by `workers` processes, one batch at a time.
+    '''
+    # Get insert query to be used for each table
+    DICT_INSERT_QUERIES = {'reservations': 'add_reservation', 'transactions': 'add_transaction',
+        'users': 'add_user'}
+    insert_query = QUERIES[DICT_INSERT_QUERIES[table]]
+
+    # Read CSV data
+    with open(data_path, newline='') as open_data_file:
         data_rows = csv.reader(open_data_file)
         next(data_rows, None)
-        
-    # Execute query
-    cursor.executemany(f"INSERT INTO {table} VALUES (?{' , ?'*(number_of_values-1)})", data_rows)
 
+        if table == "users" and workers > 1:
+            # Create hashed passwords in parallel, a batch at a time
+            with ProcessPoolExecutor(workers) as executor:
+                for batch in batches(data_rows, IMPORT_BATCH_SIZE):
+                    chunk_size = max(len(batch) // (workers * 4), 1)
+                    cursor.executemany(insert_query, executor.map(hash_user_row, batch, chunksize=chunk_size))
+            return
 
-def reset_dbs_to_original():
+        if table == "users":
+            # Create hashed password using salt
+            data_rows = map(hash_user_row, data_rows)
+
+        # Execute query
+        for batch in batches(data_rows, IMPORT_BATCH_SIZE):
+            cursor.executemany(insert_query, batch)
+
+
+def reset_dbs_to_original(workers=HASH_WORKERS):
     '''
     Function to repopulate both reservation and testing databases with original data.
     Returns True if database creating was successful.
+    `workers` processes hash the user passwords.
     '''
 
     # Connect to DB
-    conn = get_db_connection()
     sql_query = open(CREATE_DB_FILE, 'r').read()
+    with get_db_connection() as conn:
+        # Execute script to create tables
+        cursor = conn.cursor()
+        cursor.executescript(sql_query)
 
-    # Execute script to create tables
-    cursor = conn.cursor()
-    cursor.executescript(sql_query)
+        # Add reservations data
+        add_data_to_table(cursor, RESERVATIONS_DATA, 'reservations')
+        add_data_to_table(cursor, TRANSACTIONS_DATA, 'transactions')
+        add_data_to_table(cursor, USERS_DATA, 'users', workers)
 
-    # Add reservations data
-    add_data_to_table(cursor, RESERVATIONS_DATA, 'reservations')
-    add_data_to_table(cursor, TRANSACTIONS_DATA, 'transactions')
-    add_data_to_table(cursor, USERS_DATA, 'users')
-
-    # Commit and close
-    conn.commit()
-    conn.close()
+        # Apply migrations (version token, triggers, indexes, ...)
+        update_db_schema(conn)
 
     # Copy reservations data to testing database
-    if os.path.exists(TEST_DATABASE_FILE):
-        os.remove(TEST_DATABASE_FILE)
-    shutil.copyfile(DATABASE_FILE, TEST_DATABASE_FILE)
+    copy_database(DATABASE_FILE, TEST_DATABASE_FILE, journal_mode='DELETE')
+
+
+def copy_database(source_file, destination_file, journal_mode=None):
+    '''
+    Function to copy a database with the SQLite backup API (see
+    database_backups.backup_database). Unlike copying the file, this
+    includes changes still in the write-ahead log and is safe while the
+    database is in use: connections to the destination see the new content.
+    `journal_mode` (e.g. DELETE for a standalone copy) is set on the
+    destination afterwards.
+    '''
+    backup_database(source_file, destination_file, journal_mode=journal_mode, timeout=DB_POOL_TIMEOUT)
 
-if __name__ == '__main__':
-    reset_dbs_to_original()
 
 def save_current_version_of_db():
     '''
@@ -101,8 +346,8 @@ def save_current_version_of_db():
     if os.path.exists(BACKUP_DATABASE_FILE):
         # Delete backup file if it already exists
         os.remove(BACKUP_DATABASE_FILE)
-    # Rename current DB to backup name
-    shutil.copyfile(DATABASE_FILE, BACKUP_DATABASE_FILE)
+    # Copy current DB to backup name
+    copy_database(DATABASE_FILE, BACKUP_DATABASE_FILE, journal_mode='DELETE')
     
 
 def restore_db_from_backup():
@@ -110,9 +355,10 @@ def restore_db_from_backup():
     Function to restore database file from backup
     '''
     if os.path.exists(BACKUP_DATABASE_FILE):
-        os.remove(DATABASE_FILE)
-        shutil.copyfile(BACKUP_DATABASE_FILE, DATABASE_FILE)
+        copy_database(BACKUP_DATABASE_FILE, DATABASE_FILE)
         os.remove(BACKUP_DATABASE_FILE)
+        # Pooled connections were opened before the copy
+        db_migrate()
     else:
         raise Exception("Backup file does not exits and database cannot be restored.")
 
@@ -125,5 +371,14 @@ def use_test_db():
     save_current_version_of_db()
 
     # Copy test data to database
-    os.remove(DATABASE_FILE)
-    shutil.copyfile(TEST_DATABASE_FILE, DATABASE_FILE)
\ No newline at end of file
+    copy_database(TEST_DATABASE_FILE, DATABASE_FILE)
+    # Pooled connections were opened before the copy
+    db_migrate()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog='python -m database.database_helpers',
+        description='Repopulate the reservations and testing databases with the original data.')
+    parser.add_argument('--workers', type=int, default=HASH_WORKERS,
+        help='processes hashing the user passwords (default: number of CPUs)')
+    reset_dbs_to_original(parser.parse_args().workers)
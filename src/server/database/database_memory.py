@@ -0,0 +1,95 @@
+# In-memory copies of the database for tests and benchmarks:
+# a database file is loaded into memory once and every test gets its own
+# clone (made with the SQLite backup API), so tests never copy files around
+# or change data/reservations.db and can run in parallel processes
+#
+# Fabrizio Giovannini Filho, Yuxin Guan, Lynnette Jiang, Jared McKeon, Fandi Meng
+
+import itertools, os, sqlite3
+from contextlib import contextmanager
+from database.database_helpers import create_db_pool, set_db_pool, update_db_schema, DB_STATEMENT_CACHE
+from database.database_occupancy import OCCUPANCY_INDEX
+from database.database_sequences import RESERVATION_IDS
+
+# Numbers databases so every one of a process has its own name
+DATABASE_NUMBERS = itertools.count()
+
+
+class MemoryDatabase:
+    '''
+    In-memory database shared by all connections of this process that open
+    its name (file:<name>?mode=memory&cache=shared). It exists while the
+    object is open: SQLite drops it when its last connection closes. Names
+    include the process ID, so test processes running side by side (e.g.
+    with pytest-xdist) never share a database.
+    '''
+
+    def __init__(self):
+        self.name = f'reservations-{os.getpid()}-{next(DATABASE_NUMBERS)}'
+        self.uri = f'file:{self.name}?mode=memory&cache=shared'
+        # Keeps the database alive
+        self._anchor = self.connect()
+
+    def connect(self):
+        '''
+        Opens a new connection to the database (a connection factory for
+        ConnectionPool)
+        '''
+        return sqlite3.connect(self.uri, uri=True, check_same_thread=False,
+            cached_statements=DB_STATEMENT_CACHE)
+
+    @classmethod
+    def from_file(cls, database_file):
+        '''
+        Returns a new in-memory database with the content of a database
+        file, brought up to date with the migrations
+        '''
+        database = cls()
+        source = sqlite3.connect(database_file)
+        try:
+            source.backup(database._anchor)
+        finally:
+            source.close()
+        update_db_schema(database._anchor)
+        return database
+
+    def clone(self):
+        '''
+        Returns a new in-memory database with the same content
+        '''
+        database = MemoryDatabase()
+        self._anchor.backup(database._anchor)
+        return database
+
+    def close(self):
+        self._anchor.close()
+
+
+@contextmanager
+def use_db_pool(pool):
+    '''
+    Context manager that makes the db_* functions use a connection pool for
+    the `with` block, and closes it at the end. The occupancy index and
+    reservation ID blocks of the previous database are dropped before and
+    after.
+    '''
+    previous_pool = set_db_pool(pool)
+    OCCUPANCY_INDEX.clear()
+    RESERVATION_IDS.reset()
+    try:
+        yield pool
+    finally:
+        set_db_pool(previous_pool)
+        pool.close_all()
+        OCCUPANCY_INDEX.clear()
+        RESERVATION_IDS.reset()
+
+
+@contextmanager
+def use_memory_db(database):
+    '''
+    Context manager that makes the db_* functions use an in-memory database
+    (through a pool of its own) for the `with` block
+    '''
+    with use_db_pool(create_db_pool(database.uri, connect=database.connect)):
+        yield database
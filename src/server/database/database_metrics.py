@@ -0,0 +1,210 @@
+# Metrics of the server process, exposed in the Prometheus text format:
+# counters, gauges and histograms kept in memory (per process), and the
+# database-side measurements (SQL statements run, connections opened,
+# password hashing time). SQL and hashing time are also added to the
+# statistics of the HTTP request being served (see helpers/metrics_functions.py)
+#
+# Fabrizio Giovannini Filho, Yuxin Guan, Lynnette Jiang, Jared McKeon, Fandi Meng
+
+import bisect, contextvars, threading
+
+# Every metric created, in the order they are rendered
+METRICS = []
+
+
+def format_value(value):
+    '''
+    Returns a number as written in the Prometheus text format
+    '''
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def format_labels(names, values, extra=()):
+    '''
+    Returns the {name="value",...} part of a sample, or '' without labels
+    '''
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+
+class Metric:
+    '''
+    A named metric with one value per combination of its label values.
+    Thread-safe: requests are served by many threads at once.
+    '''
+    kind = 'untyped'
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._lock = threading.Lock()
+        self._values = {}
+        METRICS.append(self)
+
+    def _key(self, labels):
+        return tuple(labels[name] for name in self.labels)
+
+    def value(self, **labels):
+        '''
+        Returns the current value for some label values (None if never set)
+        '''
+        with self._lock:
+            return self._values.get(self._key(labels))
+
+    def samples(self):
+        '''
+        Yields (name suffix, label values, extra labels, value) of every sample
+        '''
+        with self._lock:
+            values = list(self._values.items())
+        for key, value in sorted(values):
+            yield '', key, (), value
+
+    def render(self):
+        '''
+        Returns the metric in the Prometheus text format
+        '''
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+        for suffix, key, extra, value in self.samples():
+            lines.append(f'{self.name}{suffix}{format_labels(self.labels, key, extra)} {format_value(value)}')
+        return '\n'.join(lines) + '\n'
+
+
+class Counter(Metric):
+    '''
+    Value that only goes up (requests served, seconds spent, ...)
+    '''
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    '''
+    Value that goes up and down (requests in flight, ...)
+    '''
+    kind = 'gauge'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+
+class Histogram(Metric):
+    '''
+    Distribution of observed values (e.g. latencies): the number of values
+    up to each bucket bound, their sum and their count
+    '''
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labels=(), buckets=(.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)):
+        super().__init__(name, documentation, labels)
+        self.buckets = sorted(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                # Values per bucket (the last one for values above every bound), then the sum
+                counts = self._values[key] = [0] * (len(self.buckets) + 1) + [0]
+            counts[index] += 1
+            counts[-1] += value
+
+    def value(self, **labels):
+        '''
+        Returns the count and sum of the values observed for some label
+        values (None if none)
+        '''
+        with self._lock:
+            counts = self._values.get(self._key(labels))
+            return None if counts is None else {'count': sum(counts[:-1]), 'sum': counts[-1]}
+
+    def samples(self):
+        with self._lock:
+            values = [(key, list(counts)) for key, counts in self._values.items()]
+        for key, counts in sorted(values):
+            cumulative = 0
+            for bound, count in zip(self.buckets + [float('inf')], counts[:-1]):
+                cumulative += count
+                yield '_bucket', key, [('le', format_value(float(bound)))], cumulative
+            yield '_sum', key, (), counts[-1]
+            yield '_count', key, (), cumulative
+
+
+def render_metrics():
+    '''
+    Returns every metric in the Prometheus text format
+    '''
+    return ''.join(metric.render() for metric in METRICS)
+
+
+class RequestStats:
+    '''
+    Database work done while serving one request
+    '''
+    __slots__ = ('sql_queries', 'sql_seconds', 'hashing_seconds')
+
+    def __init__(self):
+        self.sql_queries = 0
+        self.sql_seconds = 0.0
+        self.hashing_seconds = 0.0
+
+
+# Statistics of the request being served. Endpoints run in worker threads
+# with a copy of the request's context, so they add to the same object.
+REQUEST_STATS = contextvars.ContextVar('request_stats', default=None)
+
+DB_QUERIES = Counter('reservations_db_queries_total', 'SQL statements run by the db_* functions.')
+DB_QUERY_SECONDS = Counter('reservations_db_query_seconds_total',
+    'Seconds spent running SQL statements of the db_* functions.')
+DB_CONNECTIONS_OPENED = Counter('reservations_db_connections_opened_total', 'Database connections opened.')
+PASSWORD_HASHING_SECONDS = Histogram('reservations_password_hashing_seconds',
+    'Seconds taken by every PBKDF2 password hash.', buckets=(.01, .025, .05, .1, .25, .5, 1, 2.5))
+
+
+def record_query(seconds):
+    '''
+    Function to count an SQL statement that took `seconds` to run
+    '''
+    DB_QUERIES.inc()
+    DB_QUERY_SECONDS.inc(seconds)
+    stats = REQUEST_STATS.get()
+    if stats is not None:
+        stats.sql_queries += 1
+        stats.sql_seconds += seconds
+
+
+def record_connection_opened():
+    '''
+    Function to count a new database connection
+    '''
+    DB_CONNECTIONS_OPENED.inc()
+
+
+def record_password_hashing(seconds):
+    '''
+    Function to count a password hash that took `seconds`
+    '''
+    PASSWORD_HASHING_SECONDS.observe(seconds)
+    stats = REQUEST_STATS.get()
+    if stats is not None:
+        stats.hashing_seconds += seconds
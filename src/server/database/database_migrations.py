@@ -0,0 +1,86 @@
+# Forward-only schema migrations:
+# every file `migrations/NNNN_description.sql` is applied once, in order of
+# its number NNNN, and recorded in the `schema_version` table
+#
+# Fabrizio Giovannini Filho, Yuxin Guan, Lynnette Jiang, Jared McKeon, Fandi Meng
+
+import os, re, sqlite3
+
+MIGRATIONS_DIRECTORY = os.path.join(os.path.dirname(__file__), 'migrations')
+MIGRATION_FILE_NAME = re.compile(r'^(\d+)_(\w+)\.sql$')
+
+
+def get_migrations():
+    '''
+    Returns (version, name, path) of every migration file, in order
+    '''
+    migrations = []
+    for file_name in os.listdir(MIGRATIONS_DIRECTORY):
+        match = MIGRATION_FILE_NAME.match(file_name)
+        if match:
+            migrations.append((int(match.group(1)), match.group(2),
+                os.path.join(MIGRATIONS_DIRECTORY, file_name)))
+    return sorted(migrations)
+
+
+def split_statements(script):
+    '''
+    Splits an SQL script into its statements (trigger bodies stay whole)
+    '''
+    statements = []
+    statement = ''
+    for line in script.splitlines(keepends=True):
+        statement += line
+        if sqlite3.complete_statement(statement):
+            statements.append(statement.strip())
+            statement = ''
+    if statement.strip() and not statement.strip().startswith('--'):
+        statements.append(statement.strip())
+    return statements
+
+
+def db_get_schema_version(cursor):
+    '''
+    Function to get the number of the last migration applied (0 if none)
+    '''
+    cursor.execute("CREATE TABLE IF NOT EXISTS schema_version ("
+        "version integer NOT NULL, name character varying(80) NOT NULL, "
+        "applied_at DATETIME NOT NULL, primary key (version))")
+    return cursor.execute("SELECT COALESCE(MAX(version), 0) FROM schema_version").fetchone()[0]
+
+
+def migrate_db(conn):
+    '''
+    Function to apply the migrations a database is missing, each in its own
+    transaction. Does nothing if the tables of create_db.sql have not been
+    created yet. Returns the versions applied.
+    '''
+    cursor = conn.cursor()
+    tables = cursor.execute("SELECT name FROM sqlite_master WHERE type = 'table' "
+        "AND name = 'reservations'").fetchone()
+    if not tables:
+        return []
+
+    migrations = get_migrations()
+    if migrations[-1][0] <= db_get_schema_version(cursor):
+        if conn.in_transaction:
+            conn.commit()
+        return []
+
+    applied = []
+    for version, name, path in migrations:
+        # Take the write lock first, so concurrent servers apply each migration once
+        if conn.in_transaction:
+            conn.commit()
+        cursor.execute("BEGIN IMMEDIATE")
+        try:
+            if version > db_get_schema_version(cursor):
+                for statement in split_statements(open(path, 'r').read()):
+                    cursor.execute(statement)
+                cursor.execute("INSERT INTO schema_version VALUES (?, ?, datetime('now'))", [version, name])
+                applied.append(version)
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+    return applied
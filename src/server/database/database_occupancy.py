@@ -0,0 +1,481 @@
+# In-memory occupancy store of the `reservations` table:
+# bookings are made in half-hour slots between 9 and 18, so a facility-day is
+# a small array of counters (one per slot and resource) that is cheap to
+# check and to update, instead of scanning the table on every booking
+#
+# Fabrizio Giovannini Filho, Yuxin Guan, Lynnette Jiang, Jared McKeon, Fandi Meng
+
+import math, threading
+from array import array
+from contextlib import contextmanager
+from database.database_helpers import *
+
+# Reservations with these statuses take up a machine
+ACTIVE_STATUSES = ('on', 'hold')
+
+# Each machine has own reservation constraint:
+RESERVATION_CONSTRAINTS = {
+    "workshop": 4,
+    "microvac": 2,
+    "irradiator": 2,
+    "extruder": 2,
+    "crusher": 1,
+    "harvester": 1
+}
+RESOURCES = tuple(RESERVATION_CONSTRAINTS)
+
+# Half-hour slots of a day: slot 0 is 9:00-9:30, slot 17 is 17:30-18:00
+OPENING_TIME = 9
+CLOSING_TIME = 18
+SLOT_LENGTH = 0.5
+SLOTS_PER_DAY = int((CLOSING_TIME - OPENING_TIME) / SLOT_LENGTH)
+
+
+def get_slot_range(start_time, end_time):
+    '''
+    Returns the first and last (excluded) slot covered by [start_time, end_time),
+    clipped to opening hours
+    '''
+    first = math.floor((start_time - OPENING_TIME) / SLOT_LENGTH)
+    last = math.ceil((end_time - OPENING_TIME) / SLOT_LENGTH)
+    return min(max(first, 0), SLOTS_PER_DAY), min(max(last, 0), SLOTS_PER_DAY)
+
+
+class DayOccupancy:
+    '''
+    Units in use of every resource in every slot of one facility-day, stored
+    as one array of unsigned bytes: the counters of resource RESOURCES[r] are
+    slots[r * SLOTS_PER_DAY:(r + 1) * SLOTS_PER_DAY]. `slots`, if given, is
+    such an array (e.g. a copy from db_get_days_occupancy) to use.
+    '''
+
+    def __init__(self, slots=None):
+        self.slots = slots if slots is not None else array('B', bytes(len(RESOURCES) * SLOTS_PER_DAY))
+
+    def _window(self, resource, start_time, end_time):
+        '''
+        Returns the positions in `slots` of a resource's window
+        '''
+        offset = RESOURCES.index(resource) * SLOTS_PER_DAY
+        first, last = get_slot_range(start_time, end_time)
+        return offset + first, offset + last
+
+    def add(self, resource, start_time, end_time, units=1):
+        '''
+        Adds `units` (negative to remove) to every slot of the window
+        [start_time, end_time)
+        '''
+        if resource not in RESERVATION_CONSTRAINTS:
+            return
+        first, last = self._window(resource, start_time, end_time)
+        for i in range(first, last):
+            self.slots[i] += units
+
+    def max_usage(self, resource, start_time, end_time):
+        '''
+        Returns the highest number of units in use in any slot of the window
+        [start_time, end_time)
+        '''
+        if resource not in RESERVATION_CONSTRAINTS:
+            return 0
+        first, last = self._window(resource, start_time, end_time)
+        return max(self.slots[first:last], default=0)
+
+    def fits(self, resource, start_time, end_time, units=1):
+        '''
+        Returns True if `units` more of a resource fit in every slot of the window
+        '''
+        return self.max_usage(resource, start_time, end_time) + units <= RESERVATION_CONSTRAINTS[resource]
+
+
+def get_free_windows(slots, resource, first_slot, last_slot, length, units=1):
+    '''
+    Yields, in order, the first slot of every window of `length` slots
+    between first_slot and last_slot (excluded) where `units` more of a
+    resource fit, given the slots of a DayOccupancy. One pass over the slots.
+    '''
+    offset = RESOURCES.index(resource) * SLOTS_PER_DAY
+    most_in_use = RESERVATION_CONSTRAINTS[resource] - units
+    # Free slots in a row up to the current one
+    free = 0
+    for slot in range(max(first_slot, 0), min(last_slot, SLOTS_PER_DAY)):
+        free = free + 1 if slots[offset + slot] <= most_in_use else 0
+        if free >= length:
+            yield slot - length + 1
+
+
+class OccupancyIndex:
+    '''
+    Per-process cache of DayOccupancy arrays, loaded one (facility, date) at a
+    time. The cache is tagged with the version token of the reservations table
+    (see migrations/0001_reservations_version.sql) and dropped whenever the
+    table was changed by someone else; changes made through `record_change`
+    are applied incrementally.
+    '''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._version = None
+        self._days = {}
+
+    def _load_day(self, cursor, facility, reservation_date):
+        '''
+        Builds the occupancy of every resource of a facility on a date
+        '''
+        rows = db_execute(cursor, 'day_occupancy',
+            [facility, reservation_date, *ACTIVE_STATUSES]).fetchall()
+
+        day = DayOccupancy()
+        for row in rows:
+            day.add(row['resource'], row['start_time'], row['end_time'])
+        return day
+
+    def get_day(self, facility, reservation_date, cursor=None):
+        '''
+        Returns a copy of the up-to-date occupancy of a facility on a date
+        '''
+        return self._read_day(facility, reservation_date, lambda day: day.slots[:], cursor)
+
+    def get_days(self, facility, reservation_dates, cursor=None):
+        '''
+        Returns copies of the up-to-date occupancy of a facility on several
+        dates, read from one snapshot. Days not loaded yet are read with one
+        query over their date range.
+        '''
+        keys = [(facility, str(reservation_date)) for reservation_date in reservation_dates]
+        if cursor is not None:
+            return self._read_days_with_cursor(cursor, keys)
+
+        with get_db_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("BEGIN")
+            return self._read_days_with_cursor(cursor, keys)
+
+    def _read_days_with_cursor(self, cursor, keys):
+        '''
+        Returns copies of the occupancy of facility-days read through `cursor`.
+        Days missing from the cache are read without holding the lock, so
+        other requests keep using the cache meanwhile.
+        '''
+        version = db_get_reservations_version(cursor)
+
+        with self._lock:
+            cached = {key: self._days[key].slots[:] for key in set(keys)
+                if version == self._version and key in self._days}
+        missing = sorted({key for key in keys if key not in cached})
+
+        if missing:
+            days = {key: DayOccupancy() for key in missing}
+            facilities = {facility for facility, _ in missing}
+            for facility in facilities:
+                dates = [reservation_date for key_facility, reservation_date in missing
+                    if key_facility == facility]
+                for row in db_execute(cursor, 'occupancy_between_dates',
+                    [facility, dates[0], dates[-1], *ACTIVE_STATUSES]):
+                    day = days.get((facility, row['reservation_date']))
+                    if day is not None:
+                        day.add(row['resource'], row['start_time'], row['end_time'])
+
+            with self._lock:
+                self._store(version, days)
+            cached.update((key, day.slots[:]) for key, day in days.items())
+
+        # The copies are the caller's own; a date asked for twice gets two
+        copies, seen = [], set()
+        for key in keys:
+            copies.append(cached[key][:] if key in seen else cached[key])
+            seen.add(key)
+        return copies
+
+    def max_usage(self, resource, start_time, end_time):
+        '''
+        Returns the highest number of units in use in any slot of the window
+        [start_time, end_time)
+        '''
+        if resource not in RESERVATION_CONSTRAINTS:
+            return 0
+        first, last = self._window(resource, start_time, end_time)
+        return max(self.slots[first:last], default=0)
+
+    def fits(self, resource, start_time, end_time, units=1):
+        '''
+        Returns True if `units` more of a resource fit in every slot of the window
+        '''
+        return self.max_usage(resource, start_time, end_time) + units <= RESERVATION_CONSTRAINTS[resource]
+
+
+def get_free_windows(slots, resource, first_slot, last_slot, length, units=1):
+    '''
+    Yields, in order, the first slot of every window of `length` slots
+    between first_slot and last_slot (excluded) where `units` more of a
+    resource fit, given the slots of a DayOccupancy. One pass over the slots.
+    '''
+    offset = RESOURCES.index(resource) * SLOTS_PER_DAY
+    most_in_use = RESERVATION_CONSTRAINTS[resource] - units
+    # Free slots in a row up to the current one
+    free = 0
+    for slot in range(max(first_slot, 0), min(last_slot, SLOTS_PER_DAY)):
+        free = free + 1 if slots[offset + slot] <= most_in_use else 0
+        if free >= length:
+            yield slot - length + 1
+
+
+class OccupancyIndex:
+    '''
+    Per-process cache of DayOccupancy arrays, loaded one (facility, date) at a
+    time. The cache is tagged with the version token of the reservations table
+    (see migrations/0001_reservations_version.sql) and dropped whenever the
+    table was changed by someone else; changes made through `record_change`
+    are applied incrementally.
+    '''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._version = None
+        self._days = {}
+
+    def _load_day(self, cursor, facility, reservation_date):
+        '''
+        Builds the occupancy of every resource of a facility on a date
+        '''
+        rows = db_execute(cursor, 'day_occupancy',
+            [facility, reservation_date, *ACTIVE_STATUSES]).fetchall()
+
+        day = DayOccupancy()
+        for row in rows:
+            day.add(row['resource'], row['start_time'], row['end_time'])
+        return day
+
+    def get_day(self, facility, reservation_date, cursor=None):
+        '''
+        Returns a copy of the up-to-date occupancy of a facility on a date
+        '''
+        return self._read_day(facility, reservation_date, lambda day: day.slots[:], cursor)
+
+    def get_days(self, facility, reservation_dates, cursor=None):
+        '''
+        Returns copies of the up-to-date occupancy of a facility on several
+        dates, read from one snapshot. Days not loaded yet are read with one
+        query over their date range.
+        '''
+        keys = [(facility, str(reservation_date)) for reservation_date in reservation_dates]
+        if cursor is not None:
+            return self._read_days_with_cursor(cursor, keys)
+
+        with get_db_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("BEGIN")
+            return self._read_days_with_cursor(cursor, keys)
+
+    def _read_days_with_cursor(self, cursor, keys):
+        '''
+        Returns copies of the occupancy of facility-days read through `cursor`
+        '''
+        version = db_get_reservations_version(cursor)
+
+        with self._lock:
+            if version != self._version:
+                self._days = {}
+                self._version = version
+            missing = sorted({key for key in keys if key not in self._days})
+            if missing:
+                days = {key: DayOccupancy() for key in missing}
+                facilities = {facility for facility, _ in missing}
+                for facility in facilities:
+                    dates = [reservation_date for key_facility, reservation_date in missing
+                        if key_facility == facility]
+                    for row in db_execute(cursor, 'occupancy_between_dates',
+                        [facility, dates[0], dates[-1], *ACTIVE_STATUSES]):
+                        day = days.get((facility, row['reservation_date']))
+                        if day is not None:
+                            day.add(row['resource'], row['start_time'], row['end_time'])
+                self._days.update(days)
+            return [self._days[key].slots[:] for key in keys]
+
+    def max_usage(self, facility, reservation_date, resource, start_time, end_time, cursor=None):
+        '''
+        Returns the highest number of units of `resource` in use in any slot
+        of the window [start_time, end_time)
+        '''
+        return self._read_day(facility, reservation_date,
+            lambda day: day.max_usage(resource, start_time, end_time), cursor)
+
+    def fits(self, facility, reservation_date, resource, start_time, end_time, units=1, cursor=None):
+        '''
+        Returns True if `units` more of `resource` fit in the window [start_time, end_time)
+        '''
+        return self._read_day(facility, reservation_date,
+            lambda day: day.fits(resource, start_time, end_time, units), cursor)
+
+    def _read_day(self, facility, reservation_date, read, cursor=None):
+        '''
+        Calls `read` with the up-to-date occupancy of a facility on a date, as
+        seen by `cursor` if given (e.g. inside a write transaction)
+        '''
+        key = (facility, str(reservation_date))
+        if cursor is not None:
+            return self._read_day_with_cursor(cursor, key, read)
+
+        with get_db_connection() as conn:
+            cursor = conn.cursor()
+            # Read the version and the day from the same snapshot
+            cursor.execute("BEGIN")
+            return self._read_day_with_cursor(cursor, key, read)
+
+    def _read_day_with_cursor(self, cursor, key, read):
+        '''
+        Calls `read` with the occupancy of a facility-day read through
+        `cursor`. A day missing from the cache is read without holding the
+        lock, so other requests keep using the cache meanwhile.
+        '''
+        version = db_get_reservations_version(cursor)
+
+        with self._lock:
+            if version == self._version and key in self._days:
+                return read(self._days[key])
+
+        day = self._load_day(cursor, *key)
+
+        with self._lock:
+            self._store(version, {key: day})
+            return read(day)
+
+    def _store(self, version, days):
+        # Caches days read at `version` (with the lock held). The cache moves
+        # to that version if it was at another one; a day another request
+        # cached at the same version meanwhile is the same and is kept.
+        if version != self._version:
+            self._days = {}
+            self._version = version
+        for key, day in days.items():
+            self._days.setdefault(key, day)
+
+    def record_change(self, version_before, version_after, changes):
+        '''
+        Applies a committed change of the reservations table. `changes` is a
+        list of (facility, reservation_date, resource, start_time, end_time, units)
+        and the versions must have been read inside the write transaction.
+        '''
+        with self._lock:
+            if version_before != self._version:
+                # Somebody else changed the table too: reload on demand
+                self._days = {}
+                self._version = None
+                return
+
+            self._version = version_after
+            for facility, reservation_date, resource, start_time, end_time, units in changes:
+                day = self._days.get((facility, str(reservation_date)))
+                # Days that are not loaded yet are read from the table when needed
+                if day is not None:
+                    day.add(resource, start_time, end_time, units)
+
+    def clear(self):
+        '''
+        Drops every cached day
+        '''
+        with self._lock:
+            self._days = {}
+            self._version = None
+
+
+OCCUPANCY_INDEX = OccupancyIndex()
+
+# Striped in-process locks for (facility, date, resource)
+RESOURCE_LOCKS = [threading.Lock() for _ in range(64)]
+
+
+def resource_lock(facility, reservation_date, resource):
+    '''
+    Function to get the in-process lock of a resource on a date. Bookings of
+    the same machine wait for each other on this lock, instead of retrying
+    on the database write lock, while bookings of other machines go ahead.
+    '''
+    return RESOURCE_LOCKS[hash((facility, str(reservation_date), resource)) % len(RESOURCE_LOCKS)]
+
+
+@contextmanager
+def resource_locks(keys):
+    '''
+    Function to hold the in-process locks of several (facility, date,
+    resource) at once (see resource_lock), taken in a fixed order so that
+    two bookings of overlapping keys cannot wait for each other
+    '''
+    stripes = sorted({hash((facility, str(reservation_date), resource)) % len(RESOURCE_LOCKS)
+        for facility, reservation_date, resource in keys})
+    taken = []
+    try:
+        for stripe in stripes:
+            RESOURCE_LOCKS[stripe].acquire()
+            taken.append(RESOURCE_LOCKS[stripe])
+        yield
+    finally:
+        for lock in reversed(taken):
+            lock.release()
+
+
+def db_get_reservations_version(cursor):
+    '''
+    Function to get the version token of the reservations table
+    '''
+    return db_execute(cursor, 'reservations_version').fetchone()[0]
+
+
+@contextmanager
+def db_reservations_transaction(cursor=None):
+    '''
+    Function to change the reservations table in one write transaction (see
+    get_db_transaction). Changes added to the cursor's `occupancy_changes`
+    are applied to the occupancy index once the transaction is committed.
+    '''
+    with get_db_transaction(cursor) as cursor:
+        if hasattr(cursor, 'occupancy_changes'):
+            # Already tracked by an outer transaction
+            yield cursor
+            return
+
+        version_before = db_get_reservations_version(cursor)
+        cursor.occupancy_changes = []
+        yield cursor
+        version_after = db_get_reservations_version(cursor)
+        cursor.after_commit.append(lambda: db_record_occupancy_change(version_before,
+            version_after, cursor.occupancy_changes))
+
+
+def db_get_max_usage(facility, reservation_date, resource, start_time, end_time, cursor=None):
+    '''
+    Function to get the highest number of units of a resource booked or held
+    in any half-hour slot between start_time and end_time on a date
+    '''
+    return OCCUPANCY_INDEX.max_usage(facility, reservation_date, resource, start_time, end_time, cursor)
+
+
+def db_window_fits(facility, reservation_date, resource, start_time, end_time, units=1, cursor=None):
+    '''
+    Function to check if `units` more of a resource can be booked between
+    start_time and end_time on a date
+    '''
+    return OCCUPANCY_INDEX.fits(facility, reservation_date, resource, start_time, end_time, units, cursor)
+
+
+def db_get_day_occupancy(facility, reservation_date, cursor=None):
+    '''
+    Function to get the units in use of every resource in every half-hour
+    slot of a date (see DayOccupancy)
+    '''
+    return OCCUPANCY_INDEX.get_day(facility, reservation_date, cursor)
+
+
+def db_get_days_occupancy(facility, reservation_dates, cursor=None):
+    '''
+    Function to get the units in use of every resource in every half-hour
+    slot of several dates of a facility, all as of the same moment
+    '''
+    return OCCUPANCY_INDEX.get_days(facility, reservation_dates, cursor)
+
+
+def db_record_occupancy_change(version_before, version_after, changes):
+    '''
+    Function to keep the occupancy index in sync after a committed change
+    '''
+    OCCUPANCY_INDEX.record_change(version_before, version_after, changes)
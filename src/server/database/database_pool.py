@@ -0,0 +1,206 @@
+# Connection pool for the SQLite database:
+# keeps a bounded number of long-lived connections that the db_* functions
+# borrow and give back, instead of opening a new connection on every call
+#
+# Fabrizio Giovannini Filho, Yuxin Guan, Lynnette Jiang, Jared McKeon, Fandi Meng
+
+import os, queue, sqlite3, threading
+from contextlib import contextmanager
+
+
+class ConnectionPool:
+    '''
+    Bounded pool of SQLite connections.
+
+    At most `size` connections exist at the same time. Idle connections are
+    reused (most recently used first) and health-checked before being handed
+    out: a connection is discarded if it no longer answers a query or if the
+    database file was replaced on disk since it was opened. `on_connect`, if
+    given, is called with every newly opened connection. Each connection
+    keeps its last `cached_statements` compiled statements, so queries run
+    again on a reused connection are not compiled again.
+
+    `connect`, if given, replaces sqlite3.connect(database_file, ...): it is
+    called without arguments and must return a new connection usable from
+    any thread (e.g. to an in-memory database, see database_memory.py).
+    '''
+
+    def __init__(self, database_file, size=5, timeout=30, on_connect=None, cached_statements=128,
+        connect=None):
+        self.database_file = database_file
+        self.size = size
+        self.timeout = timeout
+        self.on_connect = on_connect
+        self.cached_statements = cached_statements
+        self.connect = connect
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(size)
+        self._lock = threading.Lock()
+        self._generation = 0
+        self._in_use = 0
+        self._stats = {'opened': 0, 'reused': 0, 'discarded': 0, 'closed': 0}
+
+    def _file_identity(self):
+        '''
+        Returns (device, inode) of the database file, or None if it does not exist
+        '''
+        try:
+            stat = os.stat(self.database_file)
+        except OSError:
+            return None
+        return (stat.st_dev, stat.st_ino)
+
+    def _open(self):
+        '''
+        Opens a new connection to the database file
+        '''
+        if self.connect:
+            conn = self.connect()
+        else:
+            conn = sqlite3.connect(self.database_file, timeout=self.timeout,
+                check_same_thread=False, cached_statements=self.cached_statements)
+        conn.row_factory = sqlite3.Row
+        if self.on_connect:
+            try:
+                self.on_connect(conn)
+            except BaseException:
+                conn.close()
+                raise
+        with self._lock:
+            self._stats['opened'] += 1
+        return conn, self._file_identity(), self._generation
+
+    def _is_healthy(self, conn, file_identity):
+        '''
+        Checks that an idle connection can still be used
+        '''
+        if file_identity != self._file_identity():
+            return False
+        try:
+            conn.execute("SELECT 1").fetchone()
+        except sqlite3.Error:
+            return False
+        return True
+
+    def _discard(self, conn):
+        '''
+        Closes a connection that will not go back to the pool
+        '''
+        try:
+            conn.close()
+        except sqlite3.Error:
+            pass
+        with self._lock:
+            self._stats['discarded'] += 1
+
+    def acquire(self):
+        '''
+        Borrows a connection from the pool, waiting up to `timeout` seconds
+        for one to become available. Must be given back with `release`.
+        '''
+        if not self._slots.acquire(timeout=self.timeout):
+            raise sqlite3.OperationalError('Timed out waiting for a database connection')
+
+        try:
+            while True:
+                try:
+                    entry = self._idle.get_nowait()
+                except queue.Empty:
+                    entry = self._open()
+                    break
+                conn, file_identity, generation = entry
+                if generation == self._generation and self._is_healthy(conn, file_identity):
+                    with self._lock:
+                        self._stats['reused'] += 1
+                    break
+                self._discard(conn)
+        except BaseException:
+            self._slots.release()
+            raise
+
+        with self._lock:
+            self._in_use += 1
+        return entry
+
+    def release(self, entry):
+        '''
+        Gives a connection back to the pool
+        '''
+        conn, file_identity, generation = entry
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+            if generation == self._generation:
+                self._idle.put(entry)
+            else:
+                conn.close()
+                with self._lock:
+                    self._stats['closed'] += 1
+        except sqlite3.Error:
+            self._discard(conn)
+        finally:
+            with self._lock:
+                self._in_use -= 1
+            self._slots.release()
+
+    @contextmanager
+    def connection(self):
+        '''
+        Context manager that borrows a connection, commits when the block
+        ends (or rolls back if it raised) and always returns it to the pool
+        '''
+        entry = self.acquire()
+        conn = entry[0]
+        try:
+            yield conn
+            if conn.in_transaction:
+                conn.commit()
+        except BaseException:
+            if conn.in_transaction:
+                conn.rollback()
+            raise
+        finally:
+            self.release(entry)
+
+    @contextmanager
+    def dedicated_connection(self):
+        '''
+        Context manager that opens a connection of its own, set up like the
+        pooled ones but not taking one of the `size` slots (e.g. for a report
+        read while it is downloaded), and closes it when the block ends
+        '''
+        conn, _, _ = self._open()
+        try:
+            yield conn
+        finally:
+            conn.close()
+            with self._lock:
+                self._stats['closed'] += 1
+
+    def close_all(self):
+        '''
+        Closes every idle connection. Connections currently in use are
+        closed when they are given back.
+        '''
+        with self._lock:
+            self._generation += 1
+        while True:
+            try:
+                conn, _, _ = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            conn.close()
+            with self._lock:
+                self._stats['closed'] += 1
+
+    def stats(self):
+        '''
+        Returns counters of connections opened, reused, discarded and closed,
+        plus the current number of idle and in-use connections
+        '''
+        with self._lock:
+            stats = dict(self._stats)
+            stats['in_use'] = self._in_use
+        stats['idle'] = self._idle.qsize()
+        stats['size'] = self.size
+        return stats
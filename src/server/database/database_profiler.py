@@ -0,0 +1,181 @@
+# SQL profiler and slow-query log of the database layer:
+# with RESERVATIONS_PROFILE_SQL=yes, every pooled connection reports the
+# statements SQLite runs (set_trace_callback, with the bound values filled
+# in) and db_execute times them, so calls, total/mean/max time and rows
+# returned are added up per statement (values replaced by ?). Statements
+# slower than RESERVATIONS_SLOW_QUERY_MS are logged whether profiling is on
+# or not. The profile is served by GET /stats/queries (admins) and, when
+# profiling, written out when the process exits.
+#
+# Fabrizio Giovannini Filho, Yuxin Guan, Lynnette Jiang, Jared McKeon, Fandi Meng
+
+import atexit, json, logging, os, re, sys, threading, weakref
+
+PROFILE_SQL = os.environ.get('RESERVATIONS_PROFILE_SQL', 'no').strip().lower() in ('yes', 'y', 'true', '1', 'on')
+# Statements taking longer are logged (0 to log none)
+SLOW_QUERY_MS = float(os.environ.get('RESERVATIONS_SLOW_QUERY_MS', 100))
+# JSON file the profile is written to at exit (default: a table on stderr)
+PROFILE_OUTPUT = os.environ.get('RESERVATIONS_PROFILE_OUTPUT')
+
+LOGGER = logging.getLogger('reservations.sql')
+
+# Literal values in traced statements: blobs, strings, then numbers
+LITERALS = re.compile(r"[xX]'[0-9a-fA-F]*'|'(?:[^']|'')*'|(?<![\w.])-?\d+(?:\.\d+)?(?:[eE][-+]?\d+)?(?![\w.])")
+WHITESPACE = re.compile(r'\s+')
+COMMENTS = re.compile(r'--[^\n]*')
+# Statements the sqlite3 module runs itself around the ones it is given
+TRANSACTION_CONTROL = re.compile(r'\s*(BEGIN|COMMIT|ROLLBACK)\b', re.IGNORECASE)
+
+
+def normalize_statement(statement):
+    '''
+    Returns a statement with its literal values replaced by ? and its
+    whitespace collapsed, so runs with different values add up together
+    '''
+    return WHITESPACE.sub(' ', LITERALS.sub('?', COMMENTS.sub('', statement))).strip()
+
+
+class SQLProfiler:
+    '''
+    Per-statement counters of calls, time and rows returned, shared by all
+    connections and threads.
+
+    Statements run with db_execute are timed (wall clock around
+    cursor.execute, i.e. until the first row is ready; fetching the rest is
+    not included) and their rows are counted as they are fetched. Other
+    statements SQLite runs (BEGIN, COMMIT, migrations, executemany, ...) are
+    counted but not timed.
+    '''
+
+    def __init__(self, enabled=PROFILE_SQL, slow_query_ms=SLOW_QUERY_MS, logger=LOGGER):
+        self.enabled = enabled
+        self.slow_query_seconds = slow_query_ms / 1000
+        self.logger = logger
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._statements = {}
+        # Statement of the last db_execute of each cursor, to count its rows
+        self._cursors = weakref.WeakKeyDictionary()
+
+    def install(self, conn):
+        '''
+        Reports the statements of a new connection to the profiler (if
+        profiling). Run after the connection's row factory is set.
+        '''
+        if not self.enabled:
+            return
+        conn.set_trace_callback(self._trace)
+        row_factory = conn.row_factory
+
+        def count_row(cursor, row):
+            statement = self._cursors.get(cursor)
+            if statement is not None:
+                with self._lock:
+                    self._entry(statement)['rows'] += 1
+            return row_factory(cursor, row) if row_factory else row
+
+        conn.row_factory = count_row
+
+    def _entry(self, statement):
+        entry = self._statements.get(statement)
+        if entry is None:
+            entry = self._statements[statement] = {'query': None, 'calls': 0, 'timed_calls': 0,
+                'total_seconds': 0.0, 'max_seconds': 0.0, 'rows': 0}
+        return entry
+
+    def _trace(self, statement):
+        # Called by SQLite as each statement starts. A statement firing
+        # triggers is reported again for each, so repeats are skipped.
+        local = self._local
+        if getattr(local, 'measuring', False) and not TRANSACTION_CONTROL.match(statement):
+            if local.statement is None:
+                local.statement = statement
+        elif statement != getattr(local, 'last', None):
+            with self._lock:
+                self._entry(normalize_statement(statement))['calls'] += 1
+        local.last = statement
+
+    def begin(self):
+        '''
+        Marks the start of a timed statement (see db_execute)
+        '''
+        if self.enabled:
+            self._local.measuring = True
+            self._local.statement = None
+
+    def end(self, cursor, name, sql, parameters, seconds):
+        '''
+        Records a statement of db_execute (query `name` of QUERIES) that
+        took `seconds`, and logs it if slow
+        '''
+        statement = None
+        if self.enabled:
+            local = self._local
+            local.measuring = False
+            statement = local.statement
+            normalized = normalize_statement(statement if statement is not None else sql)
+            with self._lock:
+                entry = self._entry(normalized)
+                entry['query'] = name
+                entry['calls'] += 1
+                entry['timed_calls'] += 1
+                entry['total_seconds'] += seconds
+                entry['max_seconds'] = max(entry['max_seconds'], seconds)
+            try:
+                self._cursors[cursor] = normalized
+            except TypeError:
+                pass
+
+        if self.slow_query_seconds and seconds >= self.slow_query_seconds:
+            self.logger.warning("Slow query %s (%.1f ms): %s", name, seconds * 1000,
+                statement if statement is not None else f"{sql} {list(parameters)}")
+
+    def stats(self):
+        '''
+        Returns the profile: one dict per statement (calls, total, mean and
+        max time in ms, rows returned), the most time-consuming first
+        '''
+        with self._lock:
+            entries = [(statement, dict(entry)) for statement, entry in self._statements.items()]
+        profile = []
+        for statement, entry in entries:
+            profile.append({
+                'statement': statement,
+                'query': entry['query'],
+                'calls': entry['calls'],
+                'timed_calls': entry['timed_calls'],
+                'total_ms': entry['total_seconds'] * 1000,
+                'mean_ms': entry['total_seconds'] * 1000 / entry['timed_calls'] if entry['timed_calls'] else None,
+                'max_ms': entry['max_seconds'] * 1000,
+                'rows': entry['rows'],
+            })
+        profile.sort(key=lambda entry: (-entry['total_ms'], -entry['calls']))
+        return {'enabled': self.enabled, 'slow_query_ms': self.slow_query_seconds * 1000, 'statements': profile}
+
+    def reset(self):
+        '''
+        Clears the profile
+        '''
+        with self._lock:
+            self._statements.clear()
+
+    def dump(self, output=PROFILE_OUTPUT):
+        '''
+        Writes the profile to the JSON file `output`, or as a table to stderr
+        '''
+        stats = self.stats()
+        if output:
+            with open(output, 'w') as profile_file:
+                json.dump(stats, profile_file, indent=2)
+            return
+        sys.stderr.write(f"{'calls':>9} {'total ms':>11} {'mean ms':>9} {'max ms':>9} {'rows':>10}  statement\n")
+        for entry in stats['statements']:
+            mean = f"{entry['mean_ms']:>9.3f}" if entry['mean_ms'] is not None else f"{'-':>9}"
+            sys.stderr.write(f"{entry['calls']:>9} {entry['total_ms']:>11.1f} {mean} {entry['max_ms']:>9.3f} "
+                f"{entry['rows']:>10}  {entry['statement'][:200]}\n")
+
+
+SQL_PROFILER = SQLProfiler()
+
+if SQL_PROFILER.enabled:
+    atexit.register(SQL_PROFILER.dump)
@@ -0,0 +1,93 @@
+# SQL statements of the db_* functions:
+# every query is written once here, with `?` placeholders for its values, and
+# run by name with db_execute / db_iterate. Values are always bound, never
+# pasted into the SQL text, so each statement has one fixed text that SQLite
+# compiles once per pooled connection and then takes from the connection's
+# statement cache.
+#
+# Fabrizio Giovannini Filho, Yuxin Guan, Lynnette Jiang, Jared McKeon, Fandi Meng
+
+# Transactions with the reservation they pay for (its first occurrence for
+# recurring reservations), in one query instead of one lookup per transaction
+TRANSACTIONS_WITH_RESERVATIONS = "SELECT t.transaction_id, t.transaction_type, t.transaction_amount, "\
+    "t.transaction_timestamp, t.user_id, t.reservation_id, r.facility, r.reservation_date, r.resource, "\
+    "r.client_id, r.start_time, r.end_time, r.status FROM transactions AS t "\
+    "LEFT JOIN reservations AS r ON r.reservation_id = t.reservation_id AND r.recurring_number = "\
+    "(SELECT MIN(recurring_number) FROM reservations WHERE reservation_id = t.reservation_id) "
+
+QUERIES = {
+    # reservations
+    'add_reservation': "INSERT INTO reservations VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+    'get_reservation': "SELECT * FROM reservations WHERE reservation_id = ?",
+    'get_reservation_with_status': "SELECT * FROM reservations WHERE reservation_id = ? AND status = ?",
+    'get_reservation_with_statuses': "SELECT * FROM reservations WHERE reservation_id = ? "
+        "AND status IN (?, ?)",
+    'set_reservation_status': "UPDATE reservations SET status = ? WHERE reservation_id = ?",
+    'reservations_between_dates': "SELECT * FROM reservations WHERE reservation_date BETWEEN ? AND ? "
+        "AND status = 'on' AND facility = ?",
+    'reservations_between_dates_for_client': "SELECT * FROM reservations WHERE reservation_date "
+        "BETWEEN ? AND ? AND status = 'on' AND facility = ? AND client_id = ?",
+    'holds_between_dates': "SELECT * FROM reservations WHERE reservation_date BETWEEN ? AND ? "
+        "AND status = 'hold'",
+    'all_holds': "SELECT * FROM reservations WHERE status = 'hold'",
+    'all_reservations': "SELECT * FROM reservations ORDER BY reservation_id, recurring_number",
+    'upsert_reservation': "INSERT INTO reservations VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?) "
+        "ON CONFLICT (reservation_id, recurring_number) DO UPDATE SET facility = excluded.facility, "
+        "reservation_date = excluded.reservation_date, resource = excluded.resource, "
+        "client_id = excluded.client_id, start_time = excluded.start_time, "
+        "end_time = excluded.end_time, status = excluded.status",
+    'active_reservations': "SELECT facility, reservation_date, resource, start_time, end_time "
+        "FROM reservations WHERE status IN (?, ?)",
+    'day_occupancy': "SELECT resource, start_time, end_time FROM reservations "
+        "WHERE facility = ? AND reservation_date = ? AND status IN (?, ?)",
+    'occupancy_between_dates': "SELECT reservation_date, resource, start_time, end_time FROM reservations "
+        "WHERE facility = ? AND reservation_date BETWEEN ? AND ? AND status IN (?, ?)",
+    'reservations_version': "SELECT version FROM reservations_version",
+    'reserve_ids': "UPDATE id_sequences SET next_id = next_id + ? WHERE name = ? RETURNING next_id",
+
+    # transactions
+    'add_transaction': "INSERT INTO transactions VALUES (?, ?, ?, ?, ?, ?)",
+    'upsert_transaction': "INSERT INTO transactions VALUES (?, ?, ?, ?, ?, ?) "
+        "ON CONFLICT (transaction_id) DO UPDATE SET transaction_type = excluded.transaction_type, "
+        "transaction_amount = excluded.transaction_amount, "
+        "transaction_timestamp = excluded.transaction_timestamp, user_id = excluded.user_id, "
+        "reservation_id = excluded.reservation_id",
+    'payment_for_reservation': "SELECT * FROM transactions WHERE reservation_id = ? "
+        "AND transaction_type = 'payment'",
+    'transactions_between_dates': "SELECT * FROM transactions NATURAL JOIN "
+        "(SELECT reservation_id FROM reservations WHERE facility = ?) "
+        "WHERE transaction_timestamp BETWEEN ? AND ?",
+    'all_transactions': "SELECT * FROM transactions",
+    'transactions_for_user': "SELECT * FROM transactions WHERE user_id = ?",
+    'transactions_with_reservations': TRANSACTIONS_WITH_RESERVATIONS + "ORDER BY t.rowid",
+    'transactions_with_reservations_for_user': TRANSACTIONS_WITH_RESERVATIONS +
+        "WHERE t.user_id = ? ORDER BY t.rowid",
+    'transactions_with_reservations_between_dates': TRANSACTIONS_WITH_RESERVATIONS +
+        "WHERE r.facility = ? AND t.transaction_timestamp BETWEEN ? AND ? ORDER BY t.rowid",
+
+    # users
+    'add_user': "INSERT INTO users VALUES (?, ?, ?, ?, ?, ?)",
+    'upsert_user': "INSERT INTO users VALUES (?, ?, ?, ?, ?, ?) "
+        "ON CONFLICT (user_id) DO UPDATE SET role = excluded.role, balance = excluded.balance, "
+        "active = excluded.active, salt = excluded.salt, hash = excluded.hash",
+    'get_user': "SELECT * FROM users WHERE user_id = ?",
+    'all_users': "SELECT * FROM users",
+    'users_with_role': "SELECT * FROM users WHERE role = ?",
+    'count_users_with_role': "SELECT Count() FROM users WHERE role = ?",
+    'remove_user': "DELETE FROM users WHERE user_id = ?",
+    'set_user_role': "UPDATE users SET role = ? WHERE user_id = ?",
+    'set_user_password': "UPDATE users SET salt = ?, hash = ? WHERE user_id = ?",
+    'set_user_active': "UPDATE users SET active = ? WHERE user_id = ?",
+    'add_to_balance': "UPDATE users SET balance = balance + ? WHERE user_id = ?",
+
+    # settings
+    'get_setting': "SELECT value FROM settings WHERE name = ?",
+    'set_setting': "INSERT INTO settings VALUES (?, ?) "
+        "ON CONFLICT (name) DO UPDATE SET value = excluded.value",
+    'add_setting_if_missing': "INSERT OR IGNORE INTO settings VALUES (?, ?)",
+
+    # revoked_tokens
+    'revoke_token': "INSERT OR IGNORE INTO revoked_tokens VALUES (?, ?)",
+    'delete_expired_tokens': "DELETE FROM revoked_tokens WHERE expires_at < strftime('%s', 'now')",
+    'revoked_tokens': "SELECT token_id FROM revoked_tokens WHERE expires_at >= ?",
+}
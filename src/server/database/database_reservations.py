@@ -6,178 +6,183 @@
 # Fabrizio Giovannini Filho, Yuxin Guan, Lynnette Jiang, Jared McKeon, Fandi Meng
 
 from database.database_helpers import *
+from database.database_occupancy import *
+from database.database_sequences import *
 
 def db_add_reservation(reservation_id, facility, recurring_number, reservation_date, resource, 
-    client_id, start_time, end_time, status):
+    client_id, start_time, end_time, status, cursor=None):
     '''
-    Function to add a reservation to the database
+    Function to add a reservation to the database (inside the transaction
+    of `cursor` if given)
     '''
     # Connect to database
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
-    # Execute insert query
-    cursor.execute(f"INSERT INTO reservations VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
-        [reservation_id, facility, recurring_number, reservation_date, resource, client_id,
-        start_time, end_time, status])
+    with db_reservations_transaction(cursor) as cursor:
+        # Execute insert query
+        db_execute(cursor, 'add_reservation',
+            [reservation_id, facility, recurring_number, reservation_date, resource, client_id,
+            start_time, end_time, status])
 
-    # Commit and close
-    conn.commit()
-    conn.close()
+        # Keep occupancy index in sync
+        if status in ACTIVE_STATUSES:
+            cursor.occupancy_changes.append((facility, reservation_date, resource, start_time, end_time, 1))
+
+
+def db_add_reservations(reservations, cursor=None):
+    '''
+    Function to add several reservations (lists of the values of a
+    reservations row, in column order) with one statement, inside the
+    transaction of `cursor` if given
+    '''
+    # Connect to database
+    with db_reservations_transaction(cursor) as cursor:
+        db_execute_many(cursor, 'add_reservation', reservations)
+
+        # Keep occupancy index in sync
+        cursor.occupancy_changes.extend((facility, reservation_date, resource, start_time, end_time, 1)
+            for _, facility, _, reservation_date, resource, _, start_time, end_time, status in reservations
+            if status in ACTIVE_STATUSES)
 
 
 def db_add_transaction(transaction_id, transaction_type, transaction_amount, transaction_timestamp, 
-    user_id, reservation_id):
+    user_id, reservation_id, cursor=None):
     '''
-    Function to add a transaction to the database
+    Function to add a transaction to the database (inside the transaction
+    of `cursor` if given)
     '''
     # Connect to database
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
-    # Execute insert query
-    cursor.execute(f"INSERT INTO transactions VALUES (?, ?, ?, ?, ?, ?)",
-        [transaction_id, transaction_type, transaction_amount, transaction_timestamp, 
-        user_id, reservation_id])
+    with get_db_transaction(cursor) as cursor:
+        # Execute insert query
+        db_execute(cursor, 'add_transaction',
+            [transaction_id, transaction_type, transaction_amount, transaction_timestamp,
+            user_id, reservation_id])
 
-    # Commit and close
-    conn.commit()
-    conn.close()
 
-def db_validate_reservation(reservation_id):
+def db_add_transactions(transactions, cursor=None):
+    '''
+    Function to add several transactions (lists of the values of a
+    transactions row, in column order) with one statement, inside the
+    transaction of `cursor` if given
+    '''
+    # Connect to database
+    with get_db_transaction(cursor) as cursor:
+        db_execute_many(cursor, 'add_transaction', transactions)
+
+
+def db_validate_reservation(reservation_id, cursor=None):
     '''
     Function to validate a reservation 
     Input: reservation_id
     Output: returns True if the user is a valid user, False otherwise
     '''
     # Connect to database
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
-    # Execute insert query
-    cursor.execute(f"SELECT * FROM reservations WHERE reservation_id = {reservation_id}")
-
-    # if a row returns from query, the user is valid
-    if cursor.fetchone():
-        return True
-    else:
-        return False
+    with get_db_cursor(cursor) as cursor:
+        # Execute insert query
+        db_execute(cursor, 'get_reservation', [reservation_id])
+
+        # if a row returns from query, the user is valid
+        if cursor.fetchone():
+            return True
+        else:
+            return False
 
 
-def db_validate_active_reservation(reservation_id):
+def db_validate_active_reservation(reservation_id, cursor=None):
     '''
     Function to validate a reservation 
     Input: reservation_id
     Output: returns True if the user is a valid user, False otherwise
     '''
     # Connect to database
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
-    # Execute insert query
-    cursor.execute(f"SELECT * FROM reservations WHERE reservation_id = {reservation_id} "+
-        f"AND status = 'on'")
-
-    # if a row returns from query, the user is valid
-    if cursor.fetchone():
-        return True
-    else:
-        return False
+    with get_db_cursor(cursor) as cursor:
+        # Execute insert query
+        db_execute(cursor, 'get_reservation_with_status', [reservation_id, 'on'])
+
+        # if a row returns from query, the user is valid
+        if cursor.fetchone():
+            return True
+        else:
+            return False
 
-def db_validate_hold(reservation_id):
+def db_validate_hold(reservation_id, cursor=None):
     '''
     Function to validate a hold 
     Input: reservation_id
     Output: returns True if reservation is a hold, False otherwise
     '''
     # Connect to database
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
-    # Execute insert query
-    cursor.execute(f"SELECT * FROM reservations WHERE reservation_id = {reservation_id} "+
-        f"AND status = 'hold'")
-
-    # if a row returns from query, the user is valid
-    if cursor.fetchone():
-        return True
-    else:
-        return False
+    with get_db_cursor(cursor) as cursor:
+        # Execute insert query
+        db_execute(cursor, 'get_reservation_with_status', [reservation_id, 'hold'])
+
+        # if a row returns from query, the user is valid
+        if cursor.fetchone():
+            return True
+        else:
+            return False
 
 
-def db_cancel_reservation(reservation_id):
+def db_cancel_reservation(reservation_id, cursor=None):
     '''
-    Function to connect to database
+    Function to cancel a reservation (inside the transaction of `cursor`
+    if given)
     '''
-    conn = get_db_connection()
-    cursor = conn.cursor()
+    with db_reservations_transaction(cursor) as cursor:
+        # Rows that stop taking up a machine
+        cancelled = db_execute(cursor, 'get_reservation_with_statuses',
+            [reservation_id, *ACTIVE_STATUSES]).fetchall()
 
-    # Execute query
-    sql_query = f"UPDATE reservations SET status = 'off' WHERE reservation_id = {reservation_id}"
-    cursor.execute(sql_query)
+        # Execute query
+        db_execute(cursor, 'set_reservation_status', ['off', reservation_id])
 
-    # Commit and close
-    conn.commit()
-    conn.close()
+        # Keep occupancy index in sync
+        cursor.occupancy_changes.extend((row['facility'], row['reservation_date'], row['resource'],
+            row['start_time'], row['end_time'], -1) for row in cancelled)
 
 
+def db_iter_reservations_between_dates(start_date, end_date, facility, client_id=None):
+    '''
+    Function to get reservations between start and end dates (and for
+    client_id if given), one row at a time
+    '''
+    # Get reservations between dates
+    if client_id is not None:
+        return db_iterate('reservations_between_dates_for_client',
+            [start_date, end_date, facility, client_id])
+    else:
+        return db_iterate('reservations_between_dates', [start_date, end_date, facility])
+
 
 def db_get_reservations_between_dates(start_date, end_date, facility):
     '''
     Function to get reservations between start and end dates
     '''
-    # Connect to database
-    conn = get_db_connection()
-    cursor = conn.cursor()
-
-    # Get transactions between dates
-    query_reservations = f"SELECT * FROM reservations WHERE reservation_date BETWEEN '{start_date}'"\
-    f" AND '{end_date}' AND status = 'on' AND facility = '{facility}'"
-    all_reservations = cursor.execute(query_reservations).fetchall()
+    return list(db_iter_reservations_between_dates(start_date, end_date, facility))
 
-    # Close
-    conn.close()
 
-    return all_reservations
-
-def db_get_holds_between_dates(start_date, end_date):
+def db_iter_holds_between_dates(start_date, end_date):
     '''
-    Function to get reservations between start and end dates
+    Function to get holds between start and end dates (all holds if no
+    dates are given), one row at a time
     '''
-    # Connect to database
-    conn = get_db_connection()
-    cursor = conn.cursor()
     if start_date and end_date:
-    # Get transactions between dates
-        query_reservations = f"SELECT * FROM reservations WHERE reservation_date BETWEEN '{start_date}'"\
-        f" AND '{end_date}' AND status = 'hold'"
+        # Get holds between dates
+        return db_iterate('holds_between_dates', [start_date, end_date])
     else:
-        query_reservations = f"SELECT * FROM reservations WHERE status = 'hold'"
-    all_holds = cursor.execute(query_reservations).fetchall()
+        return db_iterate('all_holds')
 
-    # Close
-    conn.close()
 
-    return all_holds
+def db_get_holds_between_dates(start_date, end_date):
+    '''
+    Function to get reservations between start and end dates
+    '''
+    return list(db_iter_holds_between_dates(start_date, end_date))
 
 
 def db_get_reservations_between_dates_and_client(start_date, end_date, facility, client_id):
     '''
     Function to get reservations between start and end dates and for client_id
     '''
-    # Connect to database
-    conn = get_db_connection()
-    cursor = conn.cursor()
-
-    # Get transactions between dates
-    query_reservations = f"SELECT * FROM reservations WHERE reservation_date BETWEEN '{start_date}'"\
-    f" AND '{end_date}' AND client_id = '{client_id}' AND status = 'on' AND facility = '{facility}'"
-    all_reservations = cursor.execute(query_reservations).fetchall()
-
-    # Close
-    conn.close()
-
-    return all_reservations
+    return list(db_iter_reservations_between_dates(start_date, end_date, facility, client_id))
 
 
 def db_get_transactions_between_dates(start_date, end_date, facility):
@@ -185,112 +190,86 @@ def db_get_transactions_between_dates(start_date, end_date, facility):
     Function to get transactions between start and end dates
     '''
     # Connect to database
-    conn = get_db_connection()
-    cursor = conn.cursor()
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
 
-    # Get transactions between dates
-    end_date = end_date + "23:59:59.999999"
-    query_transactions =f"SELECT * FROM transactions NATURAL JOIN "\
-    f"(SELECT reservation_id FROM reservations WHERE facility = '{facility}')"\
-    f"WHERE transaction_timestamp BETWEEN '{start_date}' AND '{end_date}'"
-    all_transactions = cursor.execute(query_transactions).fetchall()
-
-    # Close
-    conn.close()
+        # Get transactions between dates
+        end_date = end_date + "23:59:59.999999"
+        all_transactions = db_execute(cursor, 'transactions_between_dates',
+            [facility, start_date, end_date]).fetchall()
 
     return all_transactions
 
 
-def db_get_reservations_for_date_and_time(reservation_date, reservation_time):
+def db_get_reservations_for_id(reservation_id, cursor=None):
     '''
     Function to get reservations between start and end dates
     '''
     # Connect to database
-    conn = get_db_connection()
-    cursor = conn.cursor()
-
-    # Get transactions between dates
-    query_reservations = f"SELECT * FROM reservations WHERE reservation_date = '{reservation_date}'"\
-    f" AND (start_time >= {reservation_time} OR end_time <= {reservation_time})"
-    all_reservations = cursor.execute(query_reservations).fetchall()
-
-    # Close
-    conn.close()
-
-    return all_reservations
-
-
-
-def db_get_reservations_for_id(reservation_id):
-    '''
-    Function to get reservations between start and end dates
-    '''
-    # Connect to database
-    conn = get_db_connection()
-    cursor = conn.cursor()
-
-    # Get transactions between dates
-    query_reservations = f"SELECT * FROM reservations WHERE reservation_id = {reservation_id}"
-    reservation = cursor.execute(query_reservations).fetchone()
-
-    # Close
-    conn.close()
+    with get_db_cursor(cursor) as cursor:
+        # Get transactions between dates
+        reservation = db_execute(cursor, 'get_reservation', [reservation_id]).fetchone()
 
     return reservation
 
 
-def db_get_payment_amount_for_id(reservation_id):
+def db_get_payment_amount_for_id(reservation_id, cursor=None):
     '''
     Function to get payment amount for a reservation
     '''
     # Connect to database
-    conn = get_db_connection()
-    cursor = conn.cursor()
-
-    # Get transactions between dates
-    query_reservations = f"SELECT * FROM transactions WHERE reservation_id = {reservation_id}"\
-    f" AND transaction_type = 'payment'"
-    transaction = cursor.execute(query_reservations).fetchone()
-
-    # Close
-    conn.close()
+    with get_db_cursor(cursor) as cursor:
+        # Get transactions between dates
+        transaction = db_execute(cursor, 'payment_for_reservation', [reservation_id]).fetchone()
 
     return float(transaction['transaction_amount'])
 
-def db_get_user_for_id(reservation_id):
+def db_get_user_for_id(reservation_id, cursor=None):
     '''
     Function to get client for a reservation
     '''
     # Connect to database
-    conn = get_db_connection()
-    cursor = conn.cursor()
+    with get_db_cursor(cursor) as cursor:
+        # Get transactions between dates
+        reservation = db_execute(cursor, 'get_reservation', [reservation_id]).fetchone()
 
-    # Get transactions between dates
-    query_reservations = f"SELECT * FROM reservations WHERE reservation_id = {reservation_id}"
-    reservation = cursor.execute(query_reservations).fetchone()
+    return reservation['client_id']
 
-    # Close
-    conn.close()
 
-    return reservation['client_id']
+def db_iter_transactions_with_reservations(user_id=None):
+    '''
+    Function to get all transactions (or all transactions of user_id) joined
+    with their reservation, one row at a time
+    '''
+    if user_id:
+        return db_iterate('transactions_with_reservations_for_user', [user_id])
+    else:
+        return db_iterate('transactions_with_reservations')
 
 
-def db_get_latest_id():
+def db_get_transactions_with_reservations(user_id=None):
     '''
-    Function to get reservations between start and end dates
+    Function to get all transactions (or all transactions of user_id) joined
+    with their reservation
     '''
-    # Connect to database
-    conn = get_db_connection()
-    cursor = conn.cursor()
+    return list(db_iter_transactions_with_reservations(user_id))
 
-    # Get transactions between dates
-    query_reservations = f"SELECT MAX(reservation_id) AS reservation_id FROM reservations"
-    reservation = cursor.execute(query_reservations).fetchone()
 
-    # Close
-    conn.close()
+def db_iter_transactions_with_reservations_between_dates(start_date, end_date, facility):
+    '''
+    Function to get transactions between start and end dates for reservations
+    of a facility, joined with their reservation, one row at a time
+    '''
+    end_date = end_date + "23:59:59.999999"
+    return db_iterate('transactions_with_reservations_between_dates', [facility, start_date, end_date])
+
 
-    return int(reservation['reservation_id'])
+def db_get_transactions_with_reservations_between_dates(start_date, end_date, facility):
+    '''
+    Function to get transactions between start and end dates for reservations
+    of a facility, joined with their reservation
+    '''
+    return list(db_iter_transactions_with_reservations_between_dates(start_date, end_date, facility))
 
 
 def db_print_all_transactions():
@@ -298,15 +277,11 @@ def db_print_all_transactions():
     Function to print all transactions in the 'transactions' table
     '''
     # Connect to database
-    conn = get_db_connection()
-    cursor = conn.cursor()
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
 
-    # Get all transactions
-    query_transactions = "SELECT * FROM transactions"
-    all_transactions = cursor.execute(query_transactions).fetchall()
-
-    # Close
-    conn.close()
+        # Get all transactions
+        all_transactions = db_execute(cursor, 'all_transactions').fetchall()
 
     return all_transactions
 
@@ -315,14 +290,10 @@ def db_print_all_transactions_for_id(user_id):
     Function to print all transactions in the 'transactions' table
     '''
     # Connect to database
-    conn = get_db_connection()
-    cursor = conn.cursor()
-
-    # Get all transactions
-    query_transactions = f"SELECT * FROM transactions WHERE user_id = '{user_id}'"
-    all_transactions = cursor.execute(query_transactions).fetchall()
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
 
-    # Close
-    conn.close()
+        # Get all transactions
+        all_transactions = db_execute(cursor, 'transactions_for_user', [user_id]).fetchall()
 
     return all_transactions
\ No newline at end of file
@@ -0,0 +1,90 @@
+# Function to interact with database:
+# specifically the `id_sequences` table
+# which hands out new reservation IDs without a MAX() over the reservations table
+#
+# Fabrizio Giovannini Filho, Yuxin Guan, Lynnette Jiang, Jared McKeon, Fandi Meng
+
+import threading
+from database.database_helpers import *
+
+# Number of IDs each process takes from the database at a time. With 1, every
+# ID is taken inside the booking's own transaction; with more, a block of IDs
+# is reserved once and handed out from memory (IDs are then unique but not
+# in booking order across server workers).
+ID_BLOCK_SIZE = int(os.environ.get('RESERVATIONS_ID_BLOCK_SIZE', 1))
+
+
+def db_reserve_ids(cursor, name, count):
+    '''
+    Function to take `count` consecutive IDs from a sequence.
+    Returns the first one.
+    '''
+    db_execute(cursor, 'reserve_ids', [count, name])
+    return cursor.fetchone()[0] - count
+
+
+class IdAllocator:
+    '''
+    Hands out unique IDs from a sequence of the `id_sequences` table,
+    `block_size` IDs at a time
+    '''
+
+    def __init__(self, name, block_size=1):
+        self.name = name
+        self.block_size = block_size
+        self._lock = threading.Lock()
+        self._next_id = 0
+        self._end_id = 0
+
+    def allocate(self, cursor=None):
+        '''
+        Returns a new ID. If `cursor` is given, a new block is reserved inside
+        the cursor's transaction (which may already hold the write lock), and
+        the rest of the block is only handed out once that transaction is
+        committed.
+        '''
+        with self._lock:
+            if self._next_id < self._end_id:
+                new_id = self._next_id
+                self._next_id += 1
+                return new_id
+
+            if cursor is None:
+                # Reserve a new block in its own transaction
+                with get_db_transaction() as block_cursor:
+                    self._next_id = db_reserve_ids(block_cursor, self.name, self.block_size)
+                self._end_id = self._next_id + self.block_size
+                new_id = self._next_id
+                self._next_id += 1
+                return new_id
+
+        first_id = db_reserve_ids(cursor, self.name, self.block_size)
+        if self.block_size > 1:
+            cursor.after_commit.append(lambda: self._keep_block(first_id + 1, first_id + self.block_size))
+        return first_id
+
+    def _keep_block(self, next_id, end_id):
+        # A block reserved inside a committed transaction: its IDs are used
+        # unless another block was kept meanwhile (the rest are then skipped)
+        with self._lock:
+            if self._next_id >= self._end_id:
+                self._next_id = next_id
+                self._end_id = end_id
+
+    def reset(self):
+        '''
+        Forgets the IDs left in the current block
+        '''
+        with self._lock:
+            self._next_id = 0
+            self._end_id = 0
+
+
+RESERVATION_IDS = IdAllocator('reservations', ID_BLOCK_SIZE)
+
+
+def db_allocate_reservation_id(cursor=None):
+    '''
+    Function to get a new, unique reservation ID
+    '''
+    return RESERVATION_IDS.allocate(cursor)
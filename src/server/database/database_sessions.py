@@ -0,0 +1,39 @@
+# Function to interact with database:
+# specifically the `revoked_tokens` table
+# which contains session tokens revoked before they expire (logouts)
+#
+# Fabrizio Giovannini Filho, Yuxin Guan, Lynnette Jiang, Jared McKeon, Fandi Meng
+
+from database.database_helpers import *
+
+
+def db_revoke_token(token_id, expires_at):
+    '''
+    Function to add a session token to the revocation list, dropping the
+    tokens of the list that have expired since
+    '''
+    # Connect to database
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+
+        # Expired tokens are rejected anyway
+        db_execute(cursor, 'delete_expired_tokens')
+
+        # Execute insert query
+        db_execute(cursor, 'revoke_token', [token_id, expires_at])
+
+
+def db_get_revoked_tokens(now):
+    '''
+    Function to get the IDs of revoked tokens that have not expired yet at
+    `now` (a Unix timestamp)
+    '''
+    # Connect to database
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+
+        # Execute query
+        db_execute(cursor, 'revoked_tokens', [now])
+        revoked = cursor.fetchall()
+
+    return {row['token_id'] for row in revoked}
@@ -0,0 +1,54 @@
+# Function to interact with database:
+# specifically the `settings` table
+# which contains server settings shared by every server process
+#
+# Fabrizio Giovannini Filho, Yuxin Guan, Lynnette Jiang, Jared McKeon, Fandi Meng
+
+from database.database_helpers import *
+
+
+def db_get_setting(name, default=None):
+    '''
+    Function to get the value of a setting, or `default` if it is not set
+    '''
+    # Connect to database
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+
+        # Execute query
+        db_execute(cursor, 'get_setting', [name])
+        setting = cursor.fetchone()
+
+    if setting:
+        return setting['value']
+    else:
+        return default
+
+
+def db_set_setting(name, value):
+    '''
+    Function to set the value of a setting
+    '''
+    # Connect to database
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+
+        # Execute upsert query
+        db_execute(cursor, 'set_setting', [name, value])
+
+
+def db_get_or_add_setting(name, value):
+    '''
+    Function to get the value of a setting, setting it to `value` first if
+    it is not set yet (so concurrent callers all get the same value)
+    '''
+    # Connect to database
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+
+        # Keep the first value that was stored
+        db_execute(cursor, 'add_setting_if_missing', [name, value])
+        db_execute(cursor, 'get_setting', [name])
+        setting = cursor.fetchone()
+
+    return setting['value']
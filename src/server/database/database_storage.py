@@ -0,0 +1,142 @@
+# Storage settings of the SQLite database:
+# the journal mode and other pragmas set on every new connection (configured
+# with environment variables) and a background thread that checkpoints the
+# write-ahead log on a schedule
+#
+# Fabrizio Giovannini Filho, Yuxin Guan, Lynnette Jiang, Jared McKeon, Fandi Meng
+
+import os, sqlite3, threading, time
+
+# Allowed values of the pragmas that take a keyword
+PRAGMA_CHOICES = {
+    'journal_mode': ('DELETE', 'TRUNCATE', 'PERSIST', 'MEMORY', 'WAL', 'OFF'),
+    'synchronous': ('OFF', 'NORMAL', 'FULL', 'EXTRA'),
+    'temp_store': ('DEFAULT', 'FILE', 'MEMORY'),
+}
+CHECKPOINT_MODES = ('PASSIVE', 'FULL', 'RESTART', 'TRUNCATE')
+
+
+def get_pragma(name, default):
+    '''
+    Returns the value of a pragma from the RESERVATIONS_DB_<NAME> environment
+    variable, or `default`. Keyword values are checked against PRAGMA_CHOICES,
+    other values must be integers.
+    '''
+    value = os.environ.get('RESERVATIONS_DB_' + name.upper(), default)
+    if name in PRAGMA_CHOICES:
+        value = str(value).upper()
+        if value not in PRAGMA_CHOICES[name]:
+            raise ValueError(f"RESERVATIONS_DB_{name.upper()} must be one of "
+                f"{', '.join(PRAGMA_CHOICES[name])}, not '{value}'.")
+        return value
+    return int(value)
+
+
+# WAL lets readers go on while a booking writes, and with synchronous=NORMAL
+# a commit only appends to the log (durable once checkpointed). A negative
+# cache_size is in KiB; mmap_size and busy_timeout are in bytes and ms.
+PRAGMAS = {
+    'journal_mode': get_pragma('journal_mode', 'WAL'),
+    'synchronous': get_pragma('synchronous', 'NORMAL'),
+    'cache_size': get_pragma('cache_size', -16000),
+    'mmap_size': get_pragma('mmap_size', 64 * 1024 * 1024),
+    'temp_store': get_pragma('temp_store', 'MEMORY'),
+    'busy_timeout': get_pragma('busy_timeout', 30000),
+}
+
+# Seconds between checkpoints of the write-ahead log (0 to turn them off)
+CHECKPOINT_INTERVAL = float(os.environ.get('RESERVATIONS_DB_CHECKPOINT_INTERVAL', 60))
+CHECKPOINT_MODE = os.environ.get('RESERVATIONS_DB_CHECKPOINT_MODE', 'PASSIVE').upper()
+
+
+def apply_pragmas(conn, pragmas=PRAGMAS):
+    '''
+    Sets the storage pragmas on a connection
+    '''
+    for name, value in pragmas.items():
+        # Pragma values cannot be bound as parameters; they were checked above
+        conn.execute(f"PRAGMA {name} = {value}").fetchall()
+
+
+def get_pragmas(conn):
+    '''
+    Returns the current value of the storage pragmas of a connection
+    '''
+    return {name: conn.execute(f"PRAGMA {name}").fetchone()[0] for name in PRAGMAS}
+
+
+class CheckpointScheduler:
+    '''
+    Background thread that checkpoints the write-ahead log every `interval`
+    seconds, so the log does not grow and the checkpoint work is not done by
+    the commit of a request. `get_connection` is a context manager giving a
+    connection to the database (e.g. get_db_connection).
+    '''
+
+    def __init__(self, get_connection, interval=CHECKPOINT_INTERVAL, mode=CHECKPOINT_MODE):
+        if mode not in CHECKPOINT_MODES:
+            raise ValueError(f"Checkpoint mode must be one of {', '.join(CHECKPOINT_MODES)}, not '{mode}'.")
+        self.get_connection = get_connection
+        self.interval = interval
+        self.mode = mode
+        self._stop = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+        self._stats = {'checkpoints': 0, 'errors': 0, 'last_checkpoint': None,
+            'last_result': None, 'last_error': None}
+
+    def checkpoint(self):
+        '''
+        Checkpoints the write-ahead log once. Returns (busy, log pages,
+        checkpointed pages) as given by PRAGMA wal_checkpoint.
+        '''
+        try:
+            with self.get_connection() as conn:
+                result = tuple(conn.execute(f"PRAGMA wal_checkpoint({self.mode})").fetchone())
+        except sqlite3.Error as error:
+            with self._lock:
+                self._stats['errors'] += 1
+                self._stats['last_error'] = str(error)
+            return None
+
+        with self._lock:
+            self._stats['checkpoints'] += 1
+            self._stats['last_checkpoint'] = time.time()
+            self._stats['last_result'] = result
+        return result
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.checkpoint()
+
+    def start(self):
+        '''
+        Starts the background thread (does nothing if the interval is 0 or
+        it is already running)
+        '''
+        if self.interval <= 0 or (self._thread and self._thread.is_alive()):
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='wal-checkpoint', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        '''
+        Stops the background thread and checkpoints one last time
+        '''
+        if self._thread:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+            self.checkpoint()
+
+    def stats(self):
+        '''
+        Returns the number of checkpoints and errors and the last result
+        '''
+        with self._lock:
+            stats = dict(self._stats)
+        stats['running'] = bool(self._thread and self._thread.is_alive())
+        stats['interval'] = self.interval
+        stats['mode'] = self.mode
+        return stats
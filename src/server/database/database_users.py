@@ -4,7 +4,6 @@
 #
 # Fabrizio Giovannini Filho, Yuxin Guan, Lynnette Jiang, Jared McKeon, Fandi Meng
 
-import hashlib
 from database.database_helpers import *
 
 
@@ -15,17 +14,17 @@ def db_user_exists(user_id):
     Output: returns True if the user exists, False otherwise
     '''
     # Connect to database
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
-    # Execute insert query
-    cursor.execute(f"SELECT * FROM users WHERE user_id = '{user_id}'")
-
-    # if a row returns from query, the user is valid
-    if cursor.fetchone():
-        return True
-    else:
-        return False
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+
+        # Execute insert query
+        db_execute(cursor, 'get_user', [user_id])
+
+        # if a row returns from query, the user is valid
+        if cursor.fetchone():
+            return True
+        else:
+            return False
 
 def db_validate_user(user_id, password):
     '''
@@ -33,25 +32,32 @@ def db_validate_user(user_id, password):
     Input: user_id
     Output: returns True if the user is a valid user, False otherwise
     '''
+    return db_check_password(db_get_user(user_id), password)
+
+
+def db_get_user(user_id, cursor=None):
+    '''
+    Function to get a user's row (role, balance, active, salt and hash)
+    Output: the user, or None if the user does not exist
+    '''
     # Connect to database
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
-    # Execute insert query
-    cursor.execute(f"SELECT * FROM users WHERE user_id = '{user_id}'")
-
-    # if a row returns from query, the user is valid
-    user = cursor.fetchone()
+    with get_db_cursor(cursor) as cursor:
+        # Execute query
+        db_execute(cursor, 'get_user', [user_id])
+        user = cursor.fetchone()
+
+    return user
+
+
+def db_check_password(user, password):
+    '''
+    Function to check a password against a user's row from db_get_user
+    '''
     hash = user["hash"]
     salt = user["salt"]
 
     # Create hash to validate user
-    new_hash = hashlib.pbkdf2_hmac(
-        hash_name='sha256',
-        password=password.encode('utf-8'),
-        salt=salt,
-        iterations=100000
-    )
+    new_hash = hash_password(password, salt)
 
     return new_hash == hash
 
@@ -62,56 +68,50 @@ def db_get_user_role(user_id):
     to know if user is scheduler, admin, client, or remote manager 
     '''
     # Connect to database
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
-    # Execute insert query
-    cursor.execute(f"SELECT * FROM users WHERE user_id = '{user_id}'")
-
-    # get the role from the one and only result
-    role = cursor.fetchone()["role"]
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+
+        # Execute insert query
+        db_execute(cursor, 'get_user', [user_id])
+
+        # get the role from the one and only result
+        role = cursor.fetchone()["role"]
     return role
 
 
-def db_show_users():
+def db_iter_users(role=None):
     '''
-    Function to retrieve all users in the system and their respective roles
+    Function to get all users (or only users with a role), one row at a time
     '''
-    # Connect to database
-    conn = get_db_connection()
-    cursor = conn.cursor()
+    if role:
+        return db_iterate('users_with_role', [role])
+    else:
+        return db_iterate('all_users')
 
-    # Execute query and fetch all users
-    cursor.execute(f"SELECT * FROM users")
-    results = cursor.fetchall()
 
-    return results
+def db_show_users():
+    '''
+    Function to retrieve all users in the system and their respective roles
+    '''
+    return list(db_iter_users())
 
 def db_show_clients():
     '''
     Function to retrieve only clients in the system and their roles and balances
     '''
-    # Connect to database
-    conn = get_db_connection()
-    cursor = conn.cursor()
-
-    # Execute query and fetch all results
-    cursor.execute(f"SELECT * FROM users WHERE role = 'client'")
-    results = cursor.fetchall()
-
-    return results
+    return list(db_iter_users('client'))
 
 def db_show_client(user_id):
     '''
     Function to retrieve only clients in the system and their roles and balances
     '''
     # Connect to database
-    conn = get_db_connection()
-    cursor = conn.cursor()
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
 
-    # Execute query and fetch one result
-    cursor.execute(f"SELECT * FROM users WHERE user_id = '{user_id}'")
-    results = cursor.fetchone()
+        # Execute query and fetch one result
+        db_execute(cursor, 'get_user', [user_id])
+        results = cursor.fetchone()
 
     return results
 
@@ -121,12 +121,12 @@ def db_count_admins():
     Function to check how many admins exist, need at least 1 
     '''
     # Connect to database
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
-    # Count admin query
-    cursor.execute(f"SELECT Count() FROM users WHERE role = 'admin'")
-    admins = cursor.fetchone()[0]
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+
+        # Count admin query
+        db_execute(cursor, 'count_users_with_role', ['admin'])
+        admins = cursor.fetchone()[0]
 
     return admins
 
@@ -136,16 +136,11 @@ def db_add_user(user_id, role, salt, hash):
     Function to add a user to the database
     '''
     # Connect to database
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
-    # Execute insert query
-    cursor.execute(f"INSERT INTO users VALUES (?, ?, ?, ?, ?, ?)", 
-        [user_id, role, 0, 'yes', salt, hash])
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
 
-    # Commit and close
-    conn.commit()
-    conn.close()
+        # Execute insert query
+        db_execute(cursor, 'add_user', [user_id, role, 0, 'yes', salt, hash])
 
 
 def db_remove_user(user_id):
@@ -153,15 +148,11 @@ def db_remove_user(user_id):
     Function to delete a user from the database
     '''
     # Connect to database
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
-    # Execute remove query
-    cursor.execute(f"DELETE FROM users WHERE user_id = '{user_id}'")
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
 
-    # Commit and close
-    conn.commit()
-    conn.close()
+        # Execute remove query
+        db_execute(cursor, 'remove_user', [user_id])
 
 
 def db_update_user_role(user_id, role):
@@ -169,61 +160,46 @@ def db_update_user_role(user_id, role):
     Function to update a user's role to the database
     '''
     # Connect to database
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
-    # Execute insert query
-    cursor.execute(f"UPDATE users SET role = '{role}' WHERE user_id = '{user_id}'")
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
 
-    # Commit and close
-    conn.commit()
-    conn.close()
+        # Execute insert query
+        db_execute(cursor, 'set_user_role', [role, user_id])
 
 def db_update_user_password(user_id, salt, hash):
     '''
     Function to update a user's password to the database
     '''
     # Connect to database
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
-    # Execute insert query
-    cursor.execute(f"UPDATE users SET salt = ?, hash = ? WHERE user_id = '{user_id}'", [salt, hash])
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
 
-    # Commit and close
-    conn.commit()
-    conn.close()
+        # Execute insert query
+        db_execute(cursor, 'set_user_password', [salt, hash, user_id])
 
 def db_update_user_id(user_id, new_user_id):
     '''
     Function to update a user's role to the database
     '''
     # Connect to database
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
-    # Execute insert query
-    cursor.execute(f"SELECT * FROM users WHERE user_id = '{user_id}'")
-    user = cursor.fetchone()
-    cursor.execute(f"INSERT INTO users VALUES (?, ?, ?, ?, ?, ?)", 
-        [new_user_id, user['role'], user['balance'], user['active'], user['salt'], user['hash']])
-    cursor.execute(f"DELETE FROM users WHERE user_id = '{user_id}'")
-
-    # Commit and close
-    conn.commit()
-    conn.close()
-
-def db_is_user_active(user_id):
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+
+        # Execute insert query
+        db_execute(cursor, 'get_user', [user_id])
+        user = cursor.fetchone()
+        db_execute(cursor, 'add_user', [new_user_id, user['role'], user['balance'], user['active'], user['salt'], user['hash']])
+        db_execute(cursor, 'remove_user', [user_id])
+
+def db_is_user_active(user_id, cursor=None):
     '''
     Function to check if a user is active
     '''
     # Connect to database
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
-    # Execute insert query
-    cursor.execute(f"SELECT * FROM users WHERE user_id = '{user_id}'")
-    active = cursor.fetchone()['active']
+    with get_db_cursor(cursor) as cursor:
+        # Execute insert query
+        db_execute(cursor, 'get_user', [user_id])
+        active = cursor.fetchone()['active']
 
     return active == "yes"
 
@@ -232,56 +208,44 @@ def db_activate_user(user_id):
     Function to activate a user
     '''
     # Connect to database
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
-    # Execute insert query
-    cursor.execute(f"UPDATE users SET active = 'yes' WHERE user_id = '{user_id}'")
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
 
-    conn.commit()
-    conn.close()
+        # Execute insert query
+        db_execute(cursor, 'set_user_active', ['yes', user_id])
 
 def db_deactivate_user(user_id):
     '''
     Function to deactivate a user
     '''
     # Connect to database
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
-    # Execute insert query
-    cursor.execute(f"UPDATE users SET active = 'no' WHERE user_id = '{user_id}'")
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
 
-    conn.commit()
-    conn.close()
+        # Execute insert query
+        db_execute(cursor, 'set_user_active', ['no', user_id])
 
-def db_get_balance(user_id):
+def db_get_balance(user_id, cursor=None):
     '''
     Function to get balance for a user's account
     '''
     # Connect to database
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
-    # Execute insert query
-    cursor.execute(f"SELECT * FROM users WHERE user_id = '{user_id}'")
-    balance = cursor.fetchone()['balance']
+    with get_db_cursor(cursor) as cursor:
+        # Execute insert query
+        db_execute(cursor, 'get_user', [user_id])
+        balance = cursor.fetchone()['balance']
 
     return balance
 
-def db_update_balance(user_id, amount):
+def db_update_balance(user_id, amount, cursor=None):
     '''
-    Function to add balance to a user's account
+    Function to add balance to a user's account (inside the transaction of
+    `cursor` if given)
     '''
     # Connect to database
-    conn = get_db_connection()
-    cursor = conn.cursor()
-
-    if int(amount) > 0:
-    # Execute insert query
-        cursor.execute(f"UPDATE users SET balance = balance + {amount} WHERE user_id = '{user_id}'")
-    else:
-        cursor.execute(f"UPDATE users SET balance = balance - {abs(amount)} WHERE user_id = '{user_id}'")
-
-    conn.commit()
-    conn.close()
\ No newline at end of file
+    with get_db_transaction(cursor) as cursor:
+        if int(amount) > 0:
+        # Execute insert query
+            db_execute(cursor, 'add_to_balance', [amount, user_id])
+        else:
+            db_execute(cursor, 'add_to_balance', [-abs(amount), user_id])
\ No newline at end of file
@@ -0,0 +1,25 @@
+-- Version token of the reservations table: changes (to a random value) on
+-- every insert, update or delete, so in-memory indexes can tell whether
+-- they are still in sync with the table
+CREATE TABLE IF NOT EXISTS reservations_version (
+	id integer NOT NULL CHECK (id = 0),
+	version integer NOT NULL,
+	primary key (id)
+	);
+
+INSERT OR IGNORE INTO reservations_version VALUES (0, random());
+
+CREATE TRIGGER IF NOT EXISTS reservations_version_insert AFTER INSERT ON reservations
+BEGIN
+	UPDATE reservations_version SET version = random();
+END;
+
+CREATE TRIGGER IF NOT EXISTS reservations_version_update AFTER UPDATE ON reservations
+BEGIN
+	UPDATE reservations_version SET version = random();
+END;
+
+CREATE TRIGGER IF NOT EXISTS reservations_version_delete AFTER DELETE ON reservations
+BEGIN
+	UPDATE reservations_version SET version = random();
+END;
@@ -0,0 +1,19 @@
+-- Next ID to hand out for each kind of ID, so new reservations don't need a
+-- MAX(reservation_id) over the whole table
+CREATE TABLE IF NOT EXISTS id_sequences (
+	name character varying(40) NOT NULL,
+	next_id integer NOT NULL,
+	primary key (name)
+	);
+
+INSERT OR IGNORE INTO id_sequences
+	SELECT 'reservations', COALESCE(MAX(reservation_id), 0) + 1 FROM reservations
+	WHERE typeof(reservation_id) = 'integer';
+
+-- Reservations inserted with an explicit ID move the sequence past that ID
+CREATE TRIGGER IF NOT EXISTS id_sequences_reservations AFTER INSERT ON reservations
+WHEN typeof(NEW.reservation_id) = 'integer'
+BEGIN
+	UPDATE id_sequences SET next_id = NEW.reservation_id + 1
+	WHERE name = 'reservations' AND next_id <= NEW.reservation_id;
+END;
@@ -0,0 +1,9 @@
+-- Server settings shared by every server process, e.g. whether clients
+-- may sign in ('client_sign_in' is 'yes' or 'no')
+CREATE TABLE IF NOT EXISTS settings (
+	name character varying(40) NOT NULL,
+	value character varying(40) NOT NULL,
+	primary key (name)
+	);
+
+INSERT OR IGNORE INTO settings VALUES ('client_sign_in', 'yes');
@@ -0,0 +1,7 @@
+-- Session tokens revoked before they expire (see session_functions.py).
+-- Rows can be deleted once expires_at (a Unix timestamp) has passed.
+CREATE TABLE IF NOT EXISTS revoked_tokens (
+	token_id character varying(40) NOT NULL,
+	expires_at REAL NOT NULL,
+	primary key (token_id)
+	);
@@ -0,0 +1,4 @@
+-- Covers the transaction columns of a user's transaction report, so it reads
+-- this index instead of scanning the whole transactions table
+CREATE INDEX IF NOT EXISTS transactions_user ON transactions
+	(user_id, reservation_id, transaction_type, transaction_amount, transaction_timestamp, transaction_id);
@@ -0,0 +1,17 @@
+-- Indexes for the filters of the hot queries, which otherwise scan the
+-- whole reservations or transactions table
+
+-- Reservations of a facility between dates, occupancy of a facility-day
+CREATE INDEX IF NOT EXISTS reservations_facility ON reservations (facility, status, reservation_date);
+
+-- Holds between dates (any facility)
+CREATE INDEX IF NOT EXISTS reservations_status ON reservations (status, reservation_date);
+
+-- Reservations of a client between dates
+CREATE INDEX IF NOT EXISTS reservations_client ON reservations (client_id, facility, status, reservation_date);
+
+-- Payment and refund of a reservation
+CREATE INDEX IF NOT EXISTS transactions_reservation ON transactions (reservation_id, transaction_type);
+
+-- Transactions between dates
+CREATE INDEX IF NOT EXISTS transactions_timestamp ON transactions (transaction_timestamp);
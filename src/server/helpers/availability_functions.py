@@ -0,0 +1,203 @@
+# Availability functions for reservations_API.py:
+# free windows of the machines within the booking horizon and the opening
+# hours, and the remaining capacity of every slot over a date range, computed
+# from the in-memory occupancy of each facility-day (see database_occupancy.py)
+# instead of trying bookings or querying one slot at a time
+#
+# Fabrizio Giovannini Filho, Yuxin Guan, Lynnette Jiang, Jared McKeon, Fandi Meng
+
+import base64, math
+from datetime import datetime, timedelta
+from fastapi import HTTPException
+import database.database_occupancy as database_occupancy
+
+# Bookings can be made up to this many days ahead
+BOOKING_HORIZON_DAYS = 30
+# Opening hours by weekday (Monday is 0): 9 to 18 on weekdays, 10 to 16 on
+# Saturday, closed on Sunday
+OPENING_HOURS = {0: (9, 18), 1: (9, 18), 2: (9, 18), 3: (9, 18), 4: (9, 18), 5: (10, 16)}
+# Most windows a search returns, and most days in a grid
+MAX_WINDOWS = 100
+MAX_GRID_DAYS = 92
+GRID_ENCODINGS = ('base64', 'json')
+
+# For each resource, the units left free (as a byte) for every number of
+# units in use, to turn a day's counters into remaining capacity with
+# bytes.translate
+REMAINING_TABLES = {resource: bytes(max(capacity - used, 0) for used in range(256))
+    for resource, capacity in database_occupancy.RESERVATION_CONSTRAINTS.items()}
+
+
+def parse_date(str_date, name):
+    '''
+    Reads a YYYY-MM-DD date given as a query parameter
+    '''
+    try:
+        return datetime.strptime(str_date, '%Y-%m-%d').date()
+    except ValueError:
+        raise HTTPException(
+            status_code=400,
+            detail=f"{name} must be a date as YYYY-MM-DD, not '{str_date}'."
+        )
+
+
+def check_resource(resource):
+    '''
+    Check that a resource is one of the machines that can be booked
+    '''
+    if resource not in database_occupancy.RESERVATION_CONSTRAINTS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Unknown resource '{resource}'. Resources are "
+                f"{', '.join(database_occupancy.RESOURCES)}."
+        )
+
+
+def get_booking_dates(start_date, end_date, today):
+    '''
+    Returns the dates from start_date to end_date that can be booked today
+    (from today up to BOOKING_HORIZON_DAYS ahead)
+    '''
+    if start_date > end_date:
+        raise HTTPException(
+            status_code=400,
+            detail='start_date must not be after end_date.'
+        )
+
+    first = max(start_date, today)
+    last = min(end_date, today + timedelta(days=BOOKING_HORIZON_DAYS))
+    return [first + timedelta(days=i) for i in range((last - first).days + 1)]
+
+
+def get_open_slots(reservation_date, earliest_time=None, latest_time=None, now=None):
+    '''
+    Returns the first and last (excluded) half-hour slot that can be booked
+    on a date: within opening hours, from earliest_time to latest_time if
+    given, and not before `now` on the same day. None if closed that day.
+    '''
+    hours = OPENING_HOURS.get(reservation_date.weekday())
+    if hours is None:
+        return None
+
+    opening, closing = hours
+    if earliest_time is not None:
+        opening = max(opening, earliest_time)
+    if latest_time is not None:
+        closing = min(closing, latest_time)
+    if now is not None and reservation_date == now.date():
+        opening = max(opening, now.hour + now.minute / 60 + now.second / 3600)
+
+    slot_length = database_occupancy.SLOT_LENGTH
+    first = math.ceil((opening - database_occupancy.OPENING_TIME) / slot_length)
+    last = math.floor((closing - database_occupancy.OPENING_TIME) / slot_length)
+    return first, last
+
+
+def get_slot_time(slot):
+    '''
+    Returns the time of day a half-hour slot starts
+    '''
+    return database_occupancy.OPENING_TIME + slot * database_occupancy.SLOT_LENGTH
+
+
+def search_availability(resource, duration, start_date=None, end_date=None, facility='facility1',
+    earliest_time=None, latest_time=None, limit=5, now=None):
+    '''
+    Finds the `limit` earliest windows of `duration` hours in which one
+    more `resource` can be booked, between start_date and end_date (as
+    YYYY-MM-DD, default today and BOOKING_HORIZON_DAYS later), inside
+    opening hours and, if given, starting at or after earliest_time and
+    ending by latest_time. The occupancy of every date is read from one
+    snapshot and each day is scanned once.
+    '''
+    now = now or datetime.now()
+    today = now.date()
+
+    check_resource(resource)
+    if duration <= 0 or not (duration / database_occupancy.SLOT_LENGTH).is_integer():
+        raise HTTPException(
+            status_code=400,
+            detail='duration must be a positive multiple of 0.5 hours.'
+        )
+    if not 1 <= limit <= MAX_WINDOWS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"limit must be between 1 and {MAX_WINDOWS}."
+        )
+    if earliest_time is not None and latest_time is not None and earliest_time >= latest_time:
+        raise HTTPException(
+            status_code=400,
+            detail='earliest_time must be before latest_time.'
+        )
+
+    start = parse_date(start_date, 'start_date') if start_date else today
+    end = parse_date(end_date, 'end_date') if end_date else max(start, today) + timedelta(days=BOOKING_HORIZON_DAYS)
+    dates = get_booking_dates(start, end, today)
+
+    length = int(duration / database_occupancy.SLOT_LENGTH)
+    days = database_occupancy.db_get_days_occupancy(facility, dates)
+
+    windows = []
+    for reservation_date, slots in zip(dates, days):
+        open_slots = get_open_slots(reservation_date, earliest_time, latest_time, now)
+        if open_slots is None:
+            continue
+        for slot in database_occupancy.get_free_windows(slots, resource, *open_slots, length):
+            windows.append({'date': reservation_date.isoformat(), 'start_time': get_slot_time(slot),
+                'end_time': get_slot_time(slot + length)})
+            if len(windows) == limit:
+                return {'data': windows}
+
+    return {'data': windows}
+
+
+def get_availability_grid(start_date, end_date, facility='facility1', encoding='base64'):
+    '''
+    Returns the units of every resource that can still be booked in every
+    half-hour slot from start_date to end_date (YYYY-MM-DD), 0 when closed.
+    With the base64 encoding, each resource has one base64 string of
+    len(dates) * slots_per_day bytes, date after date; with json, one list
+    of slots_per_day numbers per date. The occupancy of every date is read
+    from one snapshot.
+    '''
+    if encoding not in GRID_ENCODINGS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"encoding must be one of {', '.join(GRID_ENCODINGS)}."
+        )
+
+    start = parse_date(start_date, 'start_date')
+    end = parse_date(end_date, 'end_date')
+    if start > end or (end - start).days >= MAX_GRID_DAYS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"end_date must be from start_date to {MAX_GRID_DAYS - 1} days after it."
+        )
+    dates = [start + timedelta(days=i) for i in range((end - start).days + 1)]
+
+    slots_per_day = database_occupancy.SLOTS_PER_DAY
+    days = database_occupancy.db_get_days_occupancy(facility, dates)
+    open_slots = [get_open_slots(reservation_date) or (0, 0) for reservation_date in dates]
+
+    remaining = {}
+    for r, resource in enumerate(database_occupancy.RESOURCES):
+        offset = r * slots_per_day
+        grid = bytearray()
+        for slots, (first, last) in zip(days, open_slots):
+            day = slots[offset:offset + slots_per_day].tobytes().translate(REMAINING_TABLES[resource])
+            grid += bytes(first) + day[first:last] + bytes(slots_per_day - last)
+        if encoding == 'base64':
+            remaining[resource] = base64.b64encode(grid).decode('ascii')
+        else:
+            remaining[resource] = [list(grid[i:i + slots_per_day]) for i in range(0, len(grid), slots_per_day)]
+
+    return {'data': {
+        'facility': facility,
+        'dates': [reservation_date.isoformat() for reservation_date in dates],
+        'opening_time': database_occupancy.OPENING_TIME,
+        'slot_length': database_occupancy.SLOT_LENGTH,
+        'slots_per_day': slots_per_day,
+        'capacity': dict(database_occupancy.RESERVATION_CONSTRAINTS),
+        'encoding': encoding,
+        'remaining': remaining
+    }}
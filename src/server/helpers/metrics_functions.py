@@ -0,0 +1,89 @@
+# Request metrics for server.py:
+# middleware that times every request (until its last body chunk is sent,
+# so streamed reports count in full) and records, per route, the latency,
+# the SQL statements run and their time, and password hashing time. The
+# metrics are served by GET /metrics in the Prometheus text format.
+#
+# Fabrizio Giovannini Filho, Yuxin Guan, Lynnette Jiang, Jared McKeon, Fandi Meng
+
+import time
+from starlette.routing import Match
+from database.database_metrics import (Counter, Gauge, Histogram, RequestStats, REQUEST_STATS, render_metrics)
+
+# Content type of the Prometheus text format
+METRICS_CONTENT_TYPE = 'text/plain; version=0.0.4'
+# Route label of requests that match no endpoint (so unknown paths do not
+# add a new label value each)
+UNMATCHED_ROUTE = 'unmatched'
+
+HTTP_REQUESTS = Counter('reservations_http_requests_total', 'HTTP requests served.',
+    ['method', 'route', 'status'])
+HTTP_REQUEST_SECONDS = Histogram('reservations_http_request_duration_seconds',
+    'Seconds from receiving an HTTP request to sending the end of its response.', ['method', 'route'])
+HTTP_REQUESTS_IN_FLIGHT = Gauge('reservations_http_requests_in_flight', 'HTTP requests being served.')
+REQUEST_SQL_QUERIES = Histogram('reservations_http_request_sql_queries',
+    'SQL statements run per HTTP request.', ['method', 'route'], buckets=(0, 1, 2, 5, 10, 20, 50, 100, 500))
+REQUEST_SQL_SECONDS = Histogram('reservations_http_request_sql_seconds',
+    'Seconds spent running SQL statements per HTTP request.', ['method', 'route'],
+    buckets=(.0005, .001, .0025, .005, .01, .025, .05, .1, .25, 1))
+REQUEST_HASHING_SECONDS = Counter('reservations_http_request_password_hashing_seconds_total',
+    'Seconds spent hashing passwords (PBKDF2) while serving HTTP requests.', ['method', 'route'])
+
+
+def get_route(app, scope):
+    '''
+    Returns the path of the route a request matches (e.g.
+    /reservations/cancel/{reservation_id}), or UNMATCHED_ROUTE
+    '''
+    for route in app.router.routes:
+        match, _ = route.matches(scope)
+        if match == Match.FULL:
+            return route.path
+    return UNMATCHED_ROUTE
+
+
+class MetricsMiddleware:
+    '''
+    ASGI middleware recording the metrics of every HTTP request
+    '''
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
+        stats = RequestStats()
+        token = REQUEST_STATS.set(stats)
+        status = [500]
+
+        async def send_and_record_status(message):
+            if message['type'] == 'http.response.start':
+                status[0] = message['status']
+            await send(message)
+
+        HTTP_REQUESTS_IN_FLIGHT.inc()
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_and_record_status)
+        finally:
+            elapsed = time.perf_counter() - start
+            HTTP_REQUESTS_IN_FLIGHT.dec()
+            REQUEST_STATS.reset(token)
+
+            labels = {'method': scope['method'], 'route': get_route(scope['app'], scope)}
+            HTTP_REQUESTS.inc(status=str(status[0]), **labels)
+            HTTP_REQUEST_SECONDS.observe(elapsed, **labels)
+            REQUEST_SQL_QUERIES.observe(stats.sql_queries, **labels)
+            REQUEST_SQL_SECONDS.observe(stats.sql_seconds, **labels)
+            if stats.hashing_seconds:
+                REQUEST_HASHING_SECONDS.inc(stats.hashing_seconds, **labels)
+
+
+def get_metrics():
+    '''
+    Returns every metric of this server process in the Prometheus text format
+    '''
+    return render_metrics()
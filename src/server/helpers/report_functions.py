@@ -0,0 +1,109 @@
+# Report functions for reservations_API.py:
+# reports are rendered row by row from generators, so they can be joined into
+# one string in linear time or streamed to the client as text, CSV or JSON
+# lines without holding the whole report in memory
+#
+# Fabrizio Giovannini Filho, Yuxin Guan, Lynnette Jiang, Jared McKeon, Fandi Meng
+
+import csv, json
+from fastapi import HTTPException
+from fastapi.responses import StreamingResponse
+
+# Streamed report formats and their media types ('json' is the usual
+# {'data': report} response)
+REPORT_FORMATS = {
+    'text': 'text/plain',
+    'csv': 'text/csv',
+    'jsonl': 'application/x-ndjson'
+}
+
+# Characters sent to the client at a time
+CHUNK_SIZE = 64 * 1024
+
+
+class LineBuffer:
+    '''
+    File-like object for csv.writer that returns each line instead of storing it
+    '''
+
+    def write(self, line):
+        return line
+
+
+def text_lines(header, rows, render_row):
+    '''
+    Yields the header and then each row rendered as text
+    '''
+    yield header
+    for row in rows:
+        yield render_row(row)
+
+
+def csv_lines(rows, columns):
+    '''
+    Yields a CSV header line and then one line per row
+    '''
+    writer = csv.writer(LineBuffer())
+    yield writer.writerow(columns)
+    for row in rows:
+        yield writer.writerow([row[column] for column in columns])
+
+
+def jsonl_lines(rows, columns):
+    '''
+    Yields one JSON object per row, one per line
+    '''
+    for row in rows:
+        yield json.dumps({column: row[column] for column in columns}) + '\n'
+
+
+def chunks(lines, size=CHUNK_SIZE):
+    '''
+    Groups lines into chunks of about `size` characters
+    '''
+    chunk = []
+    length = 0
+    for line in lines:
+        chunk.append(line)
+        length += len(line)
+        if length >= size:
+            yield ''.join(chunk)
+            chunk = []
+            length = 0
+    if chunk:
+        yield ''.join(chunk)
+
+
+def render_text(header, rows, render_row):
+    '''
+    Returns the whole text report as one string
+    '''
+    return ''.join(text_lines(header, rows, render_row))
+
+
+def check_report_format(report_format):
+    '''
+    Checks that a report can be given in `report_format`.
+    '''
+    if report_format != 'json' and report_format not in REPORT_FORMATS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Report format must be one of json, {', '.join(REPORT_FORMATS)}."
+        )
+
+    return True
+
+
+def stream_report(report_format, header, rows, render_row, columns):
+    '''
+    Returns a StreamingResponse that sends the report in `report_format`
+    (text, csv or jsonl) while `rows` are read
+    '''
+    if report_format == 'text':
+        lines = text_lines(header, rows, render_row)
+    elif report_format == 'csv':
+        lines = csv_lines(rows, columns)
+    else:
+        lines = jsonl_lines(rows, columns)
+
+    return StreamingResponse(chunks(lines), media_type=REPORT_FORMATS[report_format])
@@ -2,25 +2,15 @@
 #
 # Fabrizio Giovannini Filho, Yuxin Guan, Lynnette Jiang, Jared McKeon, Fandi Meng
 
+from collections import defaultdict
 from datetime import date, timedelta, datetime
 import json, os
 from fastapi import HTTPException
 import database.database_reservations as database_reservations
 import database.database_users as database_users
-
-def get_booked_machines(str_reservation_date, reservation_time):
-    '''
-    Determines machines booked at a date and reservation time.
-    Returns the list of machines reserved for that date and time
-    '''
-
-    # Get current filled slots on this date:
-    current_reservations = database_reservations.db_get_reservations_for_date_and_time(str_reservation_date, reservation_time)
-    # Convert resources booked into list
-    booked_machines = [res['resource'] for res in current_reservations]
-                
-    return booked_machines
-
+import database.database_occupancy as database_occupancy
+import helpers.report_functions as report_functions
+import helpers.availability_functions as availability_functions
 
 def calculate_booking_costs(reservation_date, reservation_item, duration):
     '''
@@ -46,11 +36,11 @@ def calculate_booking_costs(reservation_date, reservation_item, duration):
     
     return payment_amount
 
-def check_active_user(user_id):
+def check_active_user(user_id, cursor=None):
     '''
     Check if user is active.
     '''
-    active = database_users.db_is_user_active(user_id)
+    active = database_users.db_is_user_active(user_id, cursor)
 
     if not active:
         raise HTTPException(
@@ -60,13 +50,13 @@ def check_active_user(user_id):
 
     return active
 
-def check_sufficient_balance(reservation_date, reservation_item, duration, user_id):
+def check_sufficient_balance(reservation_date, reservation_item, duration, user_id, cursor=None):
     '''
     Check if user has sufficient balance in account to cover the down payment.
     '''
 
     cost = calculate_booking_costs(reservation_date, reservation_item, duration)
-    balance = database_users.db_get_balance(user_id)
+    balance = database_users.db_get_balance(user_id, cursor)
 
     if balance >= cost:
         return True
@@ -76,25 +66,18 @@ def check_sufficient_balance(reservation_date, reservation_item, duration, user_
             detail= f'Insufficient balance. Cost is {cost} and balance is {balance} and the user ID is {user_id}'
         )
 
-def check_machine_availability(str_reservation_date, reservation_time, reservation_item):
+def check_machine_availability(str_reservation_date, reservation_time, reservation_item, duration, facility,
+    cursor=None):
     '''
-    Check if there is availability on the machine requested
+    Check if there is availability on the machine requested for the whole
+    window from reservation_time to reservation_time + duration
     '''
 
-    # Get current filled slots on this date:
-    current_reservations = get_booked_machines(str_reservation_date, reservation_time)
-
-    # Each machine has own reservation constraint:
-    d_reservation_constraints = {
-        "workshop": 4,
-        "microvac": 2,
-        "irradiator": 2,
-        "extruder": 2,
-        "crusher": 1,
-        "harvester": 1
-    }
+    # One more machine has to fit in every half-hour slot of the window
+    machine_available = database_occupancy.db_window_fits(facility, str_reservation_date,
+        reservation_item, reservation_time, reservation_time + duration, cursor=cursor)
 
-    if current_reservations.count(reservation_item) < d_reservation_constraints[reservation_item]:
+    if machine_available:
         return True
     # If machines are booked
     else:
@@ -104,22 +87,25 @@ def check_machine_availability(str_reservation_date, reservation_time, reservati
         )
 
 
-def check_booking_requirements(user_id, reservation_date, reservation_item, duration, str_reservation_date, reservation_time):
+def check_booking_requirements(user_id, reservation_date, reservation_item, duration, str_reservation_date, reservation_time,
+    facility, cursor=None):
     '''
     Check if reservation request meets all booking requirements.
     '''
-    user_active = check_active_user(user_id)
-    sufficient_balance = check_sufficient_balance(reservation_date, reservation_item, duration, user_id)
-    machine_available = check_machine_availability(str_reservation_date, reservation_time, reservation_item)
+    user_active = check_active_user(user_id, cursor)
+    sufficient_balance = check_sufficient_balance(reservation_date, reservation_item, duration, user_id, cursor)
+    machine_available = check_machine_availability(str_reservation_date, reservation_time, reservation_item,
+        duration, facility, cursor)
 
     return user_active and sufficient_balance and machine_available
 
 
 def add_reservation_to_db(user_id, reservation_date, reservation_id, facility, reservation_item,
-    client_id, reservation_time, duration, status):
+    client_id, reservation_time, duration, status, cursor=None):
     '''
     Add valid reservation to dictionary of reservations.
-    Returns the updated dictionary.
+    The reservation, balance update and payment are written in one
+    transaction (the one of `cursor` if given).
     '''
 
     # Calculate payment amount
@@ -128,18 +114,19 @@ def add_reservation_to_db(user_id, reservation_date, reservation_id, facility, r
     # Calculate end time
     end_time = reservation_time + duration
 
-    # Add reservation to DB
-    database_reservations.db_add_reservation(reservation_id, facility, 0, reservation_date, reservation_item, 
-        client_id, reservation_time, end_time, status)
+    with database_occupancy.db_reservations_transaction(cursor) as cursor:
+        # Add reservation to DB
+        database_reservations.db_add_reservation(reservation_id, facility, 0, reservation_date, reservation_item, 
+            client_id, reservation_time, end_time, status, cursor)
 
-    if status == 'on':
-        #Deduct reservation cost from client balance - only for reservations and validated users
-        database_users.db_update_balance(user_id, -payment_amount)
+        if status == 'on':
+            #Deduct reservation cost from client balance - only for reservations and validated users
+            database_users.db_update_balance(user_id, -payment_amount, cursor)
 
-        # Add payment transaction - only for reservations
-        transaction_id = str(reservation_id) + '-t1'
-        database_reservations.db_add_transaction(transaction_id, 'payment', payment_amount,
-            datetime.now(), user_id, reservation_id)
+            # Add payment transaction - only for reservations
+            transaction_id = str(reservation_id) + '-t1'
+            database_reservations.db_add_transaction(transaction_id, 'payment', payment_amount,
+                datetime.now(), user_id, reservation_id, cursor)
 
 
 def make_reservation(reservation_request):
@@ -158,15 +145,22 @@ def make_reservation(reservation_request):
     duration = reservation_request.duration
     status = 'on'
 
-    valid_reservation = check_booking_requirements(user_id, reservation_date, reservation_item, duration,
-                                                   str_reservation_date, reservation_time)
-    if valid_reservation:
-        # Make unique reservation id
-        reservation_id = database_reservations.db_get_latest_id() + 1
-        # Add to reservations database
-        add_reservation_to_db(user_id, reservation_date, reservation_id, facility,
-            reservation_item, client_id, reservation_time, duration, status)
+    # Cheap check first, so requests for a booked machine do not queue for the lock
+    check_machine_availability(str_reservation_date, reservation_time, reservation_item, duration, facility)
+
+    # Check and book in one write transaction, one booking of the machine at a time
+    with database_occupancy.resource_lock(facility, str_reservation_date, reservation_item), \
+        database_occupancy.db_reservations_transaction() as cursor:
+        valid_reservation = check_booking_requirements(user_id, reservation_date, reservation_item, duration,
+                                                       str_reservation_date, reservation_time, facility, cursor)
+        if valid_reservation:
+            # Make unique reservation id
+            reservation_id = database_reservations.db_allocate_reservation_id(cursor)
+            # Add to reservations database
+            add_reservation_to_db(user_id, reservation_date, reservation_id, facility,
+                reservation_item, client_id, reservation_time, duration, status, cursor)
 
+    if valid_reservation:
         return {'message': 'Reservation was successful! ',
                  'reservation_id': reservation_id}
     else:
@@ -192,16 +186,23 @@ def make_hold(hold_request):
     duration = hold_request.duration
     status = 'hold'
 
-    valid_hold = check_machine_availability(str_hold_date, hold_time,
-        hold_item)
+    # Cheap check first, so requests for a booked machine do not queue for the lock
+    check_machine_availability(str_hold_date, hold_time, hold_item, duration, facility)
 
-    if valid_hold:
-        # Make unique reservation id
-        reservation_id = database_reservations.db_get_latest_id() + 1
-        # Add to reservations database
-        add_reservation_to_db(user_id, hold_date, reservation_id, facility,
-            hold_item, client_id, hold_time, duration, status)
+    # Check and hold in one write transaction, one booking of the machine at a time
+    with database_occupancy.resource_lock(facility, str_hold_date, hold_item), \
+        database_occupancy.db_reservations_transaction() as cursor:
+        valid_hold = check_machine_availability(str_hold_date, hold_time,
+            hold_item, duration, facility, cursor)
+
+        if valid_hold:
+            # Make unique reservation id
+            reservation_id = database_reservations.db_allocate_reservation_id(cursor)
+            # Add to reservations database
+            add_reservation_to_db(user_id, hold_date, reservation_id, facility,
+                hold_item, client_id, hold_time, duration, status, cursor)
 
+    if valid_hold:
         return { 'message': 'Hold was successful! ',
                  'reservation_id': reservation_id}
     else:
@@ -211,21 +212,279 @@ def make_hold(hold_request):
             )
 
 
+# Days between the occurrences of a recurring reservation, and how a series
+# with occurrences that cannot be booked is handled: all_or_nothing books
+# none of them, best_effort books the others
+RECURRING_FREQUENCIES = {'daily': 1, 'weekly': 7}
+RECURRING_MODES = ('all_or_nothing', 'best_effort')
+MAX_OCCURRENCES = 52
+
+
+def get_occurrence_dates(first_date, frequency, occurrences):
+    '''
+    Returns the dates of the occurrences of a recurring reservation
+    '''
+    step = timedelta(days=RECURRING_FREQUENCIES[frequency])
+    return [first_date + i * step for i in range(occurrences)]
+
+
+def is_open(reservation_date, start_time, end_time):
+    '''
+    Check if a window is within the opening hours of a date
+    '''
+    hours = availability_functions.OPENING_HOURS.get(reservation_date.weekday())
+    return hours is not None and hours[0] <= start_time and end_time <= hours[1]
+
+
+def check_booking_time(reservation_time, duration):
+    '''
+    Check that a booking starts on the hour or half hour and lasts a
+    positive number of half hours
+    '''
+    slot_length = database_occupancy.SLOT_LENGTH
+    if duration <= 0 or not (duration / slot_length).is_integer():
+        raise HTTPException(
+            status_code=400,
+            detail='duration must be a positive multiple of 0.5 hours.'
+        )
+    if not (reservation_time / slot_length).is_integer():
+        raise HTTPException(
+            status_code=400,
+            detail='reservation_time must be on the hour or half hour.'
+        )
+
+
+def make_recurring_reservation(recurring_request):
+    '''
+    Make a daily or weekly series of reservations given a
+    RecurringReservationRequest. The occurrences share one reservation ID
+    (recurring_number 0, 1, ...), are checked against one snapshot of the
+    occupancy, paid with one balance update and payment, and inserted with
+    one statement, all in one transaction.
+    '''
+
+    # Get details from reservation request
+    facility = recurring_request.facility
+    user_id = recurring_request.reservation_client_id
+    reservation_time = recurring_request.reservation_time
+    reservation_item = recurring_request.reservation_item
+    client_id = recurring_request.reservation_client_id
+    duration = recurring_request.duration
+    end_time = reservation_time + duration
+
+    if reservation_item not in database_occupancy.RESERVATION_CONSTRAINTS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Unknown resource '{reservation_item}'."
+        )
+    check_booking_time(reservation_time, duration)
+    if recurring_request.frequency not in RECURRING_FREQUENCIES:
+        raise HTTPException(
+            status_code=400,
+            detail=f"frequency must be one of {', '.join(RECURRING_FREQUENCIES)}."
+        )
+    if recurring_request.mode not in RECURRING_MODES:
+        raise HTTPException(
+            status_code=400,
+            detail=f"mode must be one of {', '.join(RECURRING_MODES)}."
+        )
+    if not 1 <= recurring_request.occurrences <= MAX_OCCURRENCES:
+        raise HTTPException(
+            status_code=400,
+            detail=f"occurrences must be between 1 and {MAX_OCCURRENCES}."
+        )
+
+    try:
+        first_date = datetime.strptime(recurring_request.reservation_date, '%Y-%m-%d').date()
+    except ValueError:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Invalid reservation date '{recurring_request.reservation_date}', use YYYY-MM-DD."
+        )
+    dates = get_occurrence_dates(first_date, recurring_request.frequency, recurring_request.occurrences)
+
+    # Check and book every occurrence in one write transaction
+    with database_occupancy.resource_locks((facility, reservation_date, reservation_item)
+        for reservation_date in dates), \
+        database_occupancy.db_reservations_transaction() as cursor:
+        user = database_users.db_get_user(user_id, cursor)
+        if user is None or user['active'] != 'yes':
+            raise HTTPException(
+                status_code=400,
+                detail=f"{user_id} is not an active user."
+            )
+
+        # Occupancy of every date, from the same snapshot
+        days = database_occupancy.db_get_days_occupancy(facility, dates, cursor)
+        booked, skipped = [], []
+        for recurring_number, (reservation_date, slots) in enumerate(zip(dates, days)):
+            if not is_open(reservation_date, reservation_time, end_time):
+                reason = 'Closed at that time.'
+            elif not database_occupancy.DayOccupancy(slots).fits(reservation_item, reservation_time, end_time):
+                reason = 'Machine booked for that time.'
+            else:
+                booked.append((recurring_number, reservation_date))
+                continue
+            skipped.append({'recurring_number': recurring_number, 'reservation_date': reservation_date.isoformat(),
+                'reason': reason})
+
+        if not booked or (skipped and recurring_request.mode == 'all_or_nothing'):
+            raise HTTPException(
+                status_code=400,
+                detail='Occurrences that cannot be booked: ' + ', '.join(
+                    f"{occurrence['reservation_date']} ({occurrence['reason']})" for occurrence in skipped)
+            )
+
+        # One payment for the whole series
+        cost = sum(calculate_booking_costs(reservation_date, reservation_item, duration)
+            for _, reservation_date in booked)
+        balance = database_users.db_get_balance(user_id, cursor)
+        if balance < cost:
+            raise HTTPException(
+                status_code=400,
+                detail=f'Insufficient balance. Cost is {cost} and balance is {balance} and the user ID is {user_id}'
+            )
+
+        reservation_id = database_reservations.db_allocate_reservation_id(cursor)
+        database_reservations.db_add_reservations([[reservation_id, facility, recurring_number,
+            reservation_date.isoformat(), reservation_item, client_id, reservation_time, end_time, 'on']
+            for recurring_number, reservation_date in booked], cursor)
+        database_users.db_update_balance(user_id, -cost, cursor)
+        database_reservations.db_add_transaction(str(reservation_id) + '-t1', 'payment', cost,
+            datetime.now(), user_id, reservation_id, cursor)
+
+    return {'message': 'Recurring reservation was successful! ',
+            'reservation_id': reservation_id,
+            'cost': cost,
+            'booked': [{'recurring_number': recurring_number, 'reservation_date': reservation_date.isoformat()}
+                for recurring_number, reservation_date in booked],
+            'skipped': skipped}
+
+
+# Most reservation requests in one batch
+MAX_BATCH_SIZE = 200
+
+
+def make_reservations_batch(reservation_requests):
+    '''
+    Make several reservations given a list of ReservationRequest. Every
+    request is checked like make_reservation does (and for its time to be on
+    the half-hour grid and within opening hours), against one snapshot of
+    the users, balances and occupancy updated with the requests booked
+    before it in the list. The valid ones are booked in one transaction and
+    every request gets its own result.
+    '''
+    if not 1 <= len(reservation_requests) <= MAX_BATCH_SIZE:
+        raise HTTPException(
+            status_code=400,
+            detail=f"A batch must have between 1 and {MAX_BATCH_SIZE} reservation requests."
+        )
+
+    results = [None] * len(reservation_requests)
+
+    def reject(index, detail):
+        results[index] = {'index': index, 'status': 'rejected', 'detail': detail}
+
+    # Requests that can be checked against the database
+    requests = []
+    for index, request in enumerate(reservation_requests):
+        try:
+            reservation_date = datetime.strptime(request.reservation_date, '%Y-%m-%d').date()
+        except ValueError:
+            reject(index, f"Invalid reservation date '{request.reservation_date}', use YYYY-MM-DD.")
+            continue
+        if request.reservation_item not in database_occupancy.RESERVATION_CONSTRAINTS:
+            reject(index, f"Unknown resource '{request.reservation_item}'.")
+            continue
+        try:
+            check_booking_time(request.reservation_time, request.duration)
+        except HTTPException as error:
+            reject(index, error.detail)
+            continue
+        if not is_open(reservation_date, request.reservation_time, request.reservation_time + request.duration):
+            reject(index, 'Closed at that time.')
+            continue
+        requests.append((index, request, reservation_date))
+
+    # Check and book every request in one write transaction
+    with database_occupancy.resource_locks((request.facility, reservation_date, request.reservation_item)
+        for _, request, reservation_date in requests), \
+        database_occupancy.db_reservations_transaction() as cursor:
+        # Snapshot of the users and of the occupancy of every facility-day
+        users = {user_id: database_users.db_get_user(user_id, cursor)
+            for user_id in {request.reservation_client_id for _, request, _ in requests}}
+        balances = {user_id: user['balance'] for user_id, user in users.items() if user is not None}
+        days = {}
+        for facility in {request.facility for _, request, _ in requests}:
+            dates = sorted({reservation_date for _, request, reservation_date in requests
+                if request.facility == facility})
+            for reservation_date, slots in zip(dates,
+                database_occupancy.db_get_days_occupancy(facility, dates, cursor)):
+                days[(facility, reservation_date)] = database_occupancy.DayOccupancy(slots)
+
+        reservations, transactions, payments = [], [], defaultdict(float)
+        timestamp = datetime.now()
+        for index, request, reservation_date in requests:
+            user_id = request.reservation_client_id
+            end_time = request.reservation_time + request.duration
+            day = days[(request.facility, reservation_date)]
+            cost = calculate_booking_costs(reservation_date, request.reservation_item, request.duration)
+
+            if users[user_id] is None or users[user_id]['active'] != 'yes':
+                reject(index, f"{user_id} is not an active user.")
+            elif balances[user_id] < cost:
+                reject(index, f'Insufficient balance. Cost is {cost} and balance is {balances[user_id]} '
+                    f'and the user ID is {user_id}')
+            elif not day.fits(request.reservation_item, request.reservation_time, end_time):
+                reject(index, 'Machine booked for that time.')
+            else:
+                # Later requests of the batch see this booking
+                reservation_id = database_reservations.db_allocate_reservation_id(cursor)
+                day.add(request.reservation_item, request.reservation_time, end_time)
+                balances[user_id] -= cost
+                payments[user_id] += cost
+                reservations.append([reservation_id, request.facility, 0, reservation_date.isoformat(),
+                    request.reservation_item, request.reservation_client_id, request.reservation_time, end_time, 'on'])
+                transactions.append([str(reservation_id) + '-t1', 'payment', cost, timestamp, user_id,
+                    reservation_id])
+                results[index] = {'index': index, 'status': 'booked', 'reservation_id': reservation_id,
+                    'cost': cost}
+
+        if reservations:
+            database_reservations.db_add_reservations(reservations, cursor)
+            for user_id, amount in payments.items():
+                database_users.db_update_balance(user_id, -amount, cursor)
+            database_reservations.db_add_transactions(transactions, cursor)
+
+    booked = len(reservations)
+    return {'message': f'{booked} of {len(results)} reservations were successful.',
+            'data': results}
+
+
 def cancel_reservation(reservation_id):
     '''
-    Cancel a reservation given reservation_request class
+    Cancel a reservation given reservation_request class. The status is
+    checked and the reservation cancelled and refunded in one write
+    transaction, so concurrent cancellations of the same ID refund it once.
     '''
 
     today = date.today()
-    
-    # Validate reservation_id:
-    valid_id = database_reservations.db_validate_reservation(reservation_id)
-    if valid_id:
-        active_reservation = database_reservations.db_validate_active_reservation(reservation_id)
+
+    with database_occupancy.db_reservations_transaction() as cursor:
+        # Validate reservation_id:
+        valid_id = database_reservations.db_validate_reservation(reservation_id, cursor)
+        if not valid_id:
+            # If reservation not found
+            raise HTTPException(
+                status_code=400,
+                detail='That reservation ID does not exist in our system.'
+            )
+
+        active_reservation = database_reservations.db_validate_active_reservation(reservation_id, cursor)
 
         if active_reservation:
-            reservation = database_reservations.db_get_reservations_for_id(reservation_id)
-            database_reservations.db_cancel_reservation(reservation_id)
+            reservation = database_reservations.db_get_reservations_for_id(reservation_id, cursor)
+            database_reservations.db_cancel_reservation(reservation_id, cursor)
 
             # Add refund to transactions
             # Calculate refund
@@ -239,127 +498,130 @@ def cancel_reservation(reservation_id):
 
             # Add transaction
             transaction_id = str(reservation_id) + '-t2'
-            refund_amount = database_reservations.db_get_payment_amount_for_id(reservation_id) * refund
-            user_id = database_reservations.db_get_user_for_id(reservation_id)
-            database_users.db_update_balance(user_id, refund_amount)
+            refund_amount = database_reservations.db_get_payment_amount_for_id(reservation_id, cursor) * refund
+            user_id = database_reservations.db_get_user_for_id(reservation_id, cursor)
+            database_users.db_update_balance(user_id, refund_amount, cursor)
             database_reservations.db_add_transaction(transaction_id, 'refund', refund_amount,
-                datetime.now(), user_id, reservation_id)
+                datetime.now(), user_id, reservation_id, cursor)
 
             # Return successful cancellation
             return {'message': 'Cancellation was successful!'}
-        else:
-            # else check if held by remote manager
-            active_hold = database_reservations.db_validate_hold(reservation_id)
 
-            if active_hold:
-                database_reservations.db_cancel_reservation(reservation_id)
-                return {'message': 'Hold cancellation was successful!'}
+        # else check if held by remote manager
+        active_hold = database_reservations.db_validate_hold(reservation_id, cursor)
 
-            else:
-                # Else if correct reservation found and already cancelled
-                raise HTTPException(
-                    status_code=400, 
-                    detail='This reservation is already cancelled.'
-                    )
-    else:
-        # If reservation not found
-        raise HTTPException(
-            status_code=400, 
-            detail='That reservation ID does not exist in our system.'
-        )
-        
+        if active_hold:
+            database_reservations.db_cancel_reservation(reservation_id, cursor)
+            return {'message': 'Hold cancellation was successful!'}
+
+    # Else if correct reservation found and already cancelled
+    raise HTTPException(
+        status_code=400,
+        detail='This reservation is already cancelled.'
+    )
 
-def view_reservations(date_start, date_end, facility, client_id):
+
+# Columns of CSV and JSON lines reports
+RESERVATION_COLUMNS = ['reservation_id', 'facility', 'recurring_number', 'reservation_date', 'resource',
+    'client_id', 'start_time', 'end_time', 'status']
+TRANSACTION_COLUMNS = ['transaction_id', 'transaction_type', 'transaction_amount', 'transaction_timestamp',
+    'user_id', 'reservation_id', 'facility', 'reservation_date', 'resource', 'client_id', 'start_time',
+    'end_time', 'status']
+
+
+def view_reservations(date_start, date_end, facility, client_id, report_format='json'):
     '''
     View reservations for date range and if specified, client_id
     '''
-    if client_id is None:
-        reservations_db = database_reservations.db_get_reservations_between_dates(
-            date_start, date_end, facility)
-    else:
-        reservations_db = database_reservations.db_get_reservations_between_dates_and_client(
-            date_start, date_end, facility, client_id)
+    report_functions.check_report_format(report_format)
+
+    reservations_db = database_reservations.db_iter_reservations_between_dates(
+        date_start, date_end, facility, client_id)
 
     # Output reservations
-    report = f"All reservations for date range {date_start} to {date_end}"
+    header = f"All reservations for date range {date_start} to {date_end}"
     if client_id:
-        report += f" for client {client_id}: \n"
+        header += f" for client {client_id}: \n"
     else:
-        report += f": \n"
+        header += f": \n"
+
+    if report_format != 'json':
+        return report_functions.stream_report(report_format, header, reservations_db, create_report,
+            RESERVATION_COLUMNS)
 
-    # Go through each reservation for a date in the dictionary
-    for reservation in reservations_db:
-        # Add reservation to report
-        report += create_report(reservation)
+    # Add each reservation to report
+    reservations_db = list(reservations_db)
+    report = report_functions.render_text(header, reservations_db, create_report)
 
     # Return report
     return {'data': report, 'csv_data': reservations_db}
 
-def view_holds(date_start = "", date_end = ""):
+def view_holds(date_start = "", date_end = "", report_format='json'):
     '''
     View holds for date range and if specified, client_id
     '''
-    
-    holds_db = database_reservations.db_get_holds_between_dates(
+    report_functions.check_report_format(report_format)
+
+    holds_db = database_reservations.db_iter_holds_between_dates(
         date_start, date_end)
     
     # Output reservations
     if date_start and date_end:
-        report = f"All holds for date range {date_start} to {date_end}"
+        header = f"All holds for date range {date_start} to {date_end}"
     else:
-        report = f"All holds"
-    report += f": \n"
+        header = f"All holds"
+    header += f": \n"
 
-    # Go through each reservation for a date in the dictionary
-    for hold in holds_db:
-        # Add reservation to report
-        report += create_report(hold)
+    if report_format != 'json':
+        return report_functions.stream_report(report_format, header, holds_db, create_report,
+            RESERVATION_COLUMNS)
+
+    # Add each hold to report
+    holds_db = list(holds_db)
+    report = report_functions.render_text(header, holds_db, create_report)
 
     # Return report
     return {'data': report, 'csv_data': holds_db}
 
-def view_transactions(date_start, date_end, facility):
+def view_transactions(date_start, date_end, facility, report_format='json'):
     '''
     View transactions for date range
     '''
+    report_functions.check_report_format(report_format)
 
     # Output transactions
-    report = f"All transactions for date range {date_start} to {date_end}: \n"
-
-    # Go through each reservation for a date in the 
-    transactions_db = database_reservations.db_get_transactions_between_dates(date_start, date_end, facility)
-    for transaction in transactions_db:
-        reservation_id = transaction['reservation_id']
-        reservation = database_reservations.db_get_reservations_for_id(reservation_id)
-        # Report transactions
-        if transaction['transaction_type'] == 'payment':
-            report += create_report(reservation)
-        report += f'- {transaction["transaction_type"].capitalize()}: {transaction["transaction_amount"]}\n'
-        report += f'- {transaction["transaction_type"].capitalize()}: {transaction["transaction_amount"]}\n'
-    return {'data': report}
-
-def view_all_transactions(user_id=None):
+    header = f"All transactions for date range {date_start} to {date_end}: \n"
+
+    # Transactions of the facility with their reservation, in one query
+    transactions_db = database_reservations.db_iter_transactions_with_reservations_between_dates(date_start,
+        date_end, facility)
+
+    if report_format != 'json':
+        return report_functions.stream_report(report_format, header, transactions_db,
+            create_transaction_report, TRANSACTION_COLUMNS)
+
+    return {'data': report_functions.render_text(header, transactions_db, create_transaction_report)}
+
+def view_all_transactions(user_id=None, report_format='json'):
     '''
     View all transactions
     '''
+    report_functions.check_report_format(report_format)
 
     # Output transactions
     if user_id:
-        report = f"All transactions for user {user_id}: \n"
-        transactions_db = database_reservations.db_print_all_transactions_for_id(user_id)
+        header = f"All transactions for user {user_id}: \n"
     else:
-        report = f"All transactions: \n"
-        transactions_db = database_reservations.db_print_all_transactions()
+        header = f"All transactions: \n"
 
-    # Go through each reservation for a date in the 
-    for transaction in transactions_db:
-        reservation_id = transaction['reservation_id']
-        reservation = database_reservations.db_get_reservations_for_id(reservation_id)
-        # Report transactions
-        if transaction['transaction_type'] == 'payment':
-            report += create_report(reservation)
-        report += f'- {transaction["transaction_type"].capitalize()}: {transaction["transaction_amount"]}\n'
-    return {'data': report}
+    # Transactions with their reservation, in one query
+    transactions_db = database_reservations.db_iter_transactions_with_reservations(user_id)
+
+    if report_format != 'json':
+        return report_functions.stream_report(report_format, header, transactions_db,
+            create_transaction_report, TRANSACTION_COLUMNS)
+
+    return {'data': report_functions.render_text(header, transactions_db, create_transaction_report)}
 
 
 def create_report(reservation):
@@ -374,3 +636,13 @@ def create_report(reservation):
     )
     return report
 
+
+def create_transaction_report(transaction):
+    '''
+    Function to prepare report of a transaction joined with its reservation
+    '''
+    report = ''
+    if transaction['transaction_type'] == 'payment':
+        report += create_report(transaction)
+    report += f'- {transaction["transaction_type"].capitalize()}: {transaction["transaction_amount"]}\n'
+    return report
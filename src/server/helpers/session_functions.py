@@ -0,0 +1,219 @@
+# Session functions for reservations_API.py:
+# a login checks the password once and returns a signed session token, which
+# later requests send in an `Authorization: Bearer <token>` header and which
+# is checked with an HMAC instead of the password hash
+#
+# Fabrizio Giovannini Filho, Yuxin Guan, Lynnette Jiang, Jared McKeon, Fandi Meng
+
+import base64, hashlib, hmac, json, os, secrets, threading, time
+from fastapi import HTTPException
+import database.database_sessions as database_sessions
+import database.database_settings as database_settings
+import helpers.user_functions as user_functions
+
+# Seconds a session token is valid for
+TOKEN_TTL = int(os.environ.get('RESERVATIONS_TOKEN_TTL', 3600))
+
+# Seconds between reloads of the revocation list from the database, i.e. how
+# long a logout can take to reach the other server processes
+REVOCATION_REFRESH = float(os.environ.get('RESERVATIONS_REVOCATION_REFRESH', 5))
+
+
+def encode(data):
+    '''
+    URL-safe base64 without padding
+    '''
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode('ascii')
+
+
+def decode(text):
+    '''
+    Reverse of encode
+    '''
+    return base64.urlsafe_b64decode(text + '=' * (-len(text) % 4))
+
+
+class TokenSigner:
+    '''
+    Signs and checks session tokens with HMAC-SHA256. The secret comes from
+    the RESERVATIONS_TOKEN_SECRET environment variable or, if not set, is
+    generated once and kept in the `settings` table so every server process
+    signs with the same secret.
+    '''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._secret = None
+
+    def secret(self):
+        with self._lock:
+            if self._secret is None:
+                secret = os.environ.get('RESERVATIONS_TOKEN_SECRET')
+                if not secret:
+                    secret = database_settings.db_get_or_add_setting('token_secret', secrets.token_hex(32))
+                self._secret = secret.encode('utf-8')
+            return self._secret
+
+    def sign(self, payload):
+        '''
+        Returns a token carrying `payload` (a dict)
+        '''
+        body = encode(json.dumps(payload, separators=(',', ':')).encode('utf-8'))
+        signature = hmac.new(self.secret(), body.encode('ascii'), hashlib.sha256).digest()
+        return body + '.' + encode(signature)
+
+    def verify(self, token):
+        '''
+        Returns the payload of a token, or None if it was not signed by us
+        '''
+        try:
+            body, signature = token.split('.')
+            expected = hmac.new(self.secret(), body.encode('ascii'), hashlib.sha256).digest()
+            if not hmac.compare_digest(decode(signature), expected):
+                return None
+            return json.loads(decode(body))
+        except ValueError:
+            return None
+
+
+class RevocationList:
+    '''
+    In-memory copy of the `revoked_tokens` table, reloaded at most every
+    `refresh` seconds so checking a token does not need the database
+    '''
+
+    def __init__(self, refresh):
+        self.refresh = refresh
+        self._lock = threading.Lock()
+        self._revoked = set()
+        self._loaded_at = None
+        self._loading = False
+        # Tokens revoked by this process (ID: expiry), kept across reloads
+        # in case a reload read the table before they were added
+        self._revoked_here = {}
+
+    def revoke(self, token_id, expires_at):
+        database_sessions.db_revoke_token(token_id, expires_at)
+        with self._lock:
+            self._revoked.add(token_id)
+            self._revoked_here[token_id] = expires_at
+
+    def is_revoked(self, token_id):
+        now = time.time()
+        with self._lock:
+            stale = self._loaded_at is None or now - self._loaded_at >= self.refresh
+            # One request reloads an expired copy while the others keep
+            # checking it (before the first load, every request reads the table)
+            if not stale or (self._loading and self._loaded_at is not None):
+                return token_id in self._revoked
+            self._loading = True
+
+        # Read the table without holding the lock
+        try:
+            revoked = database_sessions.db_get_revoked_tokens(now)
+        except BaseException:
+            with self._lock:
+                self._loading = False
+            raise
+
+        with self._lock:
+            self._loading = False
+            self._revoked_here = {revoked_id: expires_at for revoked_id, expires_at in self._revoked_here.items()
+                if expires_at >= now}
+            self._revoked = revoked | self._revoked_here.keys()
+            self._loaded_at = now
+            return token_id in self._revoked
+
+
+TOKEN_SIGNER = TokenSigner()
+REVOKED_TOKENS = RevocationList(REVOCATION_REFRESH)
+
+
+def create_token(user_id, role):
+    '''
+    Returns a new session token for a user and its expiry (Unix timestamp).
+    '''
+    expires_at = int(time.time()) + TOKEN_TTL
+    token = TOKEN_SIGNER.sign({'sub': user_id, 'role': role, 'exp': expires_at,
+        'jti': secrets.token_hex(8)})
+    return token, expires_at
+
+
+def verify_token(token):
+    '''
+    Checks a session token. Returns its payload: user ID ('sub'), role,
+    expiry ('exp') and token ID ('jti').
+    '''
+    payload = TOKEN_SIGNER.verify(token)
+
+    if payload is None:
+        raise HTTPException(
+            status_code=401,
+            detail='Invalid session token.'
+        )
+    if payload['exp'] < time.time():
+        raise HTTPException(
+            status_code=401,
+            detail='Session token expired.'
+        )
+    if REVOKED_TOKENS.is_revoked(payload['jti']):
+        raise HTTPException(
+            status_code=401,
+            detail='Session token revoked.'
+        )
+
+    return payload
+
+
+def verify_authorization(authorization):
+    '''
+    Checks the value of an `Authorization: Bearer <token>` header.
+    Returns the token payload (see verify_token).
+    '''
+    if not authorization or not authorization.startswith('Bearer '):
+        raise HTTPException(
+            status_code=401,
+            detail='Missing session token.',
+            headers={'WWW-Authenticate': 'Bearer'}
+        )
+
+    return verify_token(authorization[len('Bearer '):].strip())
+
+
+def require_admin(authorization):
+    '''
+    Checks that an `Authorization: Bearer <token>` header is the session
+    token of an admin. Returns the token payload (see verify_token).
+    '''
+    payload = verify_authorization(authorization)
+
+    if payload['role'] != 'admin':
+        raise HTTPException(
+            status_code=403,
+            detail='Only admins can do this.'
+        )
+
+    return payload
+
+
+def login(user_id, password, allowed):
+    '''
+    Validates user_id and password (see user_functions.validate_user) and
+    returns a session token for the user.
+    '''
+    validation = user_functions.validate_user(user_id, password, allowed)
+    role = validation['data']
+    token, expires_at = create_token(user_id, role)
+
+    return {'message': validation['message'], 'data': role, 'token': token,
+            'expires_at': expires_at}
+
+
+def logout(authorization):
+    '''
+    Revokes the session token of an `Authorization: Bearer <token>` header.
+    '''
+    payload = verify_authorization(authorization)
+    REVOKED_TOKENS.revoke(payload['jti'], payload['exp'])
+
+    return {'message': f"{payload['sub']} has been logged out."}
@@ -4,16 +4,19 @@
 
 from fastapi import HTTPException
 import database.database_users as database_users
-import os, hashlib
+import database.database_settings as database_settings
+import helpers.report_functions as report_functions
 
 
 def validate_user(user_id, password, allowed):
     '''
     Validates user_id as a valid user. If it is valid, returns the role of the user.
     '''
-    if database_users.db_user_exists(user_id):
-        if  database_users.db_validate_user(user_id, password):
-            role = database_users.db_get_user_role(user_id)
+    # One query for existence, password and role
+    user = database_users.db_get_user(user_id)
+    if user:
+        if  database_users.db_check_password(user, password):
+            role = user['role']
             if not allowed and role == "client":
                 raise HTTPException(
                     status_code=400,
@@ -32,6 +35,38 @@ def validate_user(user_id, password, allowed):
         )
 
 
+def client_sign_in_allowed():
+    '''
+    Returns True if clients may sign in. The setting is kept in the database
+    so every server process sees the same value.
+    '''
+    return database_settings.db_get_setting('client_sign_in', 'yes') == 'yes'
+
+
+def set_client_sign_in(allowed):
+    '''
+    Allows or disallows client sign-in.
+    '''
+    database_settings.db_set_setting('client_sign_in', 'yes' if allowed else 'no')
+
+    if allowed:
+        return {'message': 'Client sign-in is allowed.', 'pref': True}
+    else:
+        return {'message': 'Client sign-in is disabled.', 'pref': False}
+
+
+def parse_yes_no(value):
+    '''
+    Reads a yes/no setting given as text, e.g. in an environment variable.
+    '''
+    if value.strip().lower() in ('yes', 'y', 'true', '1', 'on'):
+        return True
+    elif value.strip().lower() in ('no', 'n', 'false', '0', 'off'):
+        return False
+    else:
+        raise ValueError(f"Setting must be yes or no, not '{value}'.")
+
+
 def add_user(user_id, password, role):
     '''
     Adds new user to the users table in database. Returns 
@@ -47,13 +82,7 @@ def add_user(user_id, password, role):
         )
     else:
         role = role.lower()
-        salt = os.urandom(32)
-        hash = hashlib.pbkdf2_hmac(
-            hash_name='sha256',
-            password=password.encode('utf-8'),
-            salt=salt,
-            iterations=100000
-        )
+        salt, hash = database_users.generate_hash(password)
         database_users.db_add_user(user_id, role, salt, hash)
 
         return {'message': f"{user_id} has been successfully added as a {role}."}
@@ -158,13 +187,7 @@ def update_user_password(user_id, password):
 
     if exist_user:
         # Hash new password using salt
-        salt = os.urandom(32)
-        hash = hashlib.pbkdf2_hmac(
-            hash_name='sha256',
-            password=password.encode('utf-8'),
-            salt=salt,
-            iterations=100000
-        )
+        salt, hash = database_users.generate_hash(password)
         # Update password, salt and hash
         database_users.db_update_user_password(user_id, salt, hash)
         return {'message': f"Successfully updated User {user_id}'s password."}
@@ -232,40 +255,51 @@ def deactivate_user(user_id):
         )
 
 
-def show_users():
+# Table rows of the user reports, and columns of their CSV and JSON lines versions
+USER_ROW_FORMAT = '{:<15} {:<10}'
+USER_COLUMNS = ['user_id', 'role']
+CLIENT_ROW_FORMAT = '{:<15} {:<10} {:<10} {:<10}'
+CLIENT_COLUMNS = ['user_id', 'role', 'balance', 'active']
+
+
+def show_users(report_format='json'):
     '''
     Returns string with all valid user_ids and their respective roles.
     '''
+    report_functions.check_report_format(report_format)
 
-    results = database_users.db_show_users()
+    results = database_users.db_iter_users()
 
     # Format table with user data
-    row_format = '{:<15} {:<10}'
-    table = row_format.format('User ID', 'Role') + '\n'
-    table += row_format.format('------------', '----------') + '\n'
+    table = USER_ROW_FORMAT.format('User ID', 'Role') + '\n'
+    table += USER_ROW_FORMAT.format('------------', '----------') + '\n'
     # Apply row format to data
-    for row in results:
-        table += row_format.format(*row) + '\n'
+    render_row = lambda row: USER_ROW_FORMAT.format(*row) + '\n'
 
-    return {'data': table}
+    if report_format != 'json':
+        return report_functions.stream_report(report_format, table, results, render_row, USER_COLUMNS)
 
+    return {'data': report_functions.render_text(table, results, render_row)}
 
-def show_clients():
+
+def show_clients(report_format='json'):
     '''
     Returns string with all valid client user_ids, their role, and their balances.
     '''
+    report_functions.check_report_format(report_format)
 
-    results = database_users.db_show_clients()
+    results = database_users.db_iter_users('client')
 
     # Format table with client data
-    row_format = '{:<15} {:<10} {:<10} {:<10}'
-    table = row_format.format('User ID', 'Role', 'Balance', 'Active') + '\n'
-    table += row_format.format('------------', '----------', '----------', '----------') + '\n'
+    table = CLIENT_ROW_FORMAT.format('User ID', 'Role', 'Balance', 'Active') + '\n'
+    table += CLIENT_ROW_FORMAT.format('------------', '----------', '----------', '----------') + '\n'
     # Apply row format to data
-    for row in results:
-        table += row_format.format(*row) + '\n'
+    render_row = lambda row: CLIENT_ROW_FORMAT.format(*row) + '\n'
+
+    if report_format != 'json':
+        return report_functions.stream_report(report_format, table, results, render_row, CLIENT_COLUMNS)
 
-    return {'data': table}
+    return {'data': report_functions.render_text(table, results, render_row)}
 
 
 def show_client(user_id):
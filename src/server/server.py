@@ -5,28 +5,71 @@
 #
 # Execution: uvicorn server:app --reload
 
-from typing import Optional
-from fastapi import FastAPI
+import os
+from typing import List, Optional
+from anyio import to_thread
+from fastapi import FastAPI, Depends, Header, Request
+from fastapi.responses import Response
 from pydantic import BaseModel
 import helpers.reservation_functions as reservation_functions
 import helpers.user_functions as user_functions
-from PyInquirer import prompt
-from examples import custom_style_2
-
-# API launch and initial prompt
-app = FastAPI()
-answers = prompt({
-    'type': 'list',
-    'name': 'choice',
-    'message': 'Would you like the system to allow client sign-in? Select and press enter: ',
-    'choices': [
-        "Yes",
-        "No"
-    ]}, style=custom_style_2)
-if answers['choice'] == "Yes":
-    allowed = True
-else:
-    allowed = False
+import helpers.session_functions as session_functions
+import helpers.metrics_functions as metrics_functions
+import helpers.availability_functions as availability_functions
+import database.database_helpers as database_helpers
+import database.database_profiler as database_profiler
+
+# Session tokens (see POST /login) are required on every endpoint but the
+# ones below when RESERVATIONS_REQUIRE_TOKEN is yes (default no, so existing
+# clients keep working)
+REQUIRE_TOKEN = user_functions.parse_yes_no(os.environ.get('RESERVATIONS_REQUIRE_TOKEN', 'no'))
+PUBLIC_ROUTES = {('POST', '/login'), ('GET', '/pref'), ('GET', '/users'), ('GET', '/docs'),
+    ('GET', '/docs/oauth2-redirect'), ('GET', '/openapi.json'), ('GET', '/redoc'), ('GET', '/metrics')}
+
+def authenticate(request: Request):
+    if REQUIRE_TOKEN and (request.method, request.url.path) not in PUBLIC_ROUTES:
+        return session_functions.verify_authorization(request.headers.get('Authorization'))
+
+# API launch
+app = FastAPI(dependencies=[Depends(authenticate)])
+
+# Latency, SQL statements and password hashing time of every request, per
+# route (served by GET /metrics)
+app.add_middleware(metrics_functions.MetricsMiddleware)
+
+# Bring the database schema up to date before serving requests, and
+# checkpoint the write-ahead log and take scheduled snapshots (if
+# RESERVATIONS_BACKUP_INTERVAL is set) in the background while serving
+@app.on_event("startup")
+def migrate_database():
+    database_helpers.db_migrate()
+    database_helpers.DB_CHECKPOINTS.start()
+    database_helpers.DB_BACKUPS.start()
+
+@app.on_event("shutdown")
+def stop_checkpoints():
+    database_helpers.DB_BACKUPS.stop()
+    database_helpers.DB_CHECKPOINTS.stop()
+
+# Whether clients may sign in is kept in the database, so all server workers
+# share it. It can be set at launch with the RESERVATIONS_CLIENT_SIGN_IN
+# environment variable (yes/no) and changed later with PUT /pref; otherwise
+# the value already in the database is kept (yes for a new database).
+CLIENT_SIGN_IN = os.environ.get('RESERVATIONS_CLIENT_SIGN_IN')
+
+@app.on_event("startup")
+def set_client_sign_in():
+    if CLIENT_SIGN_IN is not None:
+        user_functions.set_client_sign_in(user_functions.parse_yes_no(CLIENT_SIGN_IN))
+
+# Endpoints that use the database or hash passwords are declared with `def`,
+# not `async def`, so they run in a thread pool instead of blocking the event
+# loop. Size of that pool (default 40):
+WORKER_THREADS = int(os.environ.get('RESERVATIONS_WORKER_THREADS', 40))
+
+@app.on_event("startup")
+async def set_worker_threads():
+    to_thread.current_default_thread_limiter().total_tokens = WORKER_THREADS
 
 # ReservationRequest class for POST request
 class ReservationRequest(BaseModel):
@@ -38,6 +81,13 @@ class ReservationRequest(BaseModel):
     reservation_time: float
     duration: float
 
+# RecurringReservationRequest class for recurring reservations POST request:
+# `occurrences` reservations, daily or weekly from reservation_date
+class RecurringReservationRequest(ReservationRequest):
+    frequency: str = "weekly"
+    occurrences: int
+    mode: str = "all_or_nothing"
+
 # HoldRequest class for holds POST request
 class HoldRequest(BaseModel):
     facility: str
@@ -54,13 +104,103 @@ class User(BaseModel):
     password: str
     role: str
 
+# Login class for POST request
+class Login(BaseModel):
+    user_id: str
+    password: str
+
+# Preference class for PUT request
+class Preference(BaseModel):
+    pref: bool
+
 @app.get("/pref")
-async def return_pref():
-    return {'pref': allowed}
+def return_pref():
+    return {'pref': user_functions.client_sign_in_allowed()}
+
+
+@app.put("/pref")
+def update_pref(preference: Preference, authorization: Optional[str] = Header(None)):
+    '''
+    Allow or disallow client sign-in for every server process (admins only,
+    with a session token from POST /login).
+
+    Put request will have the following structure:
+    {
+        "pref": true
+    }
+
+    Returns
+    {
+        'message': 'Client sign-in is allowed.',
+        'pref': true
+    }
+    '''
+    session_functions.require_admin(authorization)
+    return user_functions.set_client_sign_in(preference.pref)
+
+
+@app.get("/stats/connections")
+def connection_stats():
+    '''
+    Returns the database connection pool counters:
+    {
+        'data': {'opened': 3, 'reused': 250, 'discarded': 0, 'closed': 0,
+                 'in_use': 1, 'idle': 2, 'size': 5}
+    }
+    '''
+    return {'data': database_helpers.get_db_pool_stats()}
+
+
+@app.get("/stats/storage")
+def storage_stats():
+    '''
+    Returns the storage pragmas of the database connections and the
+    counters of the write-ahead log checkpoints and scheduled snapshots:
+    {
+        'data': {'pragmas': {'journal_mode': 'wal', 'synchronous': 1, ...},
+                 'checkpoints': {'checkpoints': 12, 'errors': 0, 'last_result': [0, 3, 3], ...},
+                 'backups': {'snapshots': 2, 'errors': 0, 'last_snapshot': '.../reservations-....db', ...}}
+    }
+    '''
+    return {'data': database_helpers.get_db_storage_stats()}
+
+
+@app.get("/stats/queries")
+def query_stats(reset: bool = False, authorization: Optional[str] = Header(None)):
+    '''
+    Returns the SQL profile of this server process (admins only, with a
+    session token from POST /login): calls, total, mean and max time and
+    rows returned of every statement, the most time-consuming first.
+    Statements are only profiled with RESERVATIONS_PROFILE_SQL=yes. With
+    reset=true the profile is cleared after being returned.
+    {
+        'data': {'enabled': true, 'slow_query_ms': 100.0,
+                 'statements': [{'statement': 'SELECT * FROM users WHERE user_id = ?', 'query': 'get_user',
+                                 'calls': 12, 'timed_calls': 12, 'total_ms': 0.9, 'mean_ms': 0.075,
+                                 'max_ms': 0.2, 'rows': 12}, ...]}
+    }
+    '''
+    session_functions.require_admin(authorization)
+    stats = database_profiler.SQL_PROFILER.stats()
+    if reset:
+        database_profiler.SQL_PROFILER.reset()
+    return {'data': stats}
+
+
+@app.get("/metrics")
+def metrics():
+    '''
+    Returns the metrics of this server process in the Prometheus text format
+    (for a Prometheus scraper, or curl): per-route request counts, latency
+    histograms, SQL statements and SQL time per request and password hashing
+    time, requests in flight, SQL statements run and database connections
+    opened. Each server worker process has its own metrics.
+    '''
+    return Response(metrics_functions.get_metrics(), media_type=metrics_functions.METRICS_CONTENT_TYPE)
 
 
 @app.post("/reservations")
-async def create_reservation(reservation_request: ReservationRequest):
+def create_reservation(reservation_request: ReservationRequest):
     '''
     Make reservation using reservation class.
     For documentation: https://fastapi.tiangolo.com/tutorial/body/
@@ -92,14 +232,67 @@ async def create_reservation(reservation_request: ReservationRequest):
     return reservation
 
 
+@app.post("/reservations/batch")
+def create_reservations_batch(reservation_requests: List[ReservationRequest]):
+    '''
+    Make many reservations in one request, e.g. a week's planning.
+
+    Post request is a list of reservation requests (see POST /reservations):
+    [
+        {"facility": "facility1", "user_id": "string", "reservation_item": "harvester", ...},
+        ...
+    ]
+
+    The requests are checked against one snapshot of the users, balances and
+    machines (in order, so two requests for the last machine of a slot do not
+    both succeed) and the valid ones are booked in one transaction. Returns the
+    result of every request:
+    {
+        'message': '2 of 3 reservations were successful.',
+        'data': [{'index': 0, 'status': 'booked', 'reservation_id': 15, 'cost': 8800.0},
+                 {'index': 1, 'status': 'rejected', 'detail': 'Machine booked for that time.'}, ...]
+    }
+    '''
+    return reservation_functions.make_reservations_batch(reservation_requests)
+
+
+@app.post("/reservations/recurring")
+def create_recurring_reservation(recurring_request: RecurringReservationRequest):
+    '''
+    Book a daily or weekly series of reservations in one request.
+
+    Post request will have the structure of ReservationRequest (with the date of the
+    first occurrence) plus:
+    {
+        ...,
+        "frequency": "weekly",           (or "daily")
+        "occurrences": 4,
+        "mode": "all_or_nothing"         (or "best_effort" to book the occurrences that can be)
+    }
+
+    The occurrences share one reservation ID and are paid for together:
+    {
+        'message': 'Recurring reservation was successful! ',
+        'reservation_id': reservation_id,
+        'cost': 35200.0,
+        'booked': [{'recurring_number': 0, 'reservation_date': '2022-05-10'}, ...],
+        'skipped': [{'recurring_number': 2, 'reservation_date': '2022-05-24',
+                     'reason': 'Machine booked for that time.'}]
+    }
+    '''
+    return reservation_functions.make_recurring_reservation(recurring_request)
+
+
 @app.get("/reservations")
-async def get_reservations(start_date: str = "", end_date: str = "", facility: str = "facility1", customer_id: Optional[str] = None):
+def get_reservations(start_date: str = "", end_date: str = "", facility: str = "facility1", customer_id: Optional[str] = None,
+    format: str = "json"):
     '''
     Get reservations. Query parameters:
     - start_date (required)
     - end_date (required)
     - facility (required)
     - customer_id (optional)
+    - format (optional): json (default), or text, csv or jsonl to stream the report
     For documentation: https://fastapi.tiangolo.com/tutorial/query-params/
 
     Returns list of strings with information about reservations between two dates and customer_id
@@ -111,14 +304,14 @@ async def get_reservations(start_date: str = "", end_date: str = "", facility: s
     '''
 
     # Get reservations given parameters
-    reservations = reservation_functions.view_reservations(start_date, end_date, facility, customer_id,)
+    reservations = reservation_functions.view_reservations(start_date, end_date, facility, customer_id, format)
 
     # Return transactions informartiion
     return reservations
 
 
 @app.post("/holds")
-async def create_hold(hold_request: HoldRequest):
+def create_hold(hold_request: HoldRequest):
     '''
     Make hold using reservation class.
     For documentation: https://fastapi.tiangolo.com/tutorial/body/
@@ -150,11 +343,12 @@ async def create_hold(hold_request: HoldRequest):
 
 
 @app.get("/reservations/holds")
-async def get_reservations(start_date: str = "", end_date: str = ""):
+def get_reservations(start_date: str = "", end_date: str = "", format: str = "json"):
     '''
     Get reservations. Query parameters:
     - start_date (required)
     - end_date (required)
+    - format (optional): json (default), or text, csv or jsonl to stream the report
     For documentation: https://fastapi.tiangolo.com/tutorial/query-params/
 
     Returns list of strings with information about reservations between two dates and customer_id
@@ -166,14 +360,61 @@ async def get_reservations(start_date: str = "", end_date: str = ""):
     '''
 
     # Get reservations given parameters
-    holds = reservation_functions.view_holds(start_date, end_date)
+    holds = reservation_functions.view_holds(start_date, end_date, format)
 
     # Return transactions informartion
     return holds
 
 
+@app.get("/availability/search")
+def search_availability(resource: str, duration: float, start_date: Optional[str] = None,
+    end_date: Optional[str] = None, facility: str = "facility1", earliest_time: Optional[float] = None,
+    latest_time: Optional[float] = None, limit: int = 5):
+    '''
+    Find the earliest windows in which a machine can be booked. Query parameters:
+    - resource (required): machine, e.g. harvester
+    - duration (required): hours, a multiple of 0.5
+    - start_date, end_date (optional): YYYY-MM-DD, default today and 30 days ahead
+      (windows are only searched within the next 30 days)
+    - facility (optional): default facility1
+    - earliest_time, latest_time (optional): windows start at or after earliest_time and
+      end by latest_time, e.g. 13 and 17 for afternoons
+    - limit (optional): number of windows, default 5 (at most 100)
+
+    Windows are within opening hours (9 to 18 on weekdays, 10 to 16 on Saturday,
+    closed on Sunday), earliest first:
+    {
+        'data': [{'date': '2022-05-10', 'start_time': 9.5, 'end_time': 11.5}, ...]
+    }
+    '''
+    return availability_functions.search_availability(resource, duration, start_date, end_date, facility,
+        earliest_time, latest_time, limit)
+
+
+@app.get("/availability/grid")
+def availability_grid(start_date: str, end_date: str, facility: str = "facility1", encoding: str = "base64"):
+    '''
+    Get the units of every machine that can still be booked in every half-hour
+    slot between two dates (0 outside opening hours), e.g. to draw a 30-day
+    calendar with one request. Query parameters:
+    - start_date, end_date (required): YYYY-MM-DD, at most 92 days
+    - facility (optional): default facility1
+    - encoding (optional): base64 (default) or json
+
+    Slot s of the i-th date starts at opening_time + s * slot_length. With base64,
+    byte i * slots_per_day + s of the decoded string of a machine is its units left;
+    with json, remaining[machine][i][s] is:
+    {
+        'data': {'facility': 'facility1', 'dates': ['2022-05-10', ...], 'opening_time': 9,
+                 'slot_length': 0.5, 'slots_per_day': 18, 'capacity': {'workshop': 4, ...},
+                 'encoding': 'base64', 'remaining': {'workshop': 'AgQEBAQE...', ...}}
+    }
+    '''
+    return availability_functions.get_availability_grid(start_date, end_date, facility, encoding)
+
+
 @app.get("/reservations/cancel/{reservation_id}")
-async def cancel_reservation(reservation_id): #, facility: str = "facility1"):
+def cancel_reservation(reservation_id): #, facility: str = "facility1"):
     '''
     Cancel reservation based on reservation_id. For
     documentation: https://fastapi.tiangolo.com/tutorial/path-params/
@@ -194,9 +435,10 @@ async def cancel_reservation(reservation_id): #, facility: str = "facility1"):
 
 
 @app.get("/transactions")
-async def get_transactions():
+def get_transactions(format: str = "json"):
     '''
-    Returns list of strings with information about all transactions:
+    Returns list of strings with information about all transactions
+    (format: json, or text, csv or jsonl to stream the report):
     {
         'code': 200,
         'data': report
@@ -204,16 +446,17 @@ async def get_transactions():
     '''
 
     # Get transactions given parameters
-    transactions = reservation_functions.view_all_transactions()
+    transactions = reservation_functions.view_all_transactions(None, format)
 
     # Return transactions information
     return transactions
 
 
 @app.get("/transactions/{user_id}")
-async def get_transactions(user_id: str):
+def get_transactions(user_id: str, format: str = "json"):
     '''
-    Returns list of strings with information about all transactions:
+    Returns list of strings with information about all transactions
+    (format: json, or text, csv or jsonl to stream the report):
     {
         'code': 200,
         'data': report
@@ -221,14 +464,14 @@ async def get_transactions(user_id: str):
     '''
 
     # Get transactions given parameters
-    transactions = reservation_functions.view_all_transactions(user_id)
+    transactions = reservation_functions.view_all_transactions(user_id, format)
 
     # Return transactions information
     return transactions
 
 
 @app.get("/users")
-async def validate_user(user_id: str = "", password: str = ""):
+def validate_user(user_id: str = "", password: str = ""):
     '''
     Check if user_id is associated with a valid user in the system.
 
@@ -244,11 +487,61 @@ async def validate_user(user_id: str = "", password: str = ""):
     }
     '''
 
-    return user_functions.validate_user(user_id, password, allowed)
+    return user_functions.validate_user(user_id, password, user_functions.client_sign_in_allowed())
+
+
+@app.post("/login")
+def login(login: Login):
+    '''
+    Check user_id and password once and return a session token to send with
+    later requests in an `Authorization: Bearer <token>` header.
+
+    Post request will have the following structure (similar to Login
+    class above):
+    {
+        "user_id": "string",
+        "password": "string"
+    }
+
+    Returns
+    {
+        'message': '{user_id} is a {role}",
+        'data': role,
+        'token': token,
+        'expires_at': 1653400000
+    }
+    '''
+    return session_functions.login(login.user_id, login.password, user_functions.client_sign_in_allowed())
+
+
+@app.post("/logout")
+def logout(authorization: Optional[str] = Header(None)):
+    '''
+    Revoke the session token given in the `Authorization` header.
+
+    Returns
+    {
+        'message': "{user_id} has been logged out."
+    }
+    '''
+    return session_functions.logout(authorization)
+
+
+@app.get("/session")
+def session(authorization: Optional[str] = Header(None)):
+    '''
+    Check the session token given in the `Authorization` header.
+
+    Returns
+    {
+        'data': {'sub': user_id, 'role': role, 'exp': 1653400000, 'jti': token_id}
+    }
+    '''
+    return {'data': session_functions.verify_authorization(authorization)}
 
 
 @app.post("/users")
-async def add_user(user: User):
+def add_user(user: User):
     '''
     Add a users References User class above.
     For documentation: https://fastapi.tiangolo.com/tutorial/body/
@@ -271,7 +564,7 @@ async def add_user(user: User):
 
 
 @app.delete('/users/{user_id}')
-async def remove_user(user_id: str = ""):
+def remove_user(user_id: str = ""):
     '''
     Remove user_id from Users table in database given user ID in path.
     For documentation: https://fastapi.tiangolo.com/tutorial/path-params/
@@ -287,7 +580,7 @@ async def remove_user(user_id: str = ""):
 
 
 @app.put('/users/{user_id}')
-async def update_user(user_id: str, user: User):
+def update_user(user_id: str, user: User):
     '''
     Update a user given user ID in path.
     For documentation: https://fastapi.tiangolo.com/tutorial/path-params/
@@ -307,7 +600,7 @@ async def update_user(user_id: str, user: User):
 
 
 @app.get('/users/activate/{user_id}')
-async def activate_user(user_id: str):
+def activate_user(user_id: str):
     '''
     Activate a previously-deactivated user based on user ID in path.
     For documentation: https://fastapi.tiangolo.com/tutorial/path-params/
@@ -322,7 +615,7 @@ async def activate_user(user_id: str):
 
 
 @app.get('/users/deactivate/{user_id}')
-async def deactivate_user(user_id: str):
+def deactivate_user(user_id: str):
     '''
     Deactivate a user based on user ID in path.
     For documentation: https://fastapi.tiangolo.com/tutorial/path-params/
@@ -337,9 +630,10 @@ async def deactivate_user(user_id: str):
 
 
 @app.get('/users/all')
-async def show_users():
+def show_users(format: str = "json"):
     '''
-    Get list of users and their respective roles.
+    Get list of users and their respective roles
+    (format: json, or text, csv or jsonl to stream the table).
 
     After running the show_users function, will return table of users and roles:
     {
@@ -347,13 +641,14 @@ async def show_users():
         'data': table
     }
     '''
-    return user_functions.show_users()
+    return user_functions.show_users(format)
 
 
 @app.get('/clients')
-async def show_clients():
+def show_clients(format: str = "json"):
     '''
-    Get list of all clients.
+    Get list of all clients
+    (format: json, or text, csv or jsonl to stream the table).
 
     After running the show_clients function, will return table of user IDs, roles, balances, and status:
     {
@@ -361,11 +656,11 @@ async def show_clients():
         'data': table
     }
     '''
-    return user_functions.show_clients()
+    return user_functions.show_clients(format)
 
 
 @app.get('/clients/{user_id}')
-async def show_clients(user_id: str):
+def show_clients(user_id: str):
     '''
     Get information for specific client given user ID in path.
     For documentation: https://fastapi.tiangolo.com/tutorial/path-params/
@@ -380,7 +675,7 @@ async def show_clients(user_id: str):
 
 
 @app.get('/balance')
-async def balance(user_id: str = "", amount: int = 0):
+def balance(user_id: str = "", amount: int = 0):
     '''
     Show user's balance if amount not provided. Add to user's balance if amount provided.
 
@@ -0,0 +1,40 @@
+import pytest
+import database.database_helpers as database_helpers
+import database.database_memory as database_memory
+
+
+@pytest.fixture(scope='session')
+def seed_db():
+    '''
+    The test data, loaded into memory once per test process
+    '''
+    database = database_memory.MemoryDatabase.from_file(database_helpers.TEST_DATABASE_FILE)
+    yield database
+    database.close()
+
+
+@pytest.fixture
+def memory_db(seed_db):
+    '''
+    A fresh in-memory copy of the test data, used by the db_* functions
+    for the duration of a test
+    '''
+    database = seed_db.clone()
+    with database_memory.use_memory_db(database):
+        yield database
+    database.close()
+
+
+@pytest.fixture
+def file_db(tmp_path):
+    '''
+    A copy of the test data in a database file of its own, used by the
+    db_* functions for the duration of a test (for what needs a real file:
+    the write-ahead log, snapshots, ...). Returns the file's path.
+    '''
+    database_file = str(tmp_path / 'reservations.db')
+    database_helpers.copy_database(database_helpers.TEST_DATABASE_FILE, database_file)
+    with database_memory.use_db_pool(database_helpers.create_db_pool(database_file)):
+        # Migrated up front, as the server does at start
+        database_helpers.db_migrate()
+        yield database_file
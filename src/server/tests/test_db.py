@@ -1,9 +1,18 @@
 import database.database_reservations as database_reservations
+import database.database_users as database_users
+import database.database_migrations as database_migrations
+import database.database_backups as database_backups
+import database.database_bulk as database_bulk
+import database.database_profiler as database_profiler
+import database.database_metrics as database_metrics
+import database.database_helpers as database_helpers
+import benchmarks.load_test as load_test
+import threading, time
 from datetime import datetime
 
 
 
-def test_db_get_reservations_between_dates_and_client():
+def test_db_get_reservations_between_dates_and_client(memory_db):
     '''
     Test db_get_reservations_between_dates_and_client function output
     '''
@@ -12,7 +21,7 @@ def test_db_get_reservations_between_dates_and_client():
 
     assert len(reservations_bewteen_dates) == 4
 
-def test_db_get_reservations_between_dates():
+def test_db_get_reservations_between_dates(memory_db):
     '''
     Test db_get_reservations_between_dates function output
     '''
@@ -21,7 +30,7 @@ def test_db_get_reservations_between_dates():
 
     assert len(reservations_bewteen_dates) == 8
 
-def test_db_get_holds_between_dates():
+def test_db_get_holds_between_dates(memory_db):
     '''
     Test db_get_reservations_between_dates function output
     '''
@@ -31,7 +40,7 @@ def test_db_get_holds_between_dates():
     assert len(reservations_bewteen_dates) == 2
 
 
-def test_db_get_transactions_between_dates():
+def test_db_get_transactions_between_dates(memory_db):
     '''
     Test db_get_transactions_between_dates function output
     '''
@@ -41,12 +50,10 @@ def test_db_get_transactions_between_dates():
     assert len(transactions_bewteen_dates) == 14
 
 
-def test_db_add_reservation():
+def test_db_add_reservation(memory_db):
     '''
     Test db_add_reservation function
     '''
-    # Use test data
-    database_reservations.use_test_db()
 
     # Number of previous reservations for date
     prev_res = len(database_reservations.db_get_reservations_between_dates("2022-05-06",
@@ -58,27 +65,14 @@ def test_db_add_reservation():
     # Number of new reservations for date
     new_res = len(database_reservations.db_get_reservations_between_dates("2022-05-06",
         "2022-05-06", "facility1"))
-    
-    # Restore original data
-    database_reservations.restore_db_from_backup()
 
     assert new_res == prev_res + 1
 
 
-def test_db_get_latest_id():
-    '''
-    Test function to get max of reservation_id
-    '''
-    latest_id = database_reservations.db_get_latest_id()
-    assert latest_id == 14
-
-
-def test_db_add_transaction():
+def test_db_add_transaction(memory_db):
     '''
     Test db_add_transaction function
     '''
-    # Use test data
-    database_reservations.use_test_db()
 
     # Number of previous transactions for date
     prev_trans = len(database_reservations.db_get_transactions_between_dates(datetime.today().strftime("%Y-%m-%d"),
@@ -90,18 +84,13 @@ def test_db_add_transaction():
     new_trans = len(database_reservations.db_get_transactions_between_dates(datetime.today().strftime("%Y-%m-%d"),
         datetime.today().strftime("%Y-%m-%d"), 'facility1'))
 
-    # Restore original data
-    database_reservations.restore_db_from_backup()
-
     assert new_trans == prev_trans + 1
 
 
-def test_db_cancel_reservation():
+def test_db_cancel_reservation(memory_db):
     '''
     Test db_cancel_reservation function
     '''
-    # Use test data
-    database_reservations.use_test_db()
     
     # Number of previous reservations for date
     prev_res = len(database_reservations.db_get_reservations_between_dates("2022-05-10",
@@ -112,17 +101,367 @@ def test_db_cancel_reservation():
     # Number of new reservations for date
     new_res = len(database_reservations.db_get_reservations_between_dates("2022-05-10",
         "2022-05-10", "facility1"))
-    
-    # Restore original data
-    database_reservations.restore_db_from_backup()
 
     assert new_res == prev_res - 1
 
 
-def test_db_get_reservations_for_date_and_time():
+def test_db_pool_reuses_connections(memory_db):
     '''
-    Test db_cancel_reservation function
+    Test that repeated db_* calls reuse pooled connections instead of opening new ones
+    '''
+    stats_before = database_reservations.get_db_pool_stats()
+
+    for _ in range(10):
+        database_reservations.db_get_reservations_for_id(1)
+
+    stats_after = database_reservations.get_db_pool_stats()
+
+    assert stats_after['opened'] - stats_before['opened'] <= 1
+    assert stats_after['reused'] - stats_before['reused'] >= 9
+    assert stats_after['in_use'] == 0
+
+
+def test_db_iterate_does_not_hold_pooled_connections(memory_db):
+    '''
+    Test rows being streamed (e.g. a report still downloading) do not use up the connection pool
+    '''
+    pool_size = database_reservations.get_db_pool_stats()['size']
+    streams = [database_reservations.db_iter_reservations_between_dates('2022-05-01', '2022-05-31', 'facility1')
+        for _ in range(pool_size + 1)]
+    first_rows = [next(stream) for stream in streams]
+
+    in_use = database_reservations.get_db_pool_stats()['in_use']
+    reservation = database_reservations.db_get_reservations_for_id(1)
+    for stream in streams:
+        stream.close()
+
+    assert len(first_rows) == pool_size + 1
+    assert in_use == 0
+    assert reservation is not None
+
+
+def test_db_get_max_usage(memory_db):
+    '''
+    Test db_get_max_usage looks at the whole window of a reservation
+    '''
+
+    workshops_at_nine = database_reservations.db_get_max_usage('facility1', '2022-05-10', 'workshop', 9, 9.5)
+    workshops_before_nine = database_reservations.db_get_max_usage('facility1', '2022-05-10', 'workshop', 8, 9)
+    # Crusher is booked from 11 to 17.5
+    crusher_in_afternoon = database_reservations.db_get_max_usage('facility1', '2022-05-25', 'crusher', 15, 16)
+    crusher_in_other_facility = database_reservations.db_get_max_usage('facility2', '2022-05-25', 'crusher', 15, 16)
+
+    assert workshops_at_nine == 2
+    assert workshops_before_nine == 0
+    assert crusher_in_afternoon == 1
+    assert crusher_in_other_facility == 0
+
+
+def test_db_max_usage_follows_add_and_cancel(memory_db):
+    '''
+    Test the occupancy index is kept in sync when reservations are added and cancelled
     '''
-    reservations_date_time = database_reservations.db_get_reservations_for_date_and_time('2022-05-10', 9)
 
-    assert len(reservations_date_time) == 3
\ No newline at end of file
+    prev_usage = database_reservations.db_get_max_usage('facility1', '2022-05-12', 'harvester', 9, 11)
+
+    database_reservations.db_add_reservation(100, 'facility1', 0, '2022-05-12', 'harvester',
+        'test', 10, 12, 'on')
+    booked_usage = database_reservations.db_get_max_usage('facility1', '2022-05-12', 'harvester', 9, 11)
+
+    database_reservations.db_cancel_reservation(100)
+    cancelled_usage = database_reservations.db_get_max_usage('facility1', '2022-05-12', 'harvester', 9, 11)
+
+    assert prev_usage == 0
+    assert booked_usage == 1
+    assert cancelled_usage == 0
+
+
+def test_db_occupancy_loads_without_blocking(memory_db, monkeypatch):
+    '''
+    Test cached days can be read while another request loads a day from the database
+    '''
+    index = database_reservations.OCCUPANCY_INDEX
+    index.get_day('facility1', '2022-05-10')
+
+    load_day = index._load_day
+    loading, release = threading.Event(), threading.Event()
+
+    def slow_load_day(cursor, facility, reservation_date):
+        loading.set()
+        release.wait(5)
+        return load_day(cursor, facility, reservation_date)
+
+    monkeypatch.setattr(index, '_load_day', slow_load_day)
+    loaded = []
+    loader = threading.Thread(target=lambda: loaded.append(index.max_usage('facility1', '2022-05-11',
+        'workshop', 9, 18)))
+    loader.start()
+    loading.wait(5)
+
+    start = time.perf_counter()
+    harvester_usage = index.max_usage('facility1', '2022-05-10', 'harvester', 9, 10)
+    waited = time.perf_counter() - start
+    release.set()
+    loader.join()
+
+    assert waited < 1
+    assert harvester_usage == 1
+    assert loaded == [database_reservations.db_get_max_usage('facility1', '2022-05-11', 'workshop', 9, 18)]
+
+
+def test_db_window_fits(memory_db):
+    '''
+    Test db_window_fits against the half-hour slot occupancy of a day
+    '''
+
+    # Two of four workshops are booked from 9 to 9.5
+    two_workshops_fit = database_reservations.db_window_fits('facility1', '2022-05-10', 'workshop', 9, 10, units=2)
+    three_workshops_fit = database_reservations.db_window_fits('facility1', '2022-05-10', 'workshop', 9, 10, units=3)
+    # The only harvester is booked from 9 to 9.5
+    harvester_fits_at_nine = database_reservations.db_window_fits('facility1', '2022-05-10', 'harvester', 8.5, 9.5)
+    harvester_fits_after = database_reservations.db_window_fits('facility1', '2022-05-10', 'harvester', 9.5, 18)
+    occupancy = database_reservations.db_get_day_occupancy('facility1', '2022-05-10')
+
+    assert two_workshops_fit
+    assert not three_workshops_fit
+    assert not harvester_fits_at_nine
+    assert harvester_fits_after
+    assert len(occupancy) == len(database_reservations.RESOURCES) * database_reservations.SLOTS_PER_DAY
+    assert sum(occupancy) == 3
+
+
+def test_db_allocate_reservation_id(memory_db):
+    '''
+    Test reservation IDs come from the sequence and are never reused
+    '''
+
+    first_id = database_reservations.db_allocate_reservation_id()
+    second_id = database_reservations.db_allocate_reservation_id()
+
+    # A reservation added with an explicit ID moves the sequence past it
+    database_reservations.db_add_reservation(second_id + 10, 'facility1', 0, '2022-05-06', 'workshop',
+        'test', 9, 9.5, 'on')
+    third_id = database_reservations.db_allocate_reservation_id()
+
+    assert first_id == 15
+    assert second_id == 16
+    assert third_id == second_id + 11
+
+
+def test_db_reservations_transaction_rolls_back(memory_db):
+    '''
+    Test a failed booking transaction leaves no reservation, payment or balance change behind
+    '''
+
+    balance_before = database_users.db_get_balance('client1')
+    try:
+        with database_reservations.db_reservations_transaction() as cursor:
+            database_reservations.db_add_reservation(100, 'facility1', 0, '2022-05-12', 'harvester',
+                'client1', 10, 12, 'on', cursor)
+            database_users.db_update_balance('client1', -50, cursor)
+            database_reservations.db_add_transaction('100-t1', 'payment', 50, datetime.now(),
+                'client1', 100, cursor)
+            raise RuntimeError('Booking failed')
+    except RuntimeError:
+        pass
+
+    reservation = database_reservations.db_get_reservations_for_id(100)
+    balance_after = database_users.db_get_balance('client1')
+    harvester_usage = database_reservations.db_get_max_usage('facility1', '2022-05-12', 'harvester', 10, 12)
+
+    assert reservation is None
+    assert balance_after == balance_before
+    assert harvester_usage == 0
+
+
+# Queries (of database_queries.QUERIES) run on every booking or report, with example parameters
+HOT_QUERIES = [
+    ('day_occupancy', ['facility1', '2022-05-10', 'on', 'hold']),
+    ('reservations_between_dates', ['2022-05-10', '2022-05-15', 'facility1']),
+    ('reservations_between_dates_for_client', ['2022-05-10', '2022-05-15', 'facility1', 'Bad Client']),
+    ('holds_between_dates', ['2022-05-10', '2022-05-31']),
+    ('get_reservation', [1]),
+    ('payment_for_reservation', [1]),
+    ('transactions_for_user', ['admin1']),
+    ('transactions_with_reservations_for_user', ['admin1']),
+    ('transactions_with_reservations_between_dates', ['facility1', '2022-05-05', '2022-05-30']),
+    ('get_user', ['admin1']),
+]
+
+
+def test_db_migrations_applied(memory_db):
+    '''
+    Test the database is at the version of the last migration
+    '''
+    with database_reservations.get_db_connection() as conn:
+        version = database_migrations.db_get_schema_version(conn.cursor())
+
+    assert version == database_migrations.get_migrations()[-1][0]
+
+
+def test_db_hot_queries_use_indexes(memory_db):
+    '''
+    Test no hot query falls back to a full scan of a table
+    '''
+    full_scans = []
+    with database_reservations.get_db_connection() as conn:
+        for name, parameters in HOT_QUERIES:
+            plan = conn.execute("EXPLAIN QUERY PLAN " + database_reservations.QUERIES[name], parameters).fetchall()
+            full_scans += [(name, row['detail']) for row in plan if row['detail'].startswith('SCAN')]
+
+    assert full_scans == []
+
+
+def test_db_queries_compile(memory_db):
+    '''
+    Test every registered query compiles against the current schema
+    '''
+    broken = []
+    with database_reservations.get_db_connection() as conn:
+        for name, query in database_reservations.QUERIES.items():
+            try:
+                conn.execute("EXPLAIN " + query, [None] * query.count('?')).fetchall()
+            except database_reservations.sqlite3.Error as error:
+                broken.append((name, str(error)))
+
+    assert broken == []
+
+
+def test_db_user_ids_are_not_sql(memory_db):
+    '''
+    Test values are bound, not pasted into the SQL text
+    '''
+    assert not database_users.db_user_exists("nobody' OR '1'='1")
+    assert not database_reservations.db_validate_reservation("0 OR 1 = 1")
+    assert len(database_reservations.db_print_all_transactions_for_id("x' OR 'x'='x")) == 0
+
+
+def test_db_storage_pragmas_and_checkpoint(file_db):
+    '''
+    Test pooled connections use the write-ahead log and that it can be checkpointed
+    '''
+    storage = database_reservations.get_db_storage_stats()
+    checkpoint = database_reservations.DB_CHECKPOINTS.checkpoint()
+
+    assert storage['pragmas']['journal_mode'] == 'wal'
+    assert storage['pragmas']['busy_timeout'] > 0
+    assert checkpoint is not None and checkpoint[0] == 0
+
+
+def test_db_snapshot_and_restore(tmp_path, file_db):
+    '''
+    Test a snapshot of the live database can be restored while pooled connections are open
+    '''
+    snapshots = str(tmp_path / 'snapshots')
+
+    snapshot = database_backups.take_snapshot(file_db, snapshots, pages=4)
+    valid_snapshot = database_backups.check_database(snapshot)
+    database_reservations.db_add_reservation(100, 'facility1', 0, '2022-05-12', 'harvester',
+        'test', 10, 12, 'on')
+    booked = database_reservations.db_get_reservations_for_id(100)
+
+    database_backups.restore_snapshot(snapshot, file_db)
+    restored = database_reservations.db_get_reservations_for_id(100)
+    harvester_usage = database_reservations.db_get_max_usage('facility1', '2022-05-12', 'harvester', 10, 12)
+
+    # Only the newest snapshots are kept
+    for _ in range(3):
+        database_backups.take_snapshot(file_db, snapshots)
+    removed = database_backups.prune_snapshots(snapshots, retention=2)
+
+    assert valid_snapshot
+    assert booked is not None
+    assert restored is None
+    assert harvester_usage == 0
+    assert snapshot in removed
+    assert len(database_backups.list_snapshots(snapshots)) == 2
+
+
+def test_db_add_users_with_parallel_hashing():
+    '''
+    Test users loaded with several hashing processes can sign in
+    '''
+    conn = database_reservations.sqlite3.connect(':memory:')
+    conn.row_factory = database_reservations.sqlite3.Row
+    conn.executescript(open(database_reservations.CREATE_DB_FILE, 'r').read())
+    database_reservations.add_data_to_table(conn.cursor(), database_reservations.USERS_DATA, 'users', workers=2)
+
+    users = conn.execute("SELECT * FROM users").fetchall()
+    admin = conn.execute("SELECT * FROM users WHERE user_id = ?", ['admin1']).fetchone()
+    conn.close()
+
+    with open(database_reservations.USERS_DATA) as users_file:
+        assert len(users) == len(users_file.readlines()) - 1
+    assert database_users.db_check_password(admin, 'admin1password')
+    assert not database_users.db_check_password(admin, 'client1pw')
+
+
+def test_db_bulk_import_and_export(tmp_path, memory_db):
+    '''
+    Test bulk import upserts rows in batches and export streams every row back
+    '''
+
+    rows = [{'reservation_id': 5, 'facility': 'facility1', 'recurring_number': 0, 'reservation_date': '2022-05-10',
+             'resource': 'workshop', 'client_id': 'client1', 'start_time': 9, 'end_time': 9.5, 'status': 'off'}]
+    rows += [dict(rows[0], reservation_id=1000 + i, status='on') for i in range(5)]
+    queries_before = database_metrics.DB_QUERIES.value() or 0
+    imported = database_bulk.import_rows('reservations', iter(rows), batch_size=2)
+    users = database_bulk.import_rows('users', iter([{'user_id': 'bulk1', 'role': 'client', 'password': 'bulk1pw'}]))
+    import_queries = database_metrics.DB_QUERIES.value() - queries_before
+
+    export_file = tmp_path / 'reservations.ndjson'
+    with open(export_file, 'w') as data_file:
+        exported = database_bulk.export_rows('reservations', data_file, 'ndjson')
+    with open(export_file) as data_file:
+        exported_rows = list(database_bulk.read_rows(data_file, 'ndjson'))
+
+    updated = database_reservations.db_get_reservations_for_id(5)
+    new_id = database_reservations.db_allocate_reservation_id()
+    bulk_user = database_users.db_get_user('bulk1')
+
+    assert imported == 6 and users == 1
+    # One statement per batch: three of reservations, one of users
+    assert import_queries == 4
+    assert updated['status'] == 'off'
+    assert new_id == 1005
+    assert database_users.db_check_password(bulk_user, 'bulk1pw')
+    assert exported == len(exported_rows)
+    assert exported_rows[-1]['reservation_id'] == 1004
+
+
+def test_db_find_double_bookings(memory_db):
+    '''
+    Test the load test's double booking check finds slots booked over capacity
+    '''
+    no_double_bookings = load_test.find_double_bookings()
+
+    # The only harvester is already booked from 9 to 9.5; add one more, skipping the checks of make_reservation
+    database_reservations.db_add_reservation(100, 'facility1', 0, '2022-05-10', 'harvester',
+        'test', 9, 10, 'on')
+    double_bookings = load_test.find_double_bookings()
+
+    assert no_double_bookings == []
+    assert double_bookings == [('facility1', '2022-05-10', 'harvester', 0, 2)]
+
+
+def test_db_sql_profiler(memory_db, monkeypatch, caplog):
+    '''
+    Test the SQL profiler adds up calls and rows per statement and logs slow statements
+    '''
+    profiler = database_profiler.SQLProfiler(enabled=True, slow_query_ms=0.000001)
+    monkeypatch.setattr(database_helpers, 'SQL_PROFILER', profiler)
+
+    with caplog.at_level('WARNING', logger='reservations.sql'):
+        for client in ['Bad Client', 'Good Client']:
+            database_reservations.db_get_reservations_between_dates_and_client("2022-05-10", "2022-05-15",
+                "facility1", client)
+    statements = {entry['query']: entry for entry in profiler.stats()['statements']}
+    between_dates = statements['reservations_between_dates_for_client']
+
+    assert between_dates['statement'] == "SELECT * FROM reservations WHERE reservation_date BETWEEN ? AND ? "\
+        "AND status = ? AND facility = ? AND client_id = ?"
+    assert between_dates['calls'] == 2
+    assert between_dates['rows'] >= 4
+    assert between_dates['max_ms'] <= between_dates['total_ms']
+    assert "Slow query reservations_between_dates_for_client" in caplog.text
+    assert "'Bad Client'" in caplog.text
@@ -6,9 +6,16 @@
 
 import requests
 import helpers.reservation_functions as reservation_functions
+import helpers.availability_functions as availability_functions
 import database.database_reservations as database_reservations
 import database.database_users as database_users
+import database.database_sequences as database_sequences
+import base64, time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from types import SimpleNamespace
+from fastapi import HTTPException
+import pytest
 
 
 def test_good_reservation():
@@ -177,6 +184,61 @@ def test_bad_cancel():
     assert j["detail"] == "That reservation ID does not exist in our system."
 
 
+def test_reservations_with_id_blocks(file_db, monkeypatch):
+    '''
+    Test bookings take reservation IDs in blocks inside their own transaction
+    '''
+    monkeypatch.setattr(database_sequences.RESERVATION_IDS, 'block_size', 3)
+    database_users.db_update_balance('client2', 100000)
+
+    reservation_ids = [reservation_functions.make_reservation(SimpleNamespace(facility='facility1',
+        user_id='client2', reservation_item='workshop', reservation_client_id='client2',
+        reservation_date='2022-05-17', reservation_time=9 + i, duration=1))['reservation_id'] for i in range(4)]
+
+    # The rest of a block reserved by a booking that is rolled back is not handed out
+    rolled_back_ids = []
+    with pytest.raises(HTTPException):
+        with database_reservations.db_reservations_transaction() as cursor:
+            for _ in range(3):
+                rolled_back_ids.append(database_reservations.db_allocate_reservation_id(cursor))
+            raise HTTPException(status_code=400, detail='Rolled back.')
+    next_ids = [database_reservations.db_allocate_reservation_id() for _ in range(2)]
+
+    assert reservation_ids == [15, 16, 17, 18]
+    assert rolled_back_ids == [19, 20, 21]
+    assert next_ids == [21, 22]
+
+
+def test_concurrent_cancels_refund_once(file_db, monkeypatch):
+    '''
+    Test cancelling the same reservation from several threads at once cancels and refunds it once
+    '''
+    validate_active_reservation = database_reservations.db_validate_active_reservation
+
+    def slow_validate_active_reservation(reservation_id, cursor=None):
+        # Give the other threads time to check the status before this one cancels
+        active = validate_active_reservation(reservation_id, cursor)
+        time.sleep(0.05)
+        return active
+
+    monkeypatch.setattr(database_reservations, 'db_validate_active_reservation', slow_validate_active_reservation)
+
+    def cancel(reservation_id):
+        try:
+            return reservation_functions.cancel_reservation(reservation_id)['message']
+        except HTTPException as error:
+            return error.detail
+
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        messages = list(executor.map(cancel, [7] * 4))
+    refunds = [transaction for transaction in database_reservations.db_print_all_transactions_for_id('Bad Client')
+        if transaction['transaction_type'] == 'refund' and transaction['reservation_id'] == 7]
+
+    assert messages.count('Cancellation was successful!') == 1
+    assert messages.count('This reservation is already cancelled.') == 3
+    assert len(refunds) == 1
+
+
 def test_already_cancel():
     '''
     Test a reservation that was already cancelled
@@ -309,6 +371,33 @@ def test_view_reservations_using_dates_client():
     assert j["data"].count('Reservation ID') == 1
 
 
+def test_view_reservations_streamed_formats():
+    '''
+    Test GET /reservations streams the same reservations as text, CSV and JSON lines
+    '''
+    # Use test data
+    database_reservations.use_test_db()
+
+    url = "http://127.0.0.1:8000/reservations?start_date=2022-05-10&end_date=2022-05-15&facility=facility1"
+    json_response = requests.get(url)
+    text_response = requests.get(url + "&format=text")
+    csv_response = requests.get(url + "&format=csv")
+    jsonl_response = requests.get(url + "&format=jsonl")
+    bad_response = requests.get(url + "&format=xml")
+
+    # Restore original data
+    database_reservations.restore_db_from_backup()
+
+    assert text_response.status_code == 200
+    assert text_response.headers['content-type'].startswith('text/plain')
+    assert text_response.text == json_response.json()['data']
+    assert csv_response.headers['content-type'].startswith('text/csv')
+    assert csv_response.text.splitlines()[0].startswith('reservation_id,facility')
+    assert len(csv_response.text.splitlines()) == 8 + 1
+    assert [line.startswith('{') for line in jsonl_response.text.splitlines()] == [True] * 8
+    assert bad_response.status_code == 400
+
+
 def test_get_transactions():
     '''
     Test output of GET /transactions endpoint when there are transactions for parameters given
@@ -346,21 +435,6 @@ def test_get_transactions_by_id():
     assert j["data"].count('Reservation ID') == 2
 
 
-def test_booked_machines():
-    '''
-    Test get_booked_machines function from reservation_functions
-    '''
-    # Use test data
-    database_reservations.use_test_db()
-
-    str_reservation_date = "2022-05-10"
-    reservation_time = 9
-
-    current_reservations = reservation_functions.get_booked_machines(str_reservation_date, reservation_time)
-    assert len(current_reservations) == 3
-    assert current_reservations == ['workshop', 'workshop', 'harvester']
-
-
 def test_add_reservation_db():
     '''
     Test add_reservation_dict function
@@ -438,4 +512,183 @@ def test_good_hold():
 
     assert response.status_code == 200
     assert j["message"] == "Hold was successful! "
-    assert new_hold == prev_hold + 1
\ No newline at end of file
+    assert new_hold == prev_hold + 1
+
+
+def test_search_availability(memory_db):
+    '''
+    Test search_availability finds the earliest free windows within opening hours and the booking horizon
+    '''
+    # Tuesday 2022-05-10, before opening; the only harvester is booked from 9 to 9.5
+    now = datetime(2022, 5, 10, 8, 0)
+
+    harvester = availability_functions.search_availability('harvester', 1, limit=2, now=now)['data']
+    # Both extruders are booked from 9 to 9.5 on 2022-05-11
+    extruder = availability_functions.search_availability('extruder', 0.5, start_date='2022-05-11', limit=1,
+        now=now)['data']
+    # No evening hours on Saturday and closed on Sunday
+    evenings = availability_functions.search_availability('crusher', 1, start_date='2022-05-13', earliest_time=17,
+        limit=2, now=now)['data']
+    saturday = availability_functions.search_availability('crusher', 6, start_date='2022-05-14',
+        end_date='2022-05-15', limit=10, now=now)['data']
+    beyond_horizon = availability_functions.search_availability('crusher', 1, start_date='2022-06-20', now=now)['data']
+
+    assert harvester == [{'date': '2022-05-10', 'start_time': 9.5, 'end_time': 10.5},
+        {'date': '2022-05-10', 'start_time': 10.0, 'end_time': 11.0}]
+    assert extruder == [{'date': '2022-05-11', 'start_time': 9.5, 'end_time': 10.0}]
+    assert evenings == [{'date': '2022-05-13', 'start_time': 17.0, 'end_time': 18.0},
+        {'date': '2022-05-16', 'start_time': 17.0, 'end_time': 18.0}]
+    assert saturday == [{'date': '2022-05-14', 'start_time': 10.0, 'end_time': 16.0}]
+    assert beyond_horizon == []
+
+
+def test_availability_grid(memory_db):
+    '''
+    Test get_availability_grid gives the units left in every slot, none outside opening hours
+    '''
+    # Tuesday 2022-05-10 to Sunday 2022-05-15
+    grid = availability_functions.get_availability_grid('2022-05-10', '2022-05-15')['data']
+    json_grid = availability_functions.get_availability_grid('2022-05-10', '2022-05-15', encoding='json')['data']
+    slots = grid['slots_per_day']
+    harvester = base64.b64decode(grid['remaining']['harvester'])
+    workshop = base64.b64decode(grid['remaining']['workshop'])
+    crusher = base64.b64decode(grid['remaining']['crusher'])
+
+    assert len(grid['dates']) == 6 and len(harvester) == 6 * slots
+    # The harvester and two of the four workshops are booked from 9 to 9.5 on the first day
+    assert list(harvester[:2]) == [0, 1]
+    assert list(workshop[:2]) == [2, 4]
+    # Saturday from 10 to 16, closed on Sunday
+    assert list(crusher[4 * slots:5 * slots]) == [0, 0] + [1] * 12 + [0] * 4
+    assert list(crusher[5 * slots:]) == [0] * slots
+    assert json_grid['remaining']['workshop'][0] == list(workshop[:slots])
+
+
+def test_recurring_reservation(memory_db):
+    '''
+    Test make_recurring_reservation books a series all or nothing, or the occurrences that fit
+    '''
+    database_users.db_update_balance('client2', 100000)
+
+    # Weekly from Tuesday 2022-05-03; the only harvester is booked from 9 to 9.5 on 2022-05-10
+    request = SimpleNamespace(facility='facility1', user_id='client2', reservation_item='harvester',
+        reservation_client_id='client2', reservation_date='2022-05-03', reservation_time=9, duration=1,
+        frequency='weekly', occurrences=3, mode='all_or_nothing')
+    with pytest.raises(HTTPException) as all_or_nothing:
+        reservation_functions.make_recurring_reservation(request)
+    balance_before = database_users.db_get_balance('client2')
+
+    request.mode = 'best_effort'
+    series = reservation_functions.make_recurring_reservation(request)
+    rows = list(database_reservations.db_iterate('get_reservation', [series['reservation_id']]))
+
+    assert all_or_nothing.value.status_code == 400
+    assert '2022-05-10 (Machine booked for that time.)' in all_or_nothing.value.detail
+    assert [occurrence['recurring_number'] for occurrence in series['booked']] == [0, 2]
+    assert series['skipped'][0]['reservation_date'] == '2022-05-10'
+    assert [(row['recurring_number'], row['reservation_date']) for row in rows] == [(0, '2022-05-03'), (2, '2022-05-17')]
+    assert series['cost'] == 8800 * 2
+    assert database_users.db_get_balance('client2') == balance_before - series['cost']
+    assert database_reservations.db_get_payment_amount_for_id(series['reservation_id']) == series['cost']
+    assert not database_reservations.db_window_fits('facility1', '2022-05-17', 'harvester', 9, 10)
+
+
+def test_recurring_reservation_bad_request(memory_db):
+    '''
+    Test make_recurring_reservation rejects an unknown resource or date with a 400
+    '''
+    request = SimpleNamespace(facility='facility1', user_id='client2', reservation_item='spaceship',
+        reservation_client_id='client2', reservation_date='2022-05-03', reservation_time=9, duration=1,
+        frequency='weekly', occurrences=3, mode='best_effort')
+    with pytest.raises(HTTPException) as unknown_resource:
+        reservation_functions.make_recurring_reservation(request)
+
+    request.reservation_item = 'harvester'
+    request.reservation_date = '2022-13-03'
+    with pytest.raises(HTTPException) as bad_date:
+        reservation_functions.make_recurring_reservation(request)
+
+    assert unknown_resource.value.status_code == 400
+    assert unknown_resource.value.detail == "Unknown resource 'spaceship'."
+    assert bad_date.value.status_code == 400
+    assert '2022-13-03' in bad_date.value.detail
+
+
+def test_recurring_reservation_bad_client_or_time(memory_db):
+    '''
+    Test make_recurring_reservation rejects an unknown client, a non-positive or off-grid duration or
+    time, and a time outside opening hours with a 400, without changing the balance
+    '''
+    database_users.db_update_balance('client2', 100000)
+    balance_before = database_users.db_get_balance('client2')
+
+    def rejection(**details):
+        fields = dict(facility='facility1', user_id='client2', reservation_item='harvester',
+            reservation_client_id='client2', reservation_date='2022-05-03', reservation_time=9, duration=1,
+            frequency='weekly', occurrences=3, mode='best_effort')
+        fields.update(details)
+        with pytest.raises(HTTPException) as error:
+            reservation_functions.make_recurring_reservation(SimpleNamespace(**fields))
+        return error.value
+
+    unknown_client = rejection(reservation_client_id='nobody')
+    negative_duration = rejection(duration=-1)
+    off_grid_duration = rejection(duration=0.75)
+    off_grid_time = rejection(reservation_time=9.25)
+    closed = rejection(reservation_time=20)
+
+    assert unknown_client.status_code == 400
+    assert unknown_client.detail == 'nobody is not an active user.'
+    assert negative_duration.status_code == 400
+    assert negative_duration.detail == 'duration must be a positive multiple of 0.5 hours.'
+    assert off_grid_duration.status_code == 400
+    assert off_grid_time.detail == 'reservation_time must be on the hour or half hour.'
+    assert closed.status_code == 400
+    assert 'Closed at that time.' in closed.detail
+    assert database_users.db_get_balance('client2') == balance_before
+
+
+def test_reservations_batch(memory_db):
+    '''
+    Test make_reservations_batch books the valid requests and rejects the others one by one
+    '''
+    database_users.db_update_balance('client2', 100000)
+    balance_before = database_users.db_get_balance('client2')
+
+    def request(**details):
+        fields = dict(facility='facility1', user_id='client2', reservation_item='harvester',
+            reservation_client_id='client2', reservation_date='2022-05-17', reservation_time=9, duration=1)
+        fields.update(details)
+        return SimpleNamespace(**fields)
+
+    # The only harvester is booked from 9 to 9.5 on 2022-05-10, and items 2 and 3 want the same harvester
+    batch = reservation_functions.make_reservations_batch([
+        request(reservation_date='2022-05-10'),
+        request(reservation_item='spaceship'),
+        request(),
+        request(reservation_time=9.5),
+        request(reservation_client_id='nobody'),
+        request(reservation_date='2022-05-18', duration=2),
+        request(reservation_date='2022-05-19', duration=-1),
+        request(reservation_date='2022-05-19', reservation_time=9.25),
+        request(reservation_date='2022-05-15'),
+    ])
+    results = batch['data']
+
+    assert batch['message'] == '2 of 9 reservations were successful.'
+    assert [result['status'] for result in results] == ['rejected', 'rejected', 'booked', 'rejected', 'rejected',
+        'booked', 'rejected', 'rejected', 'rejected']
+    assert results[6]['detail'] == 'duration must be a positive multiple of 0.5 hours.'
+    assert results[7]['detail'] == 'reservation_time must be on the hour or half hour.'
+    assert results[8]['detail'] == 'Closed at that time.'
+    assert results[0]['detail'] == 'Machine booked for that time.'
+    assert results[3]['detail'] == 'Machine booked for that time.'
+    assert 'nobody' in results[4]['detail']
+    assert (results[2]['cost'], results[5]['cost']) == (8800, 8800 * 2)
+    assert database_users.db_get_balance('client2') == balance_before - results[2]['cost'] - results[5]['cost']
+    assert database_reservations.db_get_payment_amount_for_id(results[5]['reservation_id']) == results[5]['cost']
+    assert not database_reservations.db_window_fits('facility1', '2022-05-17', 'harvester', 9, 10)
+
+    with pytest.raises(HTTPException) as empty:
+        reservation_functions.make_reservations_batch([])
+    assert empty.value.status_code == 400
@@ -4,8 +4,10 @@
 #
 # Execution: pytest
 
-import requests
+import requests, threading, time
 import database.database_helpers as database_helpers
+import database.database_sessions as database_sessions
+import helpers.session_functions as session_functions
 
 def test_validate_user_real():
     '''
@@ -423,4 +425,166 @@ def test_add_and_show_balance():
     assert j['message'] == f"Current balance is 10100."
 
     # Restore original data
-    database_helpers.restore_db_from_backup()
\ No newline at end of file
+    database_helpers.restore_db_from_backup()
+
+def test_update_pref_disables_client_sign_in():
+    '''
+    Test client sign-in can be turned off and on again through PUT /pref
+    '''
+    # Use test data
+    database_helpers.use_test_db()
+
+    token = requests.post("http://127.0.0.1:8000/login",
+        json={'user_id': 'admin1', 'password': 'admin1password'}).json()['token']
+    headers = {'Authorization': f"Bearer {token}"}
+
+    disable_response = requests.put("http://127.0.0.1:8000/pref", json={'pref': False}, headers=headers)
+    pref = requests.get("http://127.0.0.1:8000/pref").json()['pref']
+    client_response = requests.get("http://127.0.0.1:8000/users?user_id=client1&password=client1pw")
+    scheduler_response = requests.get("http://127.0.0.1:8000/users?user_id=patrick&password=patrickpassword")
+
+    enable_response = requests.put("http://127.0.0.1:8000/pref", json={'pref': True}, headers=headers)
+    enabled_client_response = requests.get("http://127.0.0.1:8000/users?user_id=client1&password=client1pw")
+
+    # Restore original data
+    database_helpers.restore_db_from_backup()
+
+    assert disable_response.status_code == 200
+    assert pref == False
+    assert client_response.status_code == 400
+    assert client_response.json()['detail'] == 'Client sign-in disabled.'
+    assert scheduler_response.status_code == 200
+    assert enable_response.json()['pref'] == True
+    assert enabled_client_response.status_code == 200
+
+
+def test_update_pref_needs_admin():
+    '''
+    Test PUT /pref is refused without a session token or with the token of a non-admin
+    '''
+    # Use test data
+    database_helpers.use_test_db()
+
+    token = requests.post("http://127.0.0.1:8000/login",
+        json={'user_id': 'patrick', 'password': 'patrickpassword'}).json()['token']
+
+    anonymous_response = requests.put("http://127.0.0.1:8000/pref", json={'pref': False})
+    scheduler_response = requests.put("http://127.0.0.1:8000/pref", json={'pref': False},
+        headers={'Authorization': f"Bearer {token}"})
+    pref = requests.get("http://127.0.0.1:8000/pref").json()['pref']
+
+    # Restore original data
+    database_helpers.restore_db_from_backup()
+
+    assert anonymous_response.status_code == 401
+    assert scheduler_response.status_code == 403
+    assert pref == True
+
+
+def test_login_session_and_logout():
+    '''
+    Test a session token from POST /login is accepted until it is revoked by POST /logout
+    '''
+    # Use test data
+    database_helpers.use_test_db()
+
+    login_response = requests.post("http://127.0.0.1:8000/login",
+        json={'user_id': 'patrick', 'password': 'patrickpassword'})
+    token = login_response.json()['token']
+    headers = {'Authorization': f"Bearer {token}"}
+
+    session_response = requests.get("http://127.0.0.1:8000/session", headers=headers)
+    tampered_response = requests.get("http://127.0.0.1:8000/session",
+        headers={'Authorization': f"Bearer {token[:-2]}xx"})
+    logout_response = requests.post("http://127.0.0.1:8000/logout", headers=headers)
+    revoked_response = requests.get("http://127.0.0.1:8000/session", headers=headers)
+
+    # Restore original data
+    database_helpers.restore_db_from_backup()
+
+    assert login_response.status_code == 200
+    assert login_response.json()['data'] == 'scheduler'
+    assert session_response.status_code == 200
+    assert session_response.json()['data']['sub'] == 'patrick'
+    assert tampered_response.status_code == 401
+    assert logout_response.status_code == 200
+    assert revoked_response.status_code == 401
+    assert revoked_response.json()['detail'] == 'Session token revoked.'
+
+
+def test_login_wrong_password():
+    '''
+    Test POST /login does not give a token for an incorrect password
+    '''
+    # Use test data
+    database_helpers.use_test_db()
+
+    response = requests.post("http://127.0.0.1:8000/login",
+        json={'user_id': 'patrick', 'password': 'bobpassword'})
+    j = response.json()
+
+    # Restore original data
+    database_helpers.restore_db_from_backup()
+
+    assert response.status_code == 401
+    assert 'token' not in j
+
+
+def test_metrics():
+    '''
+    Test GET /metrics reports the latency, SQL statements and password hashing of a sign-in
+    '''
+    # Use test data
+    database_helpers.use_test_db()
+
+    requests.post("http://127.0.0.1:8000/login", json={'user_id': 'patrick', 'password': 'patrickpassword'})
+    response = requests.get("http://127.0.0.1:8000/metrics")
+    samples = dict(line.rsplit(' ', 1) for line in response.text.splitlines() if not line.startswith('#'))
+
+    # Restore original data
+    database_helpers.restore_db_from_backup()
+
+    assert response.status_code == 200
+    assert response.headers['content-type'].startswith('text/plain; version=0.0.4')
+    assert int(samples['reservations_http_requests_total{method="POST",route="/login",status="200"}']) >= 1
+    assert int(samples['reservations_http_request_duration_seconds_count{method="POST",route="/login"}']) >= 1
+    assert int(samples['reservations_http_request_sql_queries_sum{method="POST",route="/login"}']) >= 1
+    assert float(samples['reservations_http_request_password_hashing_seconds_total{method="POST",route="/login"}']) > 0
+    assert int(samples['reservations_db_connections_opened_total']) >= 1
+    assert samples['reservations_http_requests_in_flight'] == '1'
+
+
+def test_revocation_list_reloads_without_blocking(memory_db, monkeypatch):
+    '''
+    Test token checks keep using the revocation list while another request reloads it, and
+    a token revoked during the reload stays revoked
+    '''
+    revocations = session_functions.RevocationList(refresh=0.1)
+    revocations.revoke('old', time.time() + 60)
+    revocations.is_revoked('old')
+
+    get_revoked_tokens = database_sessions.db_get_revoked_tokens
+    reloading, release = threading.Event(), threading.Event()
+
+    def slow_get_revoked_tokens(now):
+        revoked = get_revoked_tokens(now)
+        reloading.set()
+        release.wait(5)
+        return revoked
+
+    monkeypatch.setattr(database_sessions, 'db_get_revoked_tokens', slow_get_revoked_tokens)
+    time.sleep(0.1)
+    reloader = threading.Thread(target=revocations.is_revoked, args=['old'])
+    reloader.start()
+    reloading.wait(5)
+
+    start = time.perf_counter()
+    revoked_during_reload = revocations.is_revoked('old')
+    waited = time.perf_counter() - start
+    revocations.revoke('new', time.time() + 60)
+    release.set()
+    reloader.join()
+
+    assert revoked_during_reload
+    assert waited < 1
+    assert revocations.is_revoked('new')